@@ -0,0 +1,143 @@
+import os, sys, math
+
+from log import Log
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+AGC_TARGET = -20.0
+AGC_MAX_GAIN = 30.0
+AGC_RECORDINGS = ["raw", "normalized"]
+
+class AutomaticGainControl(object):
+    _tag = "agc"
+
+    """
+    Automatic gain control with a peak limiter, brings quiet rooms up to a
+    level the detector hears well and loud rooms down before they clip. Works
+    on a whole callback's worth of frames at a time with NumPy so it costs a
+    small fraction of a Raspberry Pi core.
+
+    Each callback is split into blocks of `block_time` seconds and the RMS
+    level of every block is measured at once. The gain follows the gain that
+    would bring each block to `target`, falling with the `attack` time
+    constant and rising with the slower `release` one, and is held through
+    blocks quieter than `gate` so silence isn't amplified into hiss. The
+    limiter then pulls the gain down at once for any block whose peak would go
+    over `limit`, recovering over `limiter_release`. The gain of each sample
+    is interpolated between the gains of the blocks, and every channel gets
+    the same gain.
+
+    :param int channels: number of interleaved channels.
+    :param int sample_rate: frames per second.
+    :param int bytes_per_sample: bytes per sample, only 16 bit is supported.
+    :param float target: RMS level to bring audio to, in dBFS.
+    :param float max_gain: most gain to apply, in dB.
+    :param float min_gain: least gain to apply, in dB.
+    :param float attack: seconds for the gain to fall towards a louder level.
+    :param float release: seconds for the gain to rise towards a quieter level.
+    :param float gate: level in dBFS below which the gain is held.
+    :param float limit: highest peak to let through, in dBFS.
+    :param float limiter_release: seconds for the limiter to recover.
+    :param float block_time: seconds of audio to measure the level of at once.
+    """
+    def __init__(self,
+        channels=1,
+        sample_rate=16000,
+        bytes_per_sample=2,
+        target=AGC_TARGET,
+        max_gain=AGC_MAX_GAIN,
+        min_gain=-10.0,
+        attack=0.05,
+        release=2.0,
+        gate=-60.0,
+        limit=-1.0,
+        limiter_release=0.1,
+        block_time=0.01):
+        if numpy is None:
+            raise ImportError("numpy is needed for automatic gain control")
+        if bytes_per_sample != 2:
+            raise ValueError("Only 16 bit audio can have its gain controlled")
+
+        self.channels = channels
+        self.gain = 0.0
+        self._target = target
+        self._max_gain = max_gain
+        self._min_gain = min_gain
+        self._gate = gate
+        self._limit = limit
+        self._block_frames = max(1, int(block_time * sample_rate))
+        self._attack = math.exp(-block_time / attack)
+        self._release = math.exp(-block_time / release)
+        self._limiter_release = math.exp(-block_time / limiter_release)
+        self._limiting = 0.0
+        self._last_gain = 1.0
+        self._ceiling = 32767 * 10 ** (limit / 20.0)
+
+        Log.debug(self._tag, "AutomaticGainControl created (%d channels, "
+            "target %.1f dBFS)" % (channels, target))
+
+    def reset(self, gain=0.0):
+        """
+        Start again from a gain, such as that another instance had reached.
+
+        :param float gain: gain to start from, in dB.
+        :return: None
+        """
+        self.gain = gain
+        self._limiting = 0.0
+        self._last_gain = 10 ** (gain / 20.0)
+
+    def process(self, data):
+        """
+        Apply the gain to a block of audio.
+
+        :param bytes data: interleaved 16 bit audio.
+        :return: bytes of the audio with the gain applied.
+        """
+        samples = numpy.frombuffer(data, dtype="<i2")
+        samples = samples[:len(samples) // self.channels * self.channels]
+        frames = samples.reshape(-1, self.channels).astype(numpy.float32)
+        length = len(frames)
+        if length == 0:
+            return b""
+
+        # level and peak of each block, over all channels
+        starts = numpy.arange(0, length, self._block_frames)
+        power = numpy.add.reduceat(
+            numpy.square(frames).sum(axis=1), starts) / \
+            (numpy.diff(numpy.append(starts, length)) * self.channels)
+        peaks = numpy.maximum.reduceat(numpy.abs(frames).max(axis=1), starts)
+        levels = 10 * numpy.log10(power / 32768.0 ** 2 + 1e-12)
+        peak_levels = 20 * numpy.log10(peaks / 32768.0 + 1e-12)
+
+        # the gain is recursive, but there are only a few blocks per callback
+        gains = numpy.empty(len(starts), dtype=numpy.float32)
+        for index in range(len(starts)):
+            if levels[index] > self._gate:
+                wanted = min(self._max_gain, max(self._min_gain,
+                    self._target - levels[index]))
+                smoothing = self._attack if wanted < self.gain else \
+                    self._release
+                self.gain = smoothing * self.gain + (1 - smoothing) * wanted
+
+            over = min(0.0, self._limit - (peak_levels[index] + self.gain))
+            if over < self._limiting:
+                self._limiting = over
+            else:
+                self._limiting = self._limiter_release * self._limiting + \
+                    (1 - self._limiter_release) * over
+            gains[index] = self.gain + self._limiting
+
+        # ramp from the gain at the end of each block to the next
+        ends = numpy.append(starts[1:], length) - 1
+        amplitudes = 10 ** (gains / 20.0)
+        ramp = numpy.interp(numpy.arange(length),
+            numpy.append(-1, ends), numpy.append(self._last_gain, amplitudes))
+        self._last_gain = amplitudes[-1]
+
+        frames *= ramp[:, None].astype(numpy.float32)
+        return numpy.clip(frames, -self._ceiling, self._ceiling).astype(
+            "<i2").tobytes()
@@ -1,17 +1,51 @@
-import os, sys, signal, time
+import os, sys, signal, time, math
 import threading, collections, copy
 import pyaudio, wave, snowboydetect
 
 from log import Log
+from profiler import Profiler
 from recorder import *
+from preroll import SharedRingBuffer, SharedBackwardBuffer, PREROLL_MARGIN
+from writer import WriterPool, WRITER_THREADS
+from channels import ChannelSelector
+from agc import AutomaticGainControl, AGC_TARGET
+from chunks import ChunkStore
+from hooks import HookDispatcher, RecordingEvent
+from events import DETECTION, TRIGGER, CONTINUE, VERIFIED, NOT_VERIFIED, \
+    RETRIEVE
 
 ADD_TO_RECORD_AFTER=2
+FRAMES_PER_BUFFER=2048
+SLEEP_TIME=0.03
+WAKEUP_INTERVAL=1
+VERIFY_WINDOW=3
+
+# CPU time of the calling thread, so the callback and detection of each device
+# can be told apart, or wall time before Python 3.7
+_cpu_clock = getattr(time, "thread_time", time.time)
+
+def find_input_device(audio, device):
+    """
+    Find a PortAudio input device by index or by part of its name.
+
+    :param PyAudio audio: PortAudio instance.
+    :param device: int device index, or String part of a device name.
+    :return: int device index.
+    """
+    try:
+        return int(device)
+    except ValueError:
+        pass
+    for index in range(audio.get_device_count()):
+        info = audio.get_device_info_by_index(index)
+        if info.get("maxInputChannels", 0) > 0 and \
+            device.lower() in info.get("name", "").lower():
+            return index
+    raise ValueError("No input device named %s" % device)
 
 class AudioHandler(object):
     _tag = "audio_handler"
 
-    instance_recorders = []
-
     """Main detector object, based on `snowboydecoder.py` from Snowboy. Snowboy 
     decoder to detect whether a keyword specified by `decoder_model` exists in a 
     microphone input stream.
@@ -28,6 +62,51 @@ class AudioHandler(object):
     :param string output_dir: Directory to save recordings to.
     :param bool delete_active_recording: Delete an active recording if 
                                 interrupted
+    :param int frames_per_buffer: frames PortAudio delivers per callback.
+    :param str shared_preroll: path of a shared pre-roll segment filled by
+                                `capture.py`; if given, audio is read from it
+                                rather than from the microphone.
+    :param PostProcessor post_processor: post-processor to pass finished 
+                                recordings to.
+    :param int writer_threads: number of threads writing recordings, however
+                                many overlap.
+    :param Verifier verifier: second stage of detection that must also detect
+                                the hotword before a recording is written.
+    :param float verify_window: seconds of audio before the trigger to verify.
+    :param EventLog event_log: log to record every detection result and
+                                trigger in, None to not record them.
+    :param Uploader uploader: uploader to pass finished recordings to.
+    :param int channels: number of channels to capture and record, reduced to
+                                the detector's channels for detection; the 
+                                detector's number of channels if not given.
+    :param str channel_mode: how to reduce the channels for detection, `best`
+                                to pick the channel with the best SNR, or 
+                                `mix` to delay-and-sum them.
+    :param float segment_seconds: split recordings into files of this many
+                                seconds, tied together by a manifest.
+    :param int segment_bytes: split recordings into files of this many bytes.
+    :param String name: name of the device, to tell handlers apart in logs.
+    :param device: PortAudio input device index, or part of its name, None
+                                for the default device.
+    :param PyAudio audio: PortAudio instance shared with other handlers, None
+                                to create one.
+    :param WriterPool writer_pool: writer pool shared with other handlers, None
+                                to create one with `writer_threads` threads.
+    :param HookDispatcher hooks: hook dispatcher shared with other handlers,
+                                None to create one.
+    :param bool agc: control the gain of the audio automatically, rather than
+                                multiplying it by `audio_gain`.
+    :param float agc_target: level to bring audio to, in dBFS.
+    :param str agc_recordings: `raw` to record the audio as captured and only
+                                detect on the controlled audio, `normalized`
+                                to record the controlled audio too.
+    :param float chunk_seconds: store audio once in chunks of this many
+                                seconds, shared by overlapping recordings,
+                                each recording being a manifest of chunks;
+                                None to write each recording as WAV files.
+    :param Encryption encryption: encrypt recordings as they are written, None
+                                to write them as is.
+    :param Tap tap: live tap to stream triggered audio to, None for none.
     """
     def __init__(self,
         decoder_model,
@@ -36,16 +115,55 @@ class AudioHandler(object):
         audio_gain=1,
         continue_recording=False,
         output_dir=".",
-        delete_active_recording=False):
+        delete_active_recording=False,
+        frames_per_buffer=FRAMES_PER_BUFFER,
+        shared_preroll=None,
+        post_processor=None,
+        writer_threads=WRITER_THREADS,
+        verifier=None,
+        verify_window=VERIFY_WINDOW,
+        event_log=None,
+        uploader=None,
+        channels=None,
+        channel_mode="best",
+        segment_seconds=None,
+        segment_bytes=None,
+        name=None,
+        device=None,
+        audio=None,
+        writer_pool=None,
+        hooks=None,
+        agc=False,
+        agc_target=AGC_TARGET,
+        agc_recordings="raw",
+        chunk_seconds=None,
+        encryption=None,
+        tap=None):
+
+        self.name = name
+        if name is not None:
+            self._tag = "%s:%s" % (AudioHandler._tag, name)
 
         self.is_running = False
         self.is_interrupted = False
         self.is_recording = False
         self.is_terminated = False
 
-        self._start_recording_callback = None
-        self._continue_recording_callback = None
-        self._stop_recording_callback = None
+        # how long detection waits after running, so how much audio normally
+        # waits in the detector buffer
+        self.wakeup_interval = WAKEUP_INTERVAL
+
+        self._callbacks = {}
+        self._owns_hooks = hooks is None
+        self.hooks = hooks or HookDispatcher()
+
+        self.instance_recorders = RecorderList()
+        self.retrievals = RecorderList()
+        self._owns_writer_pool = writer_pool is None
+        self.writer_pool = writer_pool or WriterPool(workers=writer_threads)
+
+        self.cpu_time = {"callback": 0.0, "detection": 0.0}
+        self._cpu_since = time.time()
 
         # Setup Snowboy
         tm = type(decoder_model)
@@ -58,7 +176,7 @@ class AudioHandler(object):
 
         self.detector = snowboydetect.SnowboyDetect(
             resource_filename=resource.encode(), model_str=model_str.encode())
-        self.detector.SetAudioGain(audio_gain)
+        self.detector.SetAudioGain(1 if agc else audio_gain)
         self.num_hotwords = self.detector.NumHotwords()
 
         if len(decoder_model) > 1 and len(sensitivity) == 1:
@@ -71,30 +189,102 @@ class AudioHandler(object):
         if len(sensitivity) != 0:
             self.detector.SetSensitivity(sensitivity_str.encode())
 
+        # capture more channels than the detector takes, reducing them for it
+        self.num_channels = channels or self.detector.NumChannels()
+        if self.num_channels > self.detector.NumChannels():
+            self._selector = ChannelSelector(
+                channels=self.num_channels,
+                mode=channel_mode,
+                bytes_per_sample=self.detector.BitsPerSample() // 8)
+        else:
+            self._selector = None
+
+        # control the gain of everything recorded, or just what is detected on
+        if agc and agc_recordings == "normalized" and \
+            shared_preroll is not None:
+            raise ValueError("Recordings from a shared pre-roll can't be "
+                "normalized")
+        self._agc_recordings = agc_recordings
+        if agc:
+            self._agc = AutomaticGainControl(
+                channels=self.num_channels if agc_recordings == "normalized"
+                    else self.detector.NumChannels(),
+                sample_rate=self.detector.SampleRate(),
+                bytes_per_sample=self.detector.BitsPerSample() // 8,
+                target=agc_target)
+        else:
+            self._agc = None
+
         # create detector buffer
         self.detector_buffer = DetectorRingBuffer(
             self.detector.NumChannels() * self.detector.SampleRate() * 5)
         self.backward_buffer = None
 
-        # connect to the PyAudio stream
-        self.audio = pyaudio.PyAudio()
-        self.stream_in = self.audio.open(
-            input=True, output=False,
-            format=self.audio.get_format_from_width(
-                self.detector.BitsPerSample() / 8),
-            channels=self.detector.NumChannels(),
-            rate=self.detector.SampleRate(),
-            frames_per_buffer=2048,
-            stream_callback=self._audio_callback)
+        if shared_preroll is None:
+            self.shared_ring = None
+
+            # connect to the PyAudio stream
+            self._owns_audio = audio is None
+            self.audio = audio or pyaudio.PyAudio()
+            self.stream_in = self.audio.open(
+                input=True, output=False,
+                input_device_index=None if device is None else
+                    find_input_device(self.audio, device),
+                format=self.audio.get_format_from_width(
+                    self.detector.BitsPerSample() // 8),
+                channels=self.num_channels,
+                rate=self.detector.SampleRate(),
+                frames_per_buffer=frames_per_buffer,
+                stream_callback=self._audio_callback)
+        else:
+            # reattach to the ring kept by the capture process
+            self.shared_ring = SharedRingBuffer(path=shared_preroll)
+            bytes_per_second = self.num_channels * \
+                self.detector.SampleRate() * self.detector.BitsPerSample() // 8
+            if self.shared_ring.bytes_per_second != bytes_per_second:
+                raise ValueError("Shared pre-roll has %d bytes per second, "
+                    "detector needs %d" % (self.shared_ring.bytes_per_second,
+                    bytes_per_second))
+
+            self._shared_ring_thread = threading.Thread(
+                target=self._read_shared_ring,
+                args=(float(frames_per_buffer) / self.detector.SampleRate(),))
+            self._shared_ring_thread.daemon = True
+            self._shared_ring_thread.start()
 
         # listen to interrupots
         signal.signal(signal.SIGINT, self.stop)
+        Profiler.handle_signals(output_dir)
 
         self._enable_continue_recording = continue_recording
         self._output_dir = output_dir
         self._delete_active_recording = delete_active_recording
-
-        Log.debug(self._tag, "AudioHandler created")
+        self._frames_per_buffer = frames_per_buffer
+        self._post_processor = post_processor
+        self._verifier = verifier
+        self._verify_window = verify_window
+        self._event_log = event_log
+        self._uploader = uploader
+        self._segment_seconds = segment_seconds
+        self._segment_bytes = segment_bytes
+        self._encryption = encryption
+        self._tap = tap
+
+        # switched to `pcm8` by `Backpressure` while the writers are behind
+        self.encoding = "pcm"
+
+        if chunk_seconds is None:
+            self.chunk_store = None
+        else:
+            self.chunk_store = ChunkStore(
+                dir=output_dir,
+                num_channels=self.num_channels,
+                sample_rate=self.detector.SampleRate(),
+                bytes_per_sample=self.detector.BitsPerSample() // 8,
+                chunk_seconds=chunk_seconds)
+
+        Log.debug(self._tag, "AudioHandler created (%d frames per buffer)" %
+            frames_per_buffer)
 
     def start(self,
         record_before,
@@ -102,7 +292,8 @@ class AudioHandler(object):
         sleep_time, 
         start_recording_callback=None,
         continue_recording_callback=None,
-        stop_recording_callback=None):
+        stop_recording_callback=None,
+        wakeup_interval=WAKEUP_INTERVAL):
         """
         Start hotwor detection. For every `sleep_time` second it checks the
         audio buffer for triggering keywords. Every loop it checks if the loop 
@@ -120,27 +311,15 @@ class AudioHandler(object):
         :param Function stop_recording_callback: callback function for when 
                                 recoridng has commenced for the alloted time 
                                 should stop.
+        Callbacks are run by `hooks` off the detection thread, and are passed
+        a `RecordingEvent`.
+        :param Float wakeup_interval: how much time in seconds to wait after 
+                                running detection on a chunk of audio.
         :return: None
         """
-        self.is_interrupted = False
-        self.is_running = True
-
-        if callable(start_recording_callback):
-            self._start_recording_callback = start_recording_callback
-        if callable(continue_recording_callback):
-            self._continue_recording_callback = continue_recording_callback
-        if callable(stop_recording_callback):
-            self._stop_recording_callback = stop_recording_callback
-
-        self._bytes_per_sample=self.detector.BitsPerSample() / 8
-        self._record_before=record_before
-        self._record_after=record_after
-
-        self.backward_buffer=BackwardBuffer(
-            num_channels=self.detector.NumChannels(),
-            sample_rate=self.detector.SampleRate(),
-            bytes_per_sample=self.detector.BitsPerSample() / 8,
-            record_for=record_before)
+        self.listen(record_before, record_after, start_recording_callback,
+            continue_recording_callback, stop_recording_callback,
+            wakeup_interval)
 
         Log.info(self._tag, "Started listening for hotword...")
 
@@ -152,67 +331,281 @@ class AudioHandler(object):
                 Log.debug(self._tag, "Terminate detected")
                 break
 
-            data = self.detector_buffer.get()
-            if len(data) == 0:
+            if self.detect():
+                time.sleep(wakeup_interval)
+            else:
                 time.sleep(sleep_time)
-                continue
-
-            ans = self.detector.RunDetection(data)
-            if ans == -1:
-                Log.critical(self._tag,
-                    "Error initialising streams or reading audio data")
-            elif ans > 0:
-                has_recorder=len(self.instance_recorders) > 0
-                is_recording=has_recorder and not self.instance_recorders[-1].capture_stopped()
-
-                if not self._enable_continue_recording and is_recording:
-                    Log.error(self._tag, "Continue recording disabled")
-                    continue
-                elif is_recording:
-                    Log.info(self._tag, "Continue recording")
-                    Log.info(self._tag, "has_recorder=%s" % has_recorder)
-                    Log.info(self._tag, "last_stopped_recording=%s" % self.instance_recorders[-1].capture_stopped())
-
-                    try:
-                        self._timer.cancel()
-                    except AttributeError:
-                        pass
-                    self.instance_recorders[-1].extend_desired_length(self._record_after)
-
-                    if self._continue_recording_callback <> None:
-                        self._continue_recording_callback()
-                else:
-                    Log.info(self._tag, "Start recording")
-
-                    if self._start_recording_callback <> None:
-                        self._start_recording_callback()
-
-                    buf_after=ForwardBuffer(
-                        num_channels=self.detector.NumChannels(),
-                        sample_rate=self.detector.SampleRate(),
-                        bytes_per_sample=self._bytes_per_sample,
-                        record_for=self._record_after)
-
-                    self.instance_recorders.append(InstanceRecorder(
-                        buf_before=self.backward_buffer,
-                        buf_after=buf_after,
-                        num_channels=self.detector.NumChannels(),
-                        sample_rate=self.detector.SampleRate(),
-                        bytes_per_sample=self._bytes_per_sample,
-                        dir=self._output_dir,
-                        delete_active_recording=self._delete_active_recording))
-
-                    self.instance_recorders[-1].start()
-
-                self._timer = threading.Timer(record_after+ADD_TO_RECORD_AFTER, self._stop_recording)
-                self._timer.daemon = True
-                self._timer.start()
-
-            time.sleep(1)
 
         Log.info(self._tag, "Stopped listening for hotword")
         self.stop()
 
+    def listen(self,
+        record_before,
+        record_after,
+        start_recording_callback=None,
+        continue_recording_callback=None,
+        stop_recording_callback=None,
+        wakeup_interval=WAKEUP_INTERVAL):
+        """
+        Get ready to detect, without starting a loop to detect in; `start`
+        calls this, or call `detect` from a loop of your own.
+
+        :param Int record_before: seconds to record before hotword.
+        :param Int record_after: seconds to record after hotword.
+        :param Function start_recording_callback: see `start`.
+        :param Function continue_recording_callback: see `start`.
+        :param Function stop_recording_callback: see `start`.
+        :param Float wakeup_interval: see `start`.
+        :return: None
+        """
+        self.is_interrupted = False
+        self.is_running = True
+        self.wakeup_interval = wakeup_interval
+        self._cpu_since = time.time()
+
+        for kind, callback in [("start", start_recording_callback),
+            ("continue", continue_recording_callback),
+            ("stop", stop_recording_callback)]:
+            if callable(callback):
+                if kind in self._callbacks:
+                    self.hooks.unregister(kind, self._callbacks[kind])
+                self.hooks.register(kind, callback)
+                self._callbacks[kind] = callback
+
+        self._bytes_per_sample=self.detector.BitsPerSample() // 8
+        self._record_before=record_before
+        self._record_after=record_after
+
+        # recordings are read from the back buffer when writing starts, and
+        # chunked ones as they are written, so it holds a little more for the
+        # writers to catch up
+        record_for = record_before + PREROLL_MARGIN
+        if self.chunk_store is not None:
+            self.chunk_store.new_session()
+
+        if self.shared_ring is None:
+            self.backward_buffer=BackwardBuffer(
+                num_channels=self.num_channels,
+                sample_rate=self.detector.SampleRate(),
+                bytes_per_sample=self.detector.BitsPerSample() // 8,
+                record_for=record_for)
+        else:
+            self.backward_buffer=SharedBackwardBuffer(
+                ring=self.shared_ring,
+                num_channels=self.num_channels,
+                sample_rate=self.detector.SampleRate(),
+                bytes_per_sample=self.detector.BitsPerSample() // 8,
+                record_for=record_for)
+
+    def detect(self):
+        """
+        Run detection on the audio buffered since it was last run, starting or
+        continuing a recording if the hotword is heard.
+
+        :return: Boolean, False if there was no audio to detect on.
+        """
+        data = self.detector_buffer.get()
+        if len(data) == 0:
+            return False
+
+        started = Profiler.start_timer()
+        cpu_started = _cpu_clock()
+        if self._event_log is not None:
+            detection_started = time.time()
+        ans = self.detector.RunDetection(data)
+        Profiler.stop_timer("detection", started)
+        if self._event_log is not None:
+            self._log_event(DETECTION, ans,
+                time.time() - detection_started)
+        if ans == -1:
+            Log.critical(self._tag,
+                "Error initialising streams or reading audio data")
+        elif ans > 0:
+            self._triggered(ans)
+
+        self.cpu_time["detection"] += _cpu_clock() - cpu_started
+        return True
+
+    def _triggered(self, ans):
+        """
+        Start a recording for a detected hotword, or continue the current one.
+
+        :param int ans: what `RunDetection` returned, the hotword index.
+        :return: None
+        """
+        last_recorder=self.instance_recorders.last()
+        has_recorder=last_recorder is not None
+        is_recording=has_recorder and not last_recorder.capture_stopped()
+
+        if not self._enable_continue_recording and is_recording:
+            Log.error(self._tag, "Continue recording disabled")
+            return
+        elif is_recording:
+            Log.info(self._tag, "Continue recording")
+            Log.info(self._tag, "has_recorder=%s" % has_recorder)
+            Log.info(self._tag, "last_stopped_recording=%s" % last_recorder.capture_stopped())
+
+            try:
+                self._timer.cancel()
+            except AttributeError:
+                pass
+            last_recorder.extend_desired_length(self._record_after)
+            self._log_event(CONTINUE, ans)
+            self._dispatch("continue", last_recorder)
+        else:
+            Log.info(self._tag, "Start recording")
+
+            buf_after=ForwardBuffer(
+                num_channels=self.num_channels,
+                sample_rate=self.detector.SampleRate(),
+                bytes_per_sample=self._bytes_per_sample,
+                record_for=self._record_after)
+
+            # the pre-roll is read when writing starts, which is later for
+            # provisional recordings or when the writers are busy
+            trigger=self.backward_buffer.total_length()
+            if self.chunk_store is not None:
+                self.chunk_store.forget(trigger-self.backward_buffer.length())
+            before_range=(max(0, trigger-self._record_before*
+                self.num_channels*self.detector.SampleRate()*
+                self._bytes_per_sample), trigger)
+
+            last_recorder=InstanceRecorder(
+                buf_before=self.backward_buffer,
+                buf_after=buf_after,
+                num_channels=self.num_channels,
+                sample_rate=self.detector.SampleRate(),
+                bytes_per_sample=self._bytes_per_sample,
+                dir=self._output_dir,
+                delete_active_recording=self._delete_active_recording,
+                keep_audio=self._post_processor is not None,
+                finished_callback=self._recording_finished,
+                writer_pool=self.writer_pool,
+                provisional=self._verifier is not None,
+                before_range=before_range,
+                segment_seconds=self._segment_seconds,
+                segment_bytes=self._segment_bytes,
+                chunk_store=self.chunk_store,
+                encryption=self._encryption,
+                encoding=self.encoding)
+            self.instance_recorders.append(last_recorder)
+            self._log_event(TRIGGER, ans)
+
+            last_recorder.start()
+            if self._verifier is None:
+                self._dispatch("start", last_recorder)
+
+            if self._verifier is not None:
+                audio = self.backward_buffer.get_last(int(
+                    self._verify_window * self.detector.SampleRate()) *
+                    self.num_channels * self._bytes_per_sample)
+                if self._selector is not None:
+                    audio = self._selector.select(audio, update=False)
+                self._verifier.submit(last_recorder, audio,
+                    self._verified, 0.0 if self._agc is None else
+                    self._agc.gain)
+
+        self._timer = threading.Timer(
+            self._record_after+ADD_TO_RECORD_AFTER,
+            self._stop_recording, args=(last_recorder,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def cpu_usage(self):
+        """
+        Retrieves the CPU time spent on this device's audio since it started
+        listening: in the audio callback, including channel selection, and in
+        detection. Writing recordings is shared by all devices, so isn't
+        counted.
+
+        :return: dict of seconds in `callback` and `detection`, and the
+                                `fraction` of time since listening started
+                                spent on both.
+        """
+        usage = dict(self.cpu_time)
+        elapsed = max(time.time() - self._cpu_since, 1e-6)
+        usage["fraction"] = (usage["callback"] + usage["detection"]) / elapsed
+        return usage
+
+    def retrieve(self, start, end=0, after=0):
+        """
+        Cut a recording out of the pre-roll, from `start` seconds ago to `end`
+        seconds ago, optionally continuing for `after` seconds from now. It is
+        written by the writer pool like any other recording, without
+        interrupting detection, but doesn't count as a hotword. Only as much 
+        audio as the backward buffer holds (`record_before`) can be retrieved.
+
+        :param float start: seconds ago the recording starts.
+        :param float end: seconds ago the recording ends, 0 for now.
+        :param float after: seconds to keep recording from now, only if `end` 
+                                is 0.
+        :return: the InstanceRecorder writing the recording.
+        """
+        if self.backward_buffer is None:
+            raise RuntimeError("Can't retrieve audio until detection starts")
+        if end < 0 or start <= end or after < 0:
+            raise ValueError("Can't retrieve from %.2f to %.2f seconds ago "
+                "and %.2f seconds after" % (start, end, after))
+        if end > 0 and after > 0:
+            raise ValueError("Can't record after a range ending in the past")
+
+        sample_rate = self.detector.SampleRate()
+        bytes_per_frame = self.num_channels * self._bytes_per_sample
+        frame = self.backward_buffer.total_length() // bytes_per_frame
+        start_frame = max(0, frame - int(start * sample_rate))
+        end_frame = max(0, frame - int(end * sample_rate))
+
+        held = min(self.backward_buffer.length(),
+            self.backward_buffer.max_length()) // bytes_per_frame
+        if frame - start_frame > held:
+            Log.warning(self._tag, "Only %.2f of %.2f seconds ago are held, "
+                "retrieving from then" % (float(held) / sample_rate, start))
+
+        buf_after=ForwardBuffer(
+            num_channels=self.num_channels,
+            sample_rate=sample_rate,
+            bytes_per_sample=self._bytes_per_sample,
+            record_for=int(math.ceil(after)))
+
+        retrieval=InstanceRecorder(
+            buf_before=self.backward_buffer,
+            buf_after=buf_after,
+            num_channels=self.num_channels,
+            sample_rate=sample_rate,
+            bytes_per_sample=self._bytes_per_sample,
+            dir=self._output_dir,
+            file_prefix="retrieval-",
+            keep_audio=self._post_processor is not None,
+            finished_callback=self._recording_finished,
+            writer_pool=self.writer_pool,
+            before_range=(start_frame * bytes_per_frame,
+                end_frame * bytes_per_frame),
+            trigger_label="retrieve",
+            segment_seconds=self._segment_seconds,
+            segment_bytes=self._segment_bytes,
+            chunk_store=self.chunk_store,
+            encryption=self._encryption,
+            encoding=self.encoding)
+        self.retrievals.append(retrieval)
+        self._log_event(RETRIEVE)
+        Log.info(self._tag, "Retrieving %.2f to %.2f seconds ago and %.2f "
+            "seconds after in %s" % (start, end, after, retrieval.filename))
+
+        if after > 0:
+            retrieval.start()
+            timer = threading.Timer(after, retrieval.stop_capture)
+            timer.daemon = True
+            timer.start()
+        else:
+            # nothing is captured after, so it is written in one go
+            retrieval.stop_capture()
+        return retrieval
+
+    @property
+    def handlers(self):
+        """The handlers of each device, just this one"""
+        return [self]
+
     def interrupt(self):
         """
         Interrupt the hotword detection if it is running, otherwise do nothing.
@@ -223,12 +616,8 @@ class AudioHandler(object):
         self.is_interrupted = True
         self.is_recording = False
         self.detector_buffer.clear()
-        for idx, instance_recorder in enumerate(self.instance_recorders):
-            try:
-                instance_recorder.interrupt()
-                del self.instance_recorders[idx]
-            except AttributeError:
-                pass
+        self.instance_recorders.interrupt()
+        self.retrievals.interrupt()
 
     def stop(self):
         """
@@ -272,50 +661,152 @@ class AudioHandler(object):
             self.stream_in.close()
         except AttributeError:
             pass
-        try:
+        if self.shared_ring is None and self._owns_audio:
             self.audio.terminate()
-        except AttributeError:
-            pass
+        if self.shared_ring is not None:
+            self._shared_ring_thread.join()
+            self.shared_ring.close()
+
+        if self._owns_writer_pool:
+            self.writer_pool.terminate()
+        if self._verifier is not None:
+            self._verifier.terminate()
+        if self._owns_hooks:
+            self.hooks.terminate()
 
     def _audio_callback(self, in_data, frame_count, time_info, status):
         """Write audio from PyAudio to the buffers"""
-        try:
-            clean_ups = []
-            for i in range(0,len(self.instance_recorders)):
-                if self.instance_recorders[i].clean_up:
-                    clean_ups.append(i)
-                    pass
-
-                self.instance_recorders[i].extend(in_data)
-
-            for clean_up in clean_ups:
-                del self.instance_recorders[clean_up]
-        except AttributeError:
-            pass
-
-        self.detector_buffer.extend(in_data)
+        started = Profiler.start_timer()
+        cpu_started = _cpu_clock()
+        if self._agc is not None and self._agc_recordings == "normalized":
+            in_data = self._agc.process(in_data)
+        self.instance_recorders.extend(in_data)
+        self.retrievals.extend(in_data)
+
+        if self._selector is None:
+            detector_data = in_data
+        else:
+            detector_data = self._selector.select(in_data)
+        if self._agc is not None and self._agc_recordings == "raw":
+            detector_data = self._agc.process(detector_data)
+        self.detector_buffer.extend(detector_data)
         try:
             self.backward_buffer.extend(in_data)
         except AttributeError:
             pass
+        if self._tap is not None:
+            self._tap.publish()
 
-        play_data = chr(0) * len(in_data)
+        play_data = b"\x00" * len(in_data)
+        self.cpu_time["callback"] += _cpu_clock() - cpu_started
+        Profiler.stop_timer("callback", started)
         return play_data, pyaudio.paContinue
 
-    def _stop_recording(self, index=-1):
+    def _verified(self, instance_recorder, passed):
+        """
+        Commit a provisional recording once the verifier has checked it, or 
+        discard it if the trigger was false.
+
+        :param InstanceRecorder instance_recorder: the provisional recording.
+        :param bool passed: whether the verifier detected the hotword.
+        :return: None
+        """
+        if not passed:
+            Log.info(self._tag, "Trigger not verified, discarding recording")
+            self._log_event(NOT_VERIFIED)
+            instance_recorder.discard()
+            return
+
+        Log.info(self._tag, "Trigger verified")
+        self._log_event(VERIFIED)
+        instance_recorder.commit()
+        self._dispatch("start", instance_recorder)
+
+    def _log_event(self, kind, result=0, duration=0):
+        """
+        Record an event in the event log, if there is one, at the frame most
+        recently passed to the detector.
+
+        :param int kind: kind of event, see `events.py`.
+        :param int result: what `RunDetection` returned, the hotword index if
+                                positive.
+        :param float duration: seconds spent in `RunDetection`.
+        :return: None
+        """
+        if self._event_log is None:
+            return
+        self._event_log.log(kind, self._frame(), result=result,
+            hotword=max(result, 0), duration=duration)
+
+    def _frame(self):
+        """Retrieves the index of the frame most recently passed to the detector"""
+        return self.detector_buffer.total_length() // \
+            (self.detector.NumChannels() * self.detector.BitsPerSample() // 8)
+
+    def _dispatch(self, kind, instance_recorder):
+        """
+        Run the hooks for a recording event, off this thread.
+
+        :param String kind: `start`, `continue` or `stop`.
+        :param InstanceRecorder instance_recorder: the recording.
+        :return: None
+        """
+        if kind == "start" and self._tap is not None:
+            self._tap.open_stream(self, instance_recorder)
+        self.hooks.dispatch(RecordingEvent(kind, instance_recorder,
+            self._frame()))
+
+    def _recording_finished(self, instance_recorder):
+        """
+        Hand a recording that has been written and closed on for 
+        post-processing and uploading.
+
+        :param InstanceRecorder instance_recorder: the finished recorder.
+        :return: None
+        """
+        if self._post_processor is not None:
+            self._post_processor.submit(instance_recorder)
+        if self._uploader is not None:
+            self._uploader.submit(instance_recorder)
+
+    def _read_shared_ring(self, poll_time):
+        """
+        Pass audio written to the shared ring by the capture process on to the
+        buffers, as if it came from PyAudio. Starts from the current end of the
+        ring, as the pre-roll before it is read directly by the backward 
+        buffer, and once listening carries on from where the backward buffer
+        ends, so recordings' forward buffers start where their pre-roll ends.
+
+        :param float poll_time: how much time in seconds to wait between reads.
+        :return: None
+        """
+        cursor = self.shared_ring.cursor()
+        while not self.is_terminated:
+            backward_buffer = self.backward_buffer
+            if backward_buffer is None:
+                data, cursor = self.shared_ring.read_since(cursor)
+            else:
+                data = backward_buffer.read()
+            if len(data) > 0:
+                self._audio_callback(data, len(data), None, 0)
+            time.sleep(poll_time)
+
+    def _stop_recording(self, instance_recorder):
         """
         Stop the audio recording to disk, called when the hotword was detected 
         some time ago.
 
-        :param int index: Index of the recorder to stop (last be default) 
+        :param InstanceRecorder instance_recorder: the recorder to stop.
         :return: None
         """
         Log.info(self._tag, "Stop Recording")
 
         self._timer = None
 
-        self.instance_recorders[index].stop_capture()
+        instance_recorder.stop_capture()
+
+        if instance_recorder.is_discarded():
+            return
 
-        if self._stop_recording_callback <> None:
-            self._stop_recording_callback()
+        self._dispatch("stop", instance_recorder)
 
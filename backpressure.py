@@ -0,0 +1,248 @@
+import os, sys
+import threading
+
+from log import Log
+from recorder import audioop
+
+BACKPRESSURE_INTERVAL = 0.5
+BACKPRESSURE_THRESHOLDS = [0.25, 0.5, 0.75]
+
+# what each tier sheds, and what undoing it is called, in the order shed
+TIERS = [
+    ("pause_post_processing", "resume_post_processing"),
+    ("pause_uploads", "resume_uploads"),
+    ("cheap_encoding", "full_encoding"),
+]
+
+class Backpressure(object):
+    _tag = "backpressure"
+
+    """
+    Watches the bounded queues between capture, detection, writing and
+    post-processing, and sheds work in tiers when they back up, such as when
+    the SD card stalls, so audio is only dropped as a last resort.
+
+    The queues are each device's detector buffer (capture to detection), each
+    recording's forward buffer (capture to writing), the writer pool's ready
+    queue and the post-processor's and uploader's queues. Every `interval`
+    seconds the lag of each is measured, and the pressure is how full the
+    fullest detector or forward buffer is, beyond the audio that normally
+    waits to be detected on or written. As the pressure passes each of `thresholds`,
+    post-processing is paused, then uploads, then, if `cheap_encoding` is
+    allowed, new recordings are written with 8 bit samples, half as many
+    bytes, which is recorded in their metadata. A tier is left, one at a time,
+    once the pressure falls under half its threshold, so shedding doesn't
+    flap. Every change of tier is logged as a warning and counted in
+    `counts`, and audio
+    dropped regardless is logged and counted in `dropped`.
+
+    :param list handlers: the `AudioHandler` of each device.
+    :param PostProcessor post_processor: post-processor to pause first, None
+                                if there is none.
+    :param Uploader uploader: uploader to pause second, None if there is none.
+    :param list thresholds: pressure, from 0 to 1, at which to shed each tier.
+    :param bool cheap_encoding: write recordings with 8 bit samples as the
+                                last tier, otherwise only post-processing and
+                                uploads are shed.
+    :param float interval: seconds between measurements.
+    """
+    def __init__(self,
+        handlers,
+        post_processor=None,
+        uploader=None,
+        thresholds=BACKPRESSURE_THRESHOLDS,
+        cheap_encoding=False,
+        interval=BACKPRESSURE_INTERVAL):
+        self.handlers = handlers
+        self.tier = 0
+        self.lags = {}
+        self.counts = {}
+        for shed, restore in TIERS:
+            self.counts[shed] = 0
+            self.counts[restore] = 0
+        self.dropped = {"detection": 0, "writing": 0}
+
+        self._post_processor = post_processor
+        self._uploader = uploader
+        self._thresholds = thresholds[:len(TIERS)]
+        if not cheap_encoding:
+            self._thresholds = self._thresholds[:2]
+        elif audioop is None:
+            Log.warning(self._tag, "audioop is missing, recordings can't be "
+                "written with 8 bit samples")
+            self._thresholds = self._thresholds[:2]
+        self._interval = interval
+        self._detector_dropped = [handler.detector_buffer.dropped
+            for handler in handlers]
+        self._recorder_dropped = {}
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._work, name="backpressure")
+        self._thread.daemon = True
+        self._thread.start()
+
+        Log.debug(self._tag, "Backpressure created (thresholds %s)" %
+            ", ".join("%.2f" % threshold for threshold in self._thresholds))
+
+    def measure(self):
+        """
+        Measure the lag of each queue and count any audio dropped since last
+        measured.
+
+        :return: dict of the most seconds of audio waiting to be detected on
+                                (`detection`) and to be written (`writing`),
+                                the seconds the oldest recording has waited
+                                for a writer (`writer_queue`), the
+                                recordings waiting to be post-processed
+                                (`post_processing`) and uploaded (`uploads`),
+                                and the `pressure`.
+        """
+        lags = {"detection": 0.0, "writing": 0.0, "writer_queue": 0.0,
+            "post_processing": 0, "uploads": 0, "pressure": 0.0}
+        writer_pools = {}
+        recorders = {}
+        for index, handler in enumerate(self.handlers):
+            buf = handler.detector_buffer
+            dropped = buf.dropped - self._detector_dropped[index]
+            self._detector_dropped[index] = buf.dropped
+
+            # the detector buffer fills up whenever detection isn't running,
+            # up to `wakeup_interval` of audio after every detection, so only
+            # what waits beyond that is pressure
+            if handler.is_running:
+                bytes_per_second = handler.detector.NumChannels() * \
+                    handler.detector.SampleRate() * \
+                    handler.detector.BitsPerSample() // 8
+                lags["detection"] = max(lags["detection"],
+                    float(buf.length()) / bytes_per_second)
+                expected = int(handler.wakeup_interval * bytes_per_second)
+                if buf.max_length() > expected:
+                    lags["pressure"] = max(lags["pressure"],
+                        float(max(buf.length() - expected, 0)) /
+                        (buf.max_length() - expected))
+                if dropped > 0:
+                    Log.error(self._tag, "Detection fell behind, dropped %d "
+                        "bytes%s" % (dropped, "" if handler.name is None else
+                        " from " + handler.name))
+                    self.dropped["detection"] += dropped
+
+            writer_pools[id(handler.writer_pool)] = handler.writer_pool
+            for instance_recorder in handler.instance_recorders.recorders() + \
+                handler.retrievals.recorders():
+                recorders[id(instance_recorder)] = instance_recorder
+
+        for key, instance_recorder in recorders.items():
+            lags["writing"] = max(lags["writing"], instance_recorder.lag())
+            lags["pressure"] = max(lags["pressure"],
+                instance_recorder.backlog())
+            dropped = instance_recorder.dropped()
+            self.dropped["writing"] += dropped - \
+                self._recorder_dropped.get(key, 0)
+            self._recorder_dropped[key] = dropped
+        for key in list(self._recorder_dropped):
+            if key not in recorders:
+                del self._recorder_dropped[key]
+
+        for writer_pool in writer_pools.values():
+            lags["writer_queue"] = max(lags["writer_queue"], writer_pool.lag())
+        if self._post_processor is not None:
+            lags["post_processing"] = self._post_processor.pending()
+        if self._uploader is not None:
+            lags["uploads"] = self._uploader.pending()
+
+        self.lags = lags
+        return lags
+
+    def check(self):
+        """
+        Measure the queues, then shed or restore tiers to suit the pressure.
+        The pressure can shed several tiers at once, but they are restored
+        one at a time.
+
+        :return: int the tier now in place, 0 when nothing is shed.
+        """
+        pressure = self.measure()["pressure"]
+        tier = self.tier
+        while tier < len(self._thresholds) and \
+            pressure >= self._thresholds[tier]:
+            tier += 1
+        if tier == self.tier and tier > 0 and \
+            pressure < self._thresholds[tier - 1] / 2:
+            tier -= 1
+
+        while self.tier < tier:
+            self._shed(self.tier)
+            self.tier += 1
+        while self.tier > tier:
+            self.tier -= 1
+            self._restore(self.tier)
+        return self.tier
+
+    def report(self):
+        """
+        Log the lag of each queue, the tier in place, and how often each tier
+        has been shed and how much audio has been dropped.
+
+        :return: None
+        """
+        lags = self.lags
+        if len(lags) == 0:
+            lags = self.measure()
+        Log.info(self._tag, "Lag: detection %.2fs, writing %.2fs, writer "
+            "queue %.2fs, %d to post-process, %d to upload (pressure %.2f)" %
+            (lags["detection"], lags["writing"], lags["writer_queue"],
+            lags["post_processing"], lags["uploads"], lags["pressure"]))
+        Log.info(self._tag, "Tier %d, %s; dropped %d bytes detecting, %d "
+            "writing" % (self.tier, ", ".join("%s %d" % (name,
+            self.counts[name]) for name in sorted(self.counts)),
+            self.dropped["detection"], self.dropped["writing"]))
+
+    def terminate(self):
+        """
+        Stop watching and restore everything shed.
+
+        :return: None
+        """
+        self._stopped.set()
+        self._thread.join()
+        while self.tier > 0:
+            self.tier -= 1
+            self._restore(self.tier)
+        Log.debug(self._tag, "Backpressure terminated")
+
+    def _shed(self, tier):
+        """Shed the work of a tier"""
+        name = TIERS[tier][0]
+        if name == "pause_post_processing" and self._post_processor is not None:
+            self._post_processor.pause()
+        elif name == "pause_uploads" and self._uploader is not None:
+            self._uploader.pause()
+        elif name == "cheap_encoding":
+            for handler in self.handlers:
+                handler.encoding = "pcm8"
+        self.counts[name] += 1
+        Log.warning(self._tag, "Writers behind (pressure %.2f, writing lag "
+            "%.2fs), %s" % (self.lags["pressure"], self.lags["writing"], name))
+
+    def _restore(self, tier):
+        """Restore the work shed by a tier"""
+        name = TIERS[tier][1]
+        if name == "resume_post_processing" and \
+            self._post_processor is not None:
+            self._post_processor.resume()
+        elif name == "resume_uploads" and self._uploader is not None:
+            self._uploader.resume()
+        elif name == "full_encoding":
+            for handler in self.handlers:
+                handler.encoding = "pcm"
+        self.counts[name] += 1
+        Log.warning(self._tag, "Writers caught up (pressure %.2f), %s" %
+            (self.lags.get("pressure", 0.0), name))
+
+    def _work(self):
+        """Check the queues every interval until terminated"""
+        while not self._stopped.wait(self._interval):
+            try:
+                self.check()
+            except Exception as e:
+                Log.error(self._tag, "Couldn't check the queues: %s" % e)
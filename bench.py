@@ -0,0 +1,313 @@
+import os, sys, argparse, json, time, platform, shutil, tempfile
+import logging
+
+from log import Log
+from recorder import *
+from channels import ChannelSelector
+from agc import AutomaticGainControl
+
+BASELINE_FILE = os.path.join(TOP_DIR, "bench-baseline.json")
+
+NUM_CHANNELS = 1
+SAMPLE_RATE = 16000
+BYTES_PER_SAMPLE = 2
+BYTES_PER_SECOND = NUM_CHANNELS * SAMPLE_RATE * BYTES_PER_SAMPLE
+CHUNK = b"\x01\x02" * 2048
+
+class Benchmarks(object):
+    _tag = "bench"
+
+    """
+    Micro-benchmarks of the hot paths, runnable without a microphone or GPIO.
+    Each benchmark is timed `repeat` times and the fastest run kept, as the
+    slower runs only measure interference from the rest of the system.
+
+    :param int repeat: number of times to time each benchmark.
+    :param String only: only run benchmarks whose name contains this.
+    """
+    def __init__(self, repeat=5, only=None):
+        self._repeat = repeat
+        self._only = only
+        self.results = {}
+
+    def run(self):
+        """
+        Run every benchmark.
+
+        :return: dict of benchmark name to seconds per operation.
+        """
+        self._time("ring_extend", self._ring_extend, 2000)
+        self._time("ring_get", self._ring_get, 200)
+        self._time("ring_get_copy", self._ring_get_copy, 5)
+        self._time("ring_get_last_3s", self._ring_get_last, 50)
+
+        for recorders in [0, 1, 2, 5, 10]:
+            self._time("audio_callback_%d_recorders" % recorders,
+                self._audio_callback(recorders), 500)
+
+        for channels in [4, 8]:
+            for mode in ["best", "mix"]:
+                self._time("channel_%s_%d" % (mode, channels),
+                    self._channel_selector(channels, mode), 100)
+
+        for channels in [1, 4]:
+            self._time("agc_%d" % channels, self._agc(channels), 100)
+
+        self._time("writer_3s", self._writer, 20)
+        self._time("log_post_filtered", self._log_post_filtered, 5000)
+        self._time("log_post_emitted", self._log_post_emitted, 5000)
+        return self.results
+
+    def _time(self, name, benchmark, number):
+        """
+        Time a benchmark, keeping the fastest of `repeat` runs.
+
+        :param String name: name of the benchmark.
+        :param function benchmark: called with `number`, returns a function
+                                that runs the operation `number` times, or
+                                None if the benchmark can't run here.
+        :param int number: times to run the operation per timing.
+        :return: None
+        """
+        if self._only is not None and self._only not in name:
+            return
+
+        best = None
+        for i in range(self._repeat):
+            operation = benchmark(number)
+            if operation is None:
+                Log.warning(self._tag, "Skipped %s" % name)
+                return
+            started = time.time()
+            operation()
+            elapsed = (time.time() - started) / number
+            best = elapsed if best is None else min(best, elapsed)
+
+        self.results[name] = best
+        Log.info(self._tag, "%s: %.3f us" % (name, best * 1e6))
+
+    def _ring_extend(self, number):
+        buf = BackwardBuffer(record_for=60)
+        buf.extend(b"\x00" * buf.max_length())
+        def operation():
+            for i in range(number):
+                buf.extend(CHUNK)
+        return operation
+
+    def _ring_get(self, number):
+        buf = DetectorRingBuffer(BYTES_PER_SECOND * 5)
+        def operation():
+            for i in range(number):
+                buf.extend(CHUNK)
+                buf.get()
+        return operation
+
+    def _ring_get_copy(self, number):
+        buf = BackwardBuffer(record_for=60)
+        buf.extend(b"\x00" * buf.max_length())
+        def operation():
+            for i in range(number):
+                buf.get_copy()
+        return operation
+
+    def _ring_get_last(self, number):
+        buf = BackwardBuffer(record_for=60)
+        buf.extend(b"\x00" * buf.max_length())
+        def operation():
+            for i in range(number):
+                buf.get_last(3 * BYTES_PER_SECOND)
+        return operation
+
+    def _audio_callback(self, recorders):
+        """Time `AudioHandler._audio_callback` with some active recorders"""
+        def benchmark(number):
+            try:
+                from audio import AudioHandler
+            except ImportError as e:
+                Log.warning(self._tag, "Can't import AudioHandler: %s" % e)
+                return None
+
+            # a handler without a stream or detector, only what the callback uses
+            handler = AudioHandler.__new__(AudioHandler)
+            handler.detector_buffer = DetectorRingBuffer(BYTES_PER_SECOND * 5)
+            handler.backward_buffer = BackwardBuffer(record_for=60)
+            handler.backward_buffer.extend(
+                b"\x00" * handler.backward_buffer.max_length())
+            handler.instance_recorders = RecorderList()
+            handler.retrievals = RecorderList()
+            handler._selector = None
+            handler._agc = None
+            handler._tap = None
+            handler.cpu_time = {"callback": 0.0, "detection": 0.0}
+            for i in range(recorders):
+                # provisional recorders buffer without writing to disk
+                handler.instance_recorders.append(InstanceRecorder(
+                    buf_before=handler.backward_buffer,
+                    buf_after=ForwardBuffer(record_for=60),
+                    provisional=True))
+
+            def operation():
+                for i in range(number):
+                    handler._audio_callback(CHUNK, len(CHUNK) // 2, None, 0)
+                    if i % 8 == 0:
+                        handler.detector_buffer.get()
+            return operation
+        return benchmark
+
+    def _channel_selector(self, channels, mode):
+        """Time reducing a callback's worth of multi-channel audio to one"""
+        def benchmark(number):
+            try:
+                selector = ChannelSelector(channels, mode)
+            except ImportError as e:
+                Log.warning(self._tag, "Can't select channels: %s" % e)
+                return None
+
+            data = b"\x01\x02\x03\x04" * (len(CHUNK) * channels // 4)
+            def operation():
+                for i in range(number):
+                    selector.select(data)
+            return operation
+        return benchmark
+
+    def _agc(self, channels):
+        """Time controlling the gain of a callback's worth of audio"""
+        def benchmark(number):
+            try:
+                agc = AutomaticGainControl(channels)
+            except ImportError as e:
+                Log.warning(self._tag, "Can't control gain: %s" % e)
+                return None
+
+            data = b"\x01\x02\x03\x04" * (len(CHUNK) * channels // 4)
+            def operation():
+                for i in range(number):
+                    agc.process(data)
+            return operation
+        return benchmark
+
+    def _writer(self, number):
+        """Time writing 3 seconds of forward buffer to disk"""
+        data = b"\x01\x02" * (3 * SAMPLE_RATE)
+        output_dir = tempfile.mkdtemp(prefix="cvr-bench-")
+        buf_before = BackwardBuffer(record_for=1)
+        instance_recorder = InstanceRecorder(
+            buf_before=buf_before,
+            buf_after=ForwardBuffer(record_for=60),
+            dir=output_dir)
+        instance_recorder.write_pending()
+        def operation():
+            for i in range(number):
+                instance_recorder.buf_after.extend(data)
+                instance_recorder.write_pending()
+            instance_recorder.buf_after.stop_capture()
+            instance_recorder.write_pending()
+            shutil.rmtree(output_dir, ignore_errors=True)
+        return operation
+
+    def _log_post_filtered(self, number):
+        def operation():
+            for i in range(number):
+                Log.debug("bench", "filtered %d" % i)
+        return operation
+
+    def _log_post_emitted(self, number):
+        def operation():
+            for i in range(number):
+                Log.info("bench_emitted", "emitted %d" % i)
+        return operation
+
+def save(results, path):
+    """
+    Save benchmark results, with details of the interpreter and machine.
+
+    :param dict results: benchmark name to seconds per operation.
+    :param String path: file to save to.
+    :return: None
+    """
+    with open(path, "w") as f:
+        json.dump({
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "time": int(time.time()),
+            "results": results
+        }, f, indent=4, sort_keys=True)
+    Log.info("bench", "Saved results to %s" % path)
+
+def compare(baseline, current, tolerance):
+    """
+    Compare results against a baseline.
+
+    :param dict baseline: benchmark name to seconds per operation.
+    :param dict current: benchmark name to seconds per operation.
+    :param float tolerance: fraction slower a benchmark may be before it is
+                                a regression.
+    :return: list of the names of benchmarks that regressed.
+    """
+    regressions = []
+    for name in sorted(current):
+        if name not in baseline:
+            Log.info("bench", "%s: %.3f us (no baseline)" %
+                (name, current[name] * 1e6))
+            continue
+
+        change = current[name] / baseline[name] - 1
+        if change > tolerance:
+            regressions.append(name)
+            Log.error("bench", "%s: %.3f us, %+.1f%% REGRESSION" %
+                (name, current[name] * 1e6, change * 100))
+        else:
+            Log.info("bench", "%s: %.3f us, %+.1f%%" %
+                (name, current[name] * 1e6, change * 100))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the buffers, audio callback, writer and logging.")
+    parser.add_argument("command",
+        help="`run` the benchmarks, optionally saving them as a baseline, or `compare` them with a baseline.",
+        choices={"run", "compare"})
+    parser.add_argument("--baseline",
+        help="Baseline file to save to or compare with. Default is bench-baseline.json alongside bench.py.",
+        default=BASELINE_FILE)
+    parser.add_argument("--results",
+        help="Saved results to compare, rather than running the benchmarks.",
+        default=None)
+    parser.add_argument("--save",
+        help="Save the results of `run` as the baseline.",
+        action='store_true')
+    parser.add_argument("--tolerance",
+        help="Fraction slower a benchmark may be before `compare` flags it. Default is 0.2.",
+        default=0.2,
+        type=float)
+    parser.add_argument("--repeat",
+        help="Number of times to time each benchmark. Default is 5.",
+        default=5,
+        type=int)
+    parser.add_argument("--only",
+        help="Only run benchmarks whose name contains this.",
+        default=None)
+    args = parser.parse_args()
+
+    # emitted log lines go nowhere, so only the cost of Log is measured
+    logging.basicConfig(stream=open(os.devnull, "w"), level=logging.INFO)
+    Log.chosen_level = logging.INFO
+    logging.getLogger("bench").addHandler(logging.StreamHandler(sys.stderr))
+    logging.getLogger("bench").propagate = False
+
+    if args.command == "compare" and args.results is not None:
+        with open(args.results) as f:
+            results = json.load(f)["results"]
+    else:
+        results = Benchmarks(repeat=args.repeat, only=args.only).run()
+
+    if args.command == "run":
+        if args.save:
+            save(results, args.baseline)
+        sys.exit(0)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(baseline, results, args.tolerance)
+    sys.exit(1 if len(regressions) > 0 else 0)
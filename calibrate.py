@@ -0,0 +1,227 @@
+import os, sys, json, time
+import pyaudio, snowboydetect
+
+from log import Log
+from recorder import DetectorRingBuffer, RESOURCE_FILE, TOP_DIR
+from audio import FRAMES_PER_BUFFER, SLEEP_TIME, WAKEUP_INTERVAL
+
+CALIBRATION_FILE = os.path.join(TOP_DIR, "calibration.json")
+
+FRAMES_PER_BUFFER_OPTIONS = [512, 1024, 2048, 4096]
+SLEEP_TIME_OPTIONS = [0.01, 0.03, 0.1]
+WAKEUP_INTERVAL_OPTIONS = [0.1, 0.5, 1]
+LATENCY_TOLERANCE = 0.02
+
+def load_calibration(path=CALIBRATION_FILE):
+    """
+    Load a previously saved calibration, if there is one.
+
+    :param str path: file the calibration was saved to.
+    :return: dict with `frames_per_buffer`, `sleep_time` and `wakeup_interval`
+                                (any missing setting uses the default).
+    """
+    config = {
+        "frames_per_buffer": FRAMES_PER_BUFFER,
+        "sleep_time": SLEEP_TIME,
+        "wakeup_interval": WAKEUP_INTERVAL
+    }
+    try:
+        with open(path, "r") as f:
+            saved = json.load(f)
+    except (IOError, OSError, ValueError):
+        return config
+
+    for key in config:
+        if key in saved:
+            config[key] = saved[key]
+    Log.debug("calibrator", "Loaded calibration from %s" % path)
+    return config
+
+def save_calibration(config, path=CALIBRATION_FILE):
+    """
+    Save a calibration so later runs use it.
+
+    :param dict config: calibration to save.
+    :param str path: file to save the calibration to.
+    :return: None
+    """
+    with open(path, "w") as f:
+        json.dump(config, f, indent=4, sort_keys=True)
+    Log.info("calibrator", "Saved calibration to %s" % path)
+
+class Calibrator(object):
+    _tag = "calibrator"
+
+    """
+    Sweep PortAudio buffer sizes and detection loop timings on this device,
+    measuring callback overruns, CPU use and detection latency for each, to
+    pick the best configuration.
+
+    :param decoder_model: decoder model file path; stirng or list of strings
+    :param Path resource: resource file path.
+    :param audio_gain: multiply input volume by this factor.
+    :param float duration: seconds to measure each configuration for.
+    :param list frames_per_buffer_options: buffer sizes to try.
+    :param list sleep_time_options: polling sleeps to try.
+    :param list wakeup_interval_options: waits after detection to try.
+    :param float latency_tolerance: seconds of mean latency more than the
+                                lowest that a configuration may have and
+                                still be chosen for using less CPU.
+    """
+    def __init__(self,
+        decoder_model,
+        resource=RESOURCE_FILE,
+        audio_gain=1,
+        duration=10,
+        frames_per_buffer_options=FRAMES_PER_BUFFER_OPTIONS,
+        sleep_time_options=SLEEP_TIME_OPTIONS,
+        wakeup_interval_options=WAKEUP_INTERVAL_OPTIONS,
+        latency_tolerance=LATENCY_TOLERANCE):
+        if type(decoder_model) is not list:
+            decoder_model = [decoder_model]
+
+        self.detector = snowboydetect.SnowboyDetect(
+            resource_filename=resource.encode(),
+            model_str=",".join(decoder_model).encode())
+        self.detector.SetAudioGain(audio_gain)
+
+        self._duration = duration
+        self._frames_per_buffer_options = frames_per_buffer_options
+        self._sleep_time_options = sleep_time_options
+        self._wakeup_interval_options = wakeup_interval_options
+        self._latency_tolerance = latency_tolerance
+
+        self.results = []
+
+        Log.debug(self._tag, "Calibrator created")
+
+    def run(self):
+        """
+        Measure every combination of settings.
+
+        :return: dict of the best configuration.
+        """
+        self.audio = pyaudio.PyAudio()
+        try:
+            for frames_per_buffer in self._frames_per_buffer_options:
+                for sleep_time in self._sleep_time_options:
+                    for wakeup_interval in self._wakeup_interval_options:
+                        self.results.append(self._measure(
+                            frames_per_buffer, sleep_time, wakeup_interval))
+        finally:
+            self.audio.terminate()
+
+        return self.best()
+
+    def best(self):
+        """
+        Choose the best measured configuration. Configurations that overran
+        the callback are only considered if every one did, then of those
+        whose mean latency is within `latency_tolerance` of the lowest, the
+        one using the least CPU wins, with latency breaking ties.
+
+        :return: dict of the best configuration.
+        """
+        if len(self.results) == 0:
+            raise ValueError("No configurations have been measured")
+
+        fewest_overruns = min(r["overruns"] for r in self.results)
+        candidates = [r for r in self.results
+            if r["overruns"] == fewest_overruns]
+        lowest_latency = min(r["mean_latency"] for r in candidates)
+        candidates = [r for r in candidates
+            if r["mean_latency"] <= lowest_latency + self._latency_tolerance]
+        best = min(candidates, key=lambda r: (r["cpu"], r["mean_latency"]))
+
+        Log.info(self._tag,
+            "Best configuration is %d frames per buffer, %.2fs sleep time and "
+            "%.2fs wakeup interval" % (best["frames_per_buffer"],
+                best["sleep_time"], best["wakeup_interval"]))
+        return {
+            "frames_per_buffer": best["frames_per_buffer"],
+            "sleep_time": best["sleep_time"],
+            "wakeup_interval": best["wakeup_interval"]
+        }
+
+    def _measure(self, frames_per_buffer, sleep_time, wakeup_interval):
+        """
+        Run the detection loop with one configuration for `duration` seconds.
+
+        :param int frames_per_buffer: frames PortAudio delivers per callback.
+        :param float sleep_time: how much time in second every loop waits.
+        :param float wakeup_interval: how much time in seconds to wait after
+                                running detection on a chunk of audio.
+        :return: dict of the measurements.
+        """
+        sample_rate = self.detector.SampleRate()
+        buffer_time = float(frames_per_buffer) / sample_rate
+
+        self.detector.Reset()
+        self._buffer = DetectorRingBuffer(
+            self.detector.NumChannels() * sample_rate * 5)
+        self._overruns = 0
+        self._pending_since = None
+
+        stream = self.audio.open(
+            input=True, output=False,
+            format=self.audio.get_format_from_width(
+                self.detector.BitsPerSample() // 8),
+            channels=self.detector.NumChannels(),
+            rate=sample_rate,
+            frames_per_buffer=frames_per_buffer,
+            stream_callback=self._audio_callback)
+
+        latencies = []
+        times_start = os.times()
+        started = time.time()
+        while time.time() - started < self._duration:
+            pending_since = self._pending_since
+            self._pending_since = None
+            data = self._buffer.get()
+            if len(data) == 0:
+                time.sleep(sleep_time)
+                continue
+
+            self.detector.RunDetection(data)
+            if pending_since is not None:
+                latencies.append(time.time() - pending_since + buffer_time)
+            time.sleep(wakeup_interval)
+
+        elapsed = time.time() - started
+        times_end = os.times()
+
+        stream.stop_stream()
+        stream.close()
+
+        cpu = ((times_end[0] - times_start[0]) +
+            (times_end[1] - times_start[1])) / elapsed
+        if len(latencies) > 0:
+            mean_latency = sum(latencies) / len(latencies)
+            max_latency = max(latencies)
+        else:
+            mean_latency = max_latency = float("inf")
+
+        result = {
+            "frames_per_buffer": frames_per_buffer,
+            "sleep_time": sleep_time,
+            "wakeup_interval": wakeup_interval,
+            "overruns": self._overruns,
+            "cpu": cpu,
+            "mean_latency": mean_latency,
+            "max_latency": max_latency
+        }
+        Log.info(self._tag,
+            "%d frames, %.2fs sleep, %.2fs wakeup: %d overruns, %.1f%% CPU, "
+            "%.3fs mean latency, %.3fs max latency" % (frames_per_buffer,
+                sleep_time, wakeup_interval, self._overruns, cpu * 100,
+                mean_latency, max_latency))
+        return result
+
+    def _audio_callback(self, in_data, frame_count, time_info, status):
+        """Count overruns and write audio from PyAudio to the buffer"""
+        if status & pyaudio.paInputOverflow:
+            self._overruns += 1
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        self._buffer.extend(in_data)
+        return None, pyaudio.paContinue
@@ -0,0 +1,116 @@
+import os, sys, signal, argparse, time
+import pyaudio
+
+from log import Log
+from preroll import SharedRingBuffer, PREROLL_SEGMENT, PREROLL_MARGIN, \
+    PREROLL_SECONDS
+
+class CaptureProcess(object):
+    _tag = "capture_process"
+
+    """
+    Tiny process that owns the microphone and keeps the pre-roll in a shared
+    ring, so the detector can be restarted without losing it.
+
+    :param str segment: path of the shared ring segment.
+    :param int seconds: seconds of audio to keep in the ring, at least the
+                                recorder's `record_before` and
+                                `PREROLL_MARGIN`.
+    :param int num_channels: number of audio channels to capture.
+    :param int sample_rate: sample rate.
+    :param int bytes_per_sample: bytes per sample.
+    :param int frames_per_buffer: frames PortAudio delivers per callback.
+    """
+    def __init__(self,
+        segment=PREROLL_SEGMENT,
+        seconds=PREROLL_SECONDS,
+        num_channels=1,
+        sample_rate=16000,
+        bytes_per_sample=2,
+        frames_per_buffer=2048):
+        bytes_per_second = num_channels * sample_rate * bytes_per_sample
+        self.ring = SharedRingBuffer(
+            path=segment,
+            size=seconds * bytes_per_second,
+            bytes_per_second=bytes_per_second,
+            create=True)
+
+        self._is_interrupted = False
+
+        self.audio = pyaudio.PyAudio()
+        self.stream_in = self.audio.open(
+            input=True, output=False,
+            format=self.audio.get_format_from_width(bytes_per_sample),
+            channels=num_channels,
+            rate=sample_rate,
+            frames_per_buffer=frames_per_buffer,
+            stream_callback=self._audio_callback)
+
+        signal.signal(signal.SIGINT, self.interrupt)
+        signal.signal(signal.SIGTERM, self.interrupt)
+
+        Log.debug(self._tag, "CaptureProcess created")
+
+    def run(self):
+        """
+        Capture until interrupted, then release the microphone and segment.
+
+        :return: None
+        """
+        Log.info(self._tag, "Capturing to %s" % self.ring.path)
+        while not self._is_interrupted:
+            time.sleep(1)
+
+        self.stream_in.stop_stream()
+        self.stream_in.close()
+        self.audio.terminate()
+        self.ring.close()
+        self.ring.unlink()
+        Log.info(self._tag, "Stopped capturing")
+
+    def interrupt(self, signal, frame):
+        """
+        Handle interrupts by stopping capture.
+
+        :return: None
+        """
+        Log.info(self._tag, "Interrupt triggered")
+        self._is_interrupted = True
+
+    def _audio_callback(self, in_data, frame_count, time_info, status):
+        """Write audio from PyAudio to the shared ring"""
+        self.ring.extend(in_data)
+        return None, pyaudio.paContinue
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log",
+        help="Minimum level of log output.",
+        choices={"DEBUG","INFO","WARNING","ERROR","CRITICAL"},
+        default="INFO")
+    parser.add_argument("--segment",
+        help="Path of the shared pre-roll segment. Default is %s." % PREROLL_SEGMENT,
+        default=PREROLL_SEGMENT)
+    parser.add_argument("--seconds",
+        help="Number of seconds of audio to keep, at least the recorder's --before plus %d. Default is %d." % (PREROLL_MARGIN, PREROLL_SECONDS),
+        default=PREROLL_SECONDS,
+        type=int)
+    parser.add_argument("--frames-per-buffer",
+        help="Frames of audio delivered per callback. Default is 2048.",
+        dest='frames_per_buffer',
+        default=2048,
+        type=int)
+    parser.add_argument("--channels",
+        help="Number of channels to capture, the same as the recorder's --channels. Default is 1.",
+        default=1,
+        type=int)
+    args = parser.parse_args()
+
+    Log.init(getattr(Log,args.log))
+
+    capture = CaptureProcess(segment=args.segment,
+        seconds=args.seconds,
+        frames_per_buffer=args.frames_per_buffer,
+        num_channels=args.channels)
+    capture.run()
+    sys.exit(0)
@@ -0,0 +1,127 @@
+import os, sys
+
+from log import Log
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHANNEL_MODES = ["best", "mix"]
+
+class ChannelSelector(object):
+    _tag = "channel_selector"
+
+    """
+    Reduces interleaved audio from a multi-microphone array to the single
+    channel the detector needs, working on a whole callback's worth of frames
+    at a time with NumPy so it keeps up with 8 channels on a Raspberry Pi.
+
+    In `best` mode the channel with the highest signal to noise ratio is
+    passed on, the noise floor of each channel being tracked from the quietest
+    blocks it has seen. To stop the detector hearing a jump on every block,
+    another channel only takes over once it is `switch_margin` times better.
+
+    In `mix` mode the channels are delay-and-summed: each is cross-correlated
+    (by FFT) with the best channel, shifted by the lag of the peak, up to
+    `max_delay` frames either way, and the aligned channels are averaged.
+
+    :param int channels: number of interleaved channels.
+    :param String mode: `best` or `mix`.
+    :param int bytes_per_sample: bytes per sample, only 16 bit is supported.
+    :param int max_delay: most frames to shift a channel by when mixing.
+    :param float switch_margin: how many times better the SNR of another
+                                channel must be to switch to it.
+    :param float noise_rise: factor the noise floor rises by per block, so it
+                                recovers after a quiet spell.
+    """
+    def __init__(self,
+        channels,
+        mode="best",
+        bytes_per_sample=2,
+        max_delay=16,
+        switch_margin=1.4,
+        noise_rise=1.01):
+        if numpy is None:
+            raise ImportError("numpy is needed to capture multiple channels")
+        if mode not in CHANNEL_MODES:
+            raise ValueError("Unknown channel mode %s" % mode)
+        if bytes_per_sample != 2:
+            raise ValueError("Only 16 bit audio can be reduced to one channel")
+
+        self.channels = channels
+        self.mode = mode
+        self.channel = 0
+        self._max_delay = max_delay
+        self._switch_margin = switch_margin
+        self._noise_rise = noise_rise
+        self._noise = None
+
+        Log.debug(self._tag, "ChannelSelector created (%d channels, %s)" %
+            (channels, mode))
+
+    def select(self, data, update=True):
+        """
+        Reduce a block of interleaved audio to one channel.
+
+        :param bytes data: interleaved 16 bit audio.
+        :param bool update: pick the best channel from this audio, rather than
+                                using the one last picked.
+        :return: bytes of one channel of 16 bit audio.
+        """
+        samples = numpy.frombuffer(data, dtype="<i2")
+        samples = samples[:len(samples) // self.channels * self.channels]
+        frames = samples.reshape(-1, self.channels)
+        if len(frames) == 0:
+            return b""
+
+        if update:
+            self.channel = self._best(frames)
+        if self.mode == "best":
+            return frames[:, self.channel].tobytes()
+        return self._mix(frames).tobytes()
+
+    def _best(self, frames):
+        """
+        Update each channel's noise floor with this block's RMS, then pick the
+        channel with the best SNR.
+
+        :param numpy.ndarray frames: frames by channels array of samples.
+        :return: int index of the best channel.
+        """
+        rms = numpy.sqrt(numpy.mean(
+            numpy.square(frames, dtype=numpy.float32), axis=0)) + 1
+        if self._noise is None:
+            self._noise = rms
+        else:
+            self._noise = numpy.minimum(self._noise * self._noise_rise, rms)
+
+        snr = rms / self._noise
+        best = int(numpy.argmax(snr))
+        if snr[best] > snr[self.channel] * self._switch_margin:
+            return best
+        return self.channel
+
+    def _mix(self, frames):
+        """
+        Delay-and-sum the channels, aligned to the best channel.
+
+        :param numpy.ndarray frames: frames by channels array of samples.
+        :return: numpy.ndarray of the mixed 16 bit samples.
+        """
+        length = len(frames)
+        signal = frames.astype(numpy.float32)
+        size = 1 << int(2 * length - 1).bit_length()
+        spectra = numpy.fft.rfft(signal, n=size, axis=0)
+        correlation = numpy.fft.irfft(
+            spectra * numpy.conj(spectra[:, self.channel:self.channel + 1]),
+            n=size, axis=0)
+
+        # lags -max_delay..max_delay, wrapped around the end of the FFT
+        lags = numpy.arange(-self._max_delay, self._max_delay + 1)
+        delays = lags[numpy.argmax(correlation[lags % size], axis=0)]
+
+        index = numpy.clip(numpy.arange(length)[:, None] + delays[None, :],
+            0, length - 1)
+        aligned = numpy.take_along_axis(signal, index, axis=0)
+        return numpy.clip(aligned.mean(axis=1), -32768, 32767).astype("<i2")
@@ -0,0 +1,277 @@
+import os, sys, argparse, json, time, wave
+import threading, shutil
+
+from log import Log
+from recorder import write_cue_chunks
+
+CHUNK_SECONDS = 10
+CHUNK_DIR = "chunks"
+
+class ChunkStore(object):
+    _tag = "chunk_store"
+
+    """
+    Stores captured audio once, however many recordings overlap it. Audio is
+    addressed by its position in everything captured since listening started
+    (a session), and kept in fixed-length raw chunk files,
+    `chunks/<session>/<index>.pcm`, each byte at its offset in the chunk.
+    Recordings write the range of audio they cover, and only the parts no
+    earlier recording has written are written to disk; each recording is then
+    a manifest of chunk ranges, turned into a WAV file by `export` when it is
+    needed.
+
+    Which parts of each chunk are written is only remembered for as long as
+    a recording could write them (see `forget`). Sessions that no manifest in
+    `dir` refers to, such as those whose recordings were all deleted, are
+    deleted by `prune` when the store is created.
+
+    :param String dir: directory to keep the chunks in, under `chunks`.
+    :param int num_channels: number of audio channels.
+    :param int sample_rate: frames per second.
+    :param int bytes_per_sample: bytes per sample.
+    :param float chunk_seconds: seconds of audio per chunk file.
+    """
+    def __init__(self,
+        dir,
+        num_channels=1,
+        sample_rate=16000,
+        bytes_per_sample=2,
+        chunk_seconds=CHUNK_SECONDS):
+        self.dir = dir
+        bytes_per_frame = num_channels * bytes_per_sample
+        self.chunk_bytes = max(1, int(chunk_seconds * sample_rate)) * \
+            bytes_per_frame
+        self.session = None
+        self.bytes_requested = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+        self._written = {}
+        self.prune()
+        Log.debug(self._tag, "ChunkStore created (%d bytes per chunk)" %
+            self.chunk_bytes)
+
+    def new_session(self):
+        """
+        Start a new session, as positions start again from 0 whenever
+        listening starts.
+
+        :return: String name of the session.
+        """
+        with self._lock:
+            name = str(int(time.time()))
+            suffix = 0
+            while os.path.exists(os.path.join(self.dir, CHUNK_DIR, name)):
+                suffix += 1
+                name = "%d-%d" % (int(time.time()), suffix)
+            os.makedirs(os.path.join(self.dir, CHUNK_DIR, name))
+            self.session = name
+            self._written = {}
+        Log.debug(self._tag, "Started session %s" % name)
+        return name
+
+    def write(self, position, data):
+        """
+        Store audio, writing only what isn't stored already.
+
+        :param int position: position of the audio in the session.
+        :param bytes data: the audio.
+        :return: int bytes written to disk.
+        """
+        written = 0
+        view = memoryview(data)
+        with self._lock:
+            self.bytes_requested += len(data)
+            start = position
+            while start < position + len(data):
+                index = start // self.chunk_bytes
+                chunk_start = index * self.chunk_bytes
+                end = min(position + len(data), chunk_start + self.chunk_bytes)
+                intervals = self._written.setdefault(index, [])
+                gaps = _missing(intervals, start - chunk_start,
+                    end - chunk_start)
+                if len(gaps) > 0:
+                    path = self._path(index)
+                    with open(path, "r+b" if os.path.exists(path) else "wb") \
+                        as f:
+                        for gap_start, gap_end in gaps:
+                            f.seek(gap_start)
+                            offset = chunk_start + gap_start - position
+                            part = view[offset:offset + gap_end - gap_start]
+                            f.write(part.tobytes())
+                            written += gap_end - gap_start
+                    _add(intervals, start - chunk_start, end - chunk_start)
+                start = end
+            self.bytes_written += written
+        return written
+
+    def forget(self, position):
+        """
+        Forget which parts are written of the chunks wholly before a
+        position, once no recording can write there any more, such as audio
+        that has left the back buffer. Writing there again is only slower.
+
+        :param int position: position in the session.
+        :return: None
+        """
+        with self._lock:
+            for index in list(self._written):
+                if (index + 1) * self.chunk_bytes <= position:
+                    del self._written[index]
+
+    def prune(self):
+        """
+        Delete the chunks of sessions, other than the current one, that no
+        manifest in `dir` refers to.
+
+        :return: int number of sessions deleted.
+        """
+        chunk_dir = os.path.join(self.dir, CHUNK_DIR)
+        if not os.path.isdir(chunk_dir):
+            return 0
+
+        referenced = set()
+        for name in os.listdir(self.dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.dir, name), "r") as f:
+                    manifest = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            if isinstance(manifest, dict) and "session" in manifest:
+                referenced.add(manifest["session"])
+
+        pruned = 0
+        for session in os.listdir(chunk_dir):
+            if session == self.session or session in referenced:
+                continue
+            shutil.rmtree(os.path.join(chunk_dir, session), ignore_errors=True)
+            pruned += 1
+        if pruned > 0:
+            Log.info(self._tag, "Deleted the chunks of %d sessions no "
+                "recording refers to" % pruned)
+        return pruned
+
+    def ranges(self, start, end, relative_to):
+        """
+        Retrieves the chunk ranges holding some audio.
+
+        :param int start: position of the audio in the session.
+        :param int end: position of the end of the audio.
+        :param String relative_to: directory to give the chunk paths from.
+        :return: list of dicts of the `file`, the `offset` into it and the
+                                number of `bytes`.
+        """
+        ranges = []
+        while start < end:
+            index = start // self.chunk_bytes
+            chunk_end = min(end, (index + 1) * self.chunk_bytes)
+            ranges.append({
+                "file": os.path.relpath(self._path(index), relative_to),
+                "offset": start - index * self.chunk_bytes,
+                "bytes": chunk_end - start})
+            start = chunk_end
+        return ranges
+
+    def _path(self, index):
+        """Retrieves the path of a chunk of the current session"""
+        return os.path.join(self.dir, CHUNK_DIR, self.session,
+            "%06d.pcm" % index)
+
+def _missing(intervals, start, end):
+    """
+    Retrieves the parts of a range not covered by some sorted, disjoint
+    intervals.
+
+    :param list intervals: list of [start, end) lists.
+    :param int start: start of the range.
+    :param int end: end of the range.
+    :return: list of (start, end) tuples.
+    """
+    gaps = []
+    for interval_start, interval_end in intervals:
+        if interval_end <= start:
+            continue
+        if interval_start >= end:
+            break
+        if interval_start > start:
+            gaps.append((start, interval_start))
+        start = max(start, interval_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+def _add(intervals, start, end):
+    """
+    Add a range to some sorted, disjoint intervals, merging any it touches.
+
+    :param list intervals: list of [start, end) lists, changed in place.
+    :param int start: start of the range.
+    :param int end: end of the range.
+    :return: None
+    """
+    merged = [start, end]
+    kept = []
+    for interval in intervals:
+        if interval[1] < merged[0] or interval[0] > merged[1]:
+            kept.append(interval)
+        else:
+            merged = [min(merged[0], interval[0]), max(merged[1], interval[1])]
+    kept.append(merged)
+    kept.sort()
+    intervals[:] = kept
+
+def export(manifest_path, wav_path=None):
+    """
+    Assemble a recording stored as chunks into a WAV file, with its cue points.
+
+    :param String manifest_path: the recording's manifest.
+    :param String wav_path: file to write, the manifest's name with `.wav` if
+                                not given.
+    :return: String path of the WAV file.
+    """
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if "chunks" not in manifest:
+        raise ValueError("%s is not a chunked recording" % manifest_path)
+    if wav_path is None:
+        wav_path = os.path.splitext(manifest_path)[0] + ".wav"
+
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    wav = wave.open(wav_path, "w")
+    wav.setnchannels(manifest["channels"])
+    wav.setframerate(manifest["sample_rate"])
+    wav.setsampwidth(manifest["bytes_per_sample"])
+    for chunk in manifest["chunks"]:
+        with open(os.path.join(directory, chunk["file"]), "rb") as f:
+            f.seek(chunk["offset"])
+            data = f.read(chunk["bytes"])
+        if len(data) < chunk["bytes"]:
+            Log.warning("chunk_store", "%s is missing %d bytes" %
+                (chunk["file"], chunk["bytes"] - len(data)))
+            data += b"\x00" * (chunk["bytes"] - len(data))
+        wav.writeframesraw(data)
+    wav.close()
+
+    bytes_per_frame = manifest["channels"] * manifest["bytes_per_sample"]
+    write_cue_chunks(wav_path, [(cue["frame"] * bytes_per_frame, cue["label"])
+        for cue in manifest["cues"]], bytes_per_frame)
+    return wav_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export recordings stored as chunks to WAV files.")
+    parser.add_argument("manifests",
+        help="Manifests of chunked recordings, e.g. recording-1500000000.json",
+        nargs="+")
+    parser.add_argument("--output", "-o",
+        help="Directory to write the WAV files to. Default is alongside each manifest.",
+        default=None)
+    args = parser.parse_args()
+
+    for manifest_path in args.manifests:
+        wav_path = None
+        if args.output is not None:
+            wav_path = os.path.join(args.output, os.path.splitext(
+                os.path.basename(manifest_path))[0] + ".wav")
+        print(export(manifest_path, wav_path))
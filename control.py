@@ -0,0 +1,99 @@
+import os, sys, stat
+import threading
+
+from log import Log
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+CONTROL_SOCKET = "/tmp/cvr-control"
+
+class ControlServer(object):
+    _tag = "control"
+
+    """
+    Local control socket for asking a running CVR for recordings of events
+    that weren't hotwords, such as a button press or another sensor. Each
+    connection sends commands one per line, and each gets a one line reply
+    starting with `ok` or `error`:
+
+        retrieve START [END [AFTER]]
+
+    records from START seconds ago to END seconds ago (default now), then on
+    for AFTER seconds (default 0), replying with the recording's file name,
+    or the name of each device's recording when listening on several.
+
+    :param AudioHandler audio_handler: the handler (or `DeviceGroup`) to
+                                retrieve audio from.
+    :param String path: path of the Unix socket to listen on.
+    """
+    def __init__(self, audio_handler, path=CONTROL_SOCKET):
+        self.audio_handler = audio_handler
+        self.path = path
+
+        # only replace a socket left behind, never some other file
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise ValueError("%s exists and isn't a socket" % path)
+            os.remove(path)
+
+        control = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    reply = control.command(line.decode("ascii", "replace"))
+                    self.wfile.write((reply + "\n").encode("ascii"))
+
+        # retrievals write audio to disk, so only this user may ask for them,
+        # and nobody else can connect before the socket starts listening
+        self._server = socketserver.ThreadingUnixStreamServer(path, Handler,
+            bind_and_activate=False)
+        self._server.server_bind()
+        os.chmod(path, 0o600)
+        self._server.server_activate()
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="control")
+        self._thread.daemon = True
+        self._thread.start()
+
+        Log.info(self._tag, "Listening for commands on %s" % path)
+
+    def command(self, line):
+        """
+        Run a command.
+
+        :param String line: the command and its arguments.
+        :return: String reply.
+        """
+        words = line.split()
+        if len(words) == 0:
+            return "error no command"
+
+        try:
+            if words[0] == "retrieve" and 2 <= len(words) <= 4:
+                times = [float(word) for word in words[1:]]
+                return "ok %s" % " ".join(handler.retrieve(*times).filename
+                    for handler in self.audio_handler.handlers)
+        except (ValueError, RuntimeError) as e:
+            Log.warning(self._tag, "%s failed: %s" % (line.strip(), e))
+            return "error %s" % e
+
+        return "error unknown command %s" % line.strip()
+
+    def terminate(self):
+        """
+        Stop listening and remove the socket.
+
+        :return: None
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        Log.debug(self._tag, "ControlServer terminated")
@@ -2,6 +2,18 @@ import os, sys, argparse
 
 from log import Log
 from detector import Detector
+from profiler import Profiler
+from memory import MemoryReport
+from control import CONTROL_SOCKET
+from events import EVENT_LOG, EVENT_LOG_SIZE
+from upload import UPLOAD_QUEUE_SIZE
+from channels import CHANNEL_MODES
+from devices import load_devices
+from agc import AGC_TARGET, AGC_RECORDINGS
+from recovery import RECOVERY_THREADS
+from tap import TAP_SOCKET
+from calibrate import Calibrator, CALIBRATION_FILE, load_calibration, \
+    save_calibration
 
 def writeable_dir(prospective_dir):
     """
@@ -73,6 +85,154 @@ if __name__ == "__main__":
         help="Don't continue recording on repeat of hotword.",
         dest='continue_recording',
         action='store_false')
+    parser.add_argument("--frames-per-buffer",
+        help="Frames of audio delivered per callback. Default is from the calibration file, or 2048.",
+        dest='frames_per_buffer',
+        default=None,
+        type=int)
+    parser.add_argument("--sleep-time",
+        help="Seconds to wait when there is no audio to detect on. Default is from the calibration file, or 0.03.",
+        dest='sleep_time',
+        default=None,
+        type=float)
+    parser.add_argument("--wakeup-interval",
+        help="Seconds to wait after running detection. Default is from the calibration file, or 1.",
+        dest='wakeup_interval',
+        default=None,
+        type=float)
+    parser.add_argument("--calibrate",
+        help="Measure buffer sizes and detection timings on this device, save the best to the calibration file and exit.",
+        action='store_true')
+    parser.add_argument("--calibrate-for",
+        help="Seconds to measure each configuration for when calibrating. Default is 10.",
+        dest='calibrate_for',
+        default=10,
+        type=float)
+    parser.add_argument("--calibration-file",
+        help="File to load and save calibrated settings. Default is calibration.json alongside cvr.py.",
+        dest='calibration_file',
+        default=CALIBRATION_FILE)
+    parser.add_argument("--shared-preroll",
+        help="Read audio from the shared pre-roll segment kept by capture.py, so the pre-roll survives restarts.",
+        dest='shared_preroll',
+        default=None)
+    parser.add_argument("--profile",
+        help="Profile from start up. Profiling can also be started with SIGUSR1 and stopped with SIGUSR2, the profile is written to the output directory.",
+        action='store_true')
+    parser.add_argument("--trace-memory",
+        help="Trace memory allocations so the report logged on SIGHUP includes the top allocation sites.",
+        dest='trace_memory',
+        action='store_true')
+    parser.add_argument("--post-process",
+        help="Number of low priority threads to trim leading silence, normalise loudness and summarise peaks of finished recordings with (requires numpy). Default is 0, off.",
+        dest='post_process',
+        default=0,
+        type=int)
+    parser.add_argument("--writer-threads",
+        help="Number of threads writing recordings, however many overlap. Default is 2.",
+        dest='writer_threads',
+        default=2,
+        type=int)
+    parser.add_argument("--verify",
+        help="Verify each trigger with a second, stricter detector before recording, discarding false triggers.",
+        action='store_true')
+    parser.add_argument("--verify-model",
+        help="PMDL file to verify triggers with. Default is the detection model.",
+        dest='verify_model',
+        default=None)
+    parser.add_argument("--verify-sensitivity",
+        help="Sensitivity of the verifying detector. Default is 0.1 below --sensitivity.",
+        dest='verify_sensitivity',
+        default=None,
+        type=float)
+    parser.add_argument("--control-socket",
+        help="Unix socket to accept commands on, such as `retrieve 30 0 10` to record from 30 seconds ago until 10 seconds from now. Default is %s when given without a path." % CONTROL_SOCKET,
+        nargs="?",
+        const=CONTROL_SOCKET,
+        default=None)
+    parser.add_argument("--event-log",
+        help="Record every detection result and trigger in a binary log in the output directory, summarised with `python events.py`.",
+        dest='event_log',
+        action='store_true')
+    parser.add_argument("--event-log-size",
+        help="Bytes per event log file before it is rotated. Default is %d." % EVENT_LOG_SIZE,
+        dest='event_log_size',
+        default=EVENT_LOG_SIZE,
+        type=int)
+    parser.add_argument("--upload-url",
+        help="Upload finished recordings and an index of them to a collector at this URL, e.g. http://collector:8080/cvr.",
+        dest='upload_url',
+        default=None)
+    parser.add_argument("--upload-queue",
+        help="Directory to queue uploads in until they succeed. Default is .upload-queue in the output directory.",
+        dest='upload_queue',
+        default=None)
+    parser.add_argument("--upload-queue-size",
+        help="Most recordings to queue for upload, the oldest are dropped beyond this. Default is %d." % UPLOAD_QUEUE_SIZE,
+        dest='upload_queue_size',
+        default=UPLOAD_QUEUE_SIZE,
+        type=int)
+    parser.add_argument("--channels",
+        help="Number of channels to capture from a microphone array and keep in recordings. Default is as many as the model takes.",
+        default=None,
+        type=int)
+    parser.add_argument("--channel-mode",
+        help="How to reduce the channels to one for detection: the `best` channel by SNR, or a delay-and-sum `mix`. Default is best.",
+        dest='channel_mode',
+        choices=CHANNEL_MODES,
+        default="best")
+    parser.add_argument("--segment-seconds",
+        help="Split recordings into files of this many seconds, listed in order in a <name>.json manifest that is updated as each file is finished.",
+        dest='segment_seconds',
+        default=None,
+        type=float)
+    parser.add_argument("--segment-bytes",
+        help="Split recordings into files of at most this many bytes of audio, as with --segment-seconds.",
+        dest='segment_bytes',
+        default=None,
+        type=int)
+    parser.add_argument("--devices",
+        help="JSON file listing input devices to listen on in this process, each with its own buffers and output directory (a directory per device in --output by default).",
+        default=None)
+    parser.add_argument("--agc",
+        help="Control the gain automatically, with a limiter, instead of multiplying by --gain (requires numpy).",
+        action='store_true')
+    parser.add_argument("--agc-target",
+        help="Level in dBFS automatic gain control brings audio to. Default is %.0f." % AGC_TARGET,
+        dest='agc_target',
+        default=AGC_TARGET,
+        type=float)
+    parser.add_argument("--agc-recordings",
+        help="Record the `raw` audio and only detect on the gain controlled audio, or record the `normalized` audio too. Default is raw.",
+        dest='agc_recordings',
+        choices=AGC_RECORDINGS,
+        default="raw")
+    parser.add_argument("--chunk-seconds",
+        help="Store captured audio once, in chunk files of this many seconds shared by overlapping recordings, each recording being a <name>.json manifest of chunks that `python chunks.py` exports to WAV.",
+        dest='chunk_seconds',
+        default=None,
+        type=float)
+    parser.add_argument("--recovery-threads",
+        help="Number of background threads repairing recordings left unfinished by a power cut, found at start up. Default is %d, 0 to not repair them." % RECOVERY_THREADS,
+        dest='recovery_threads',
+        default=RECOVERY_THREADS,
+        type=int)
+    parser.add_argument("--encrypt-key",
+        help="Encrypt recordings with AES-GCM as they are written, to <name>.wav.enc, with the key in this file. Create a key with `python encryption.py keygen <file>` and decrypt recordings with `python encryption.py decrypt`.",
+        dest='encrypt_key',
+        default=None)
+    parser.add_argument("--no-backpressure",
+        help="Don't shed post-processing, then uploads when the writers fall behind, e.g. when the SD card stalls.",
+        dest='backpressure',
+        action='store_false')
+    parser.add_argument("--backpressure-pcm8",
+        help="When shedding post-processing and uploads isn't enough, write new recordings with 8 bit samples until the writers catch up.",
+        dest='backpressure_pcm8',
+        action='store_true')
+    parser.add_argument("--tap",
+        help="Stream triggered audio live, from a couple of seconds before the hotword, to subscribers of this Unix socket (e.g. %s) or [host:]port on localhost. `python tap.py <socket>` subscribes." % TAP_SOCKET,
+        dest='tap',
+        default=None)
     args = parser.parse_args()
 
     Log.init(getattr(Log,args.log))
@@ -86,6 +246,37 @@ if __name__ == "__main__":
         sensitivity=args.sensitivity
 
     Log.debug("__main__", "Sensitivity set to %f" % sensitivity)
+
+    verify_model = None
+    verify_sensitivity = []
+    if args.verify or args.verify_model is not None:
+        verify_model = args.verify_model or args.model
+        if args.verify_sensitivity is None:
+            verify_sensitivity = max(0, sensitivity - 0.1)
+        else:
+            verify_sensitivity = min(1, max(0, args.verify_sensitivity))
+        Log.debug("__main__", "Verifying triggers with %s at sensitivity %f" % (verify_model, verify_sensitivity))
+
+    if args.trace_memory:
+        MemoryReport.start_tracing()
+
+    if args.calibrate:
+        calibrator = Calibrator(decoder_model=args.model,
+            audio_gain=args.gain,
+            duration=args.calibrate_for)
+        save_calibration(calibrator.run(), args.calibration_file)
+        sys.exit(0)
+
+    calibration = load_calibration(args.calibration_file)
+    for key in calibration:
+        if getattr(args, key) is None:
+            setattr(args, key, calibration[key])
+    Log.debug("__main__", "Using %d frames per buffer, %.2fs sleep time and %.2fs wakeup interval" % (args.frames_per_buffer, args.sleep_time, args.wakeup_interval))
+
+    devices = None
+    if args.devices is not None:
+        devices = load_devices(args.devices, args.output)
+
     detector = Detector(decoder_model=args.model,
         sensitivity=sensitivity,
         audio_gain=args.gain,
@@ -95,12 +286,43 @@ if __name__ == "__main__":
         continue_recording=args.continue_recording,
         output_dir=args.output,
         delete_active_recording=args.delete_active_recording,
-        on_beep_audio_file=args.audio_beep)
+        on_beep_audio_file=args.audio_beep,
+        frames_per_buffer=args.frames_per_buffer,
+        shared_preroll=args.shared_preroll,
+        post_process_workers=args.post_process,
+        writer_threads=args.writer_threads,
+        verify_model=verify_model,
+        verify_sensitivity=verify_sensitivity,
+        control_socket=args.control_socket,
+        event_log=os.path.join(args.output, EVENT_LOG) if args.event_log else None,
+        event_log_size=args.event_log_size,
+        upload_url=args.upload_url,
+        upload_queue=args.upload_queue,
+        upload_queue_size=args.upload_queue_size,
+        channels=args.channels,
+        channel_mode=args.channel_mode,
+        segment_seconds=args.segment_seconds,
+        segment_bytes=args.segment_bytes,
+        devices=devices,
+        agc=args.agc,
+        agc_target=args.agc_target,
+        agc_recordings=args.agc_recordings,
+        chunk_seconds=args.chunk_seconds,
+        recovery_threads=args.recovery_threads,
+        encrypt_key=args.encrypt_key,
+        backpressure=args.backpressure,
+        backpressure_pcm8=args.backpressure_pcm8,
+        tap=args.tap)
+
+    if args.profile:
+        Profiler.start(args.output)
 
     Log.debug("__main__", "Will record %d seconds before and %d seconds after hotword" % (args.before, args.after))
     detector.wait_on_button(button_pin=27,
         record_before=args.before,
         record_after=args.after,
+        sleep_time=args.sleep_time,
+        wakeup_interval=args.wakeup_interval,
         start_enabled=True)
 
     Log.info("__main__", "Goodbye, Cruel World!")
@@ -1,11 +1,26 @@
 import os, sys, signal, argparse, time
 import threading
-import RPi.GPIO as GPIO
 
-from led import LED
+from gpio import GPIO
+from led import LED, LEDWorker
 from log import Log
-from audio import AudioHandler
+from profiler import Profiler
+from memory import MemoryReport
+from audio import AudioHandler, FRAMES_PER_BUFFER, SLEEP_TIME, \
+    WAKEUP_INTERVAL
 from beep import BeepHandler
+from postprocess import PostProcessor
+from writer import WRITER_THREADS
+from verify import Verifier
+from control import ControlServer
+from events import EventLog, EVENT_LOG_SIZE
+from upload import Uploader, UPLOAD_QUEUE_SIZE
+from devices import DeviceGroup
+from agc import AGC_TARGET
+from recovery import Recovery, RECOVERY_THREADS
+from encryption import Encryption, load_key
+from backpressure import Backpressure
+from tap import Tap
 
 class Detector(object):
     _tag = "detector"
@@ -30,6 +45,60 @@ class Detector(object):
                                 interrupted
     :param str on_beep_audio_file: Path to valid audio file to play when 
                                 recording starts
+    :param int frames_per_buffer: frames PortAudio delivers per callback.
+    :param str shared_preroll: path of a shared pre-roll segment filled by
+                                `capture.py` to read audio from.
+    :param int post_process_workers: number of threads to trim, normalise and
+                                summarise finished recordings with, 0 to not
+                                post-process.
+    :param int writer_threads: number of threads writing recordings.
+    :param verify_model: model file path(s) to verify triggers with before 
+                                recording, None to not verify.
+    :param verify_sensitivity: sensitivity to verify triggers with, usually
+                                lower (stricter) than `sensitivity`.
+    :param str control_socket: path of a Unix socket to accept retrieval 
+                                commands on, None to not listen.
+    :param str event_log: path of a binary log to record detection results
+                                and triggers in, None to not record them.
+    :param int event_log_size: bytes per event log file before rotating.
+    :param str upload_url: base URL of a collector to upload finished 
+                                recordings to, None to not upload.
+    :param str upload_queue: directory to queue uploads in, `.upload-queue` 
+                                in the output directory if not given.
+    :param int upload_queue_size: most recordings waiting to be uploaded.
+    :param int channels: number of channels to capture and record, None for
+                                as many as the model takes.
+    :param str channel_mode: how to reduce the channels for detection, `best`
+                                or `mix`.
+    :param float segment_seconds: split recordings into files of this many
+                                seconds, None to not split by time.
+    :param int segment_bytes: split recordings into files of this many bytes,
+                                None to not split by size.
+    :param list devices: settings of each input device to listen on, from
+                                `load_devices`, None to listen on the default
+                                device only.
+    :param bool agc: control the gain automatically instead of by `audio_gain`.
+    :param float agc_target: level to bring audio to, in dBFS.
+    :param str agc_recordings: `raw` to record the audio as captured, or
+                                `normalized` to record it with the gain
+                                controlled.
+    :param float chunk_seconds: store audio once in chunks of this many
+                                seconds shared by overlapping recordings, None
+                                to write each recording as WAV files.
+    :param int recovery_threads: number of threads to repair recordings left
+                                unfinished by a power cut with, in the
+                                background, 0 to not repair them.
+    :param str encrypt_key: path of a key to encrypt recordings with as they
+                                are written, None to not encrypt them. Can't
+                                be combined with post-processing, chunks or
+                                a tap, which would leave audio unencrypted.
+    :param bool backpressure: shed post-processing, then uploads in tiers
+                                when the writers fall behind.
+    :param bool backpressure_pcm8: as a last tier of `backpressure`, write new
+                                recordings with 8 bit samples.
+    :param str tap: Unix socket path or `[host:]port` to stream triggered
+                                audio to subscribers on as it is captured,
+                                None for no live tap.
     """
     def __init__(self,
         decoder_model,
@@ -41,7 +110,41 @@ class Detector(object):
         continue_recording=False,
         output_dir=".",
         delete_active_recording=False,
-        on_beep_audio_file=None):
+        on_beep_audio_file=None,
+        frames_per_buffer=FRAMES_PER_BUFFER,
+        shared_preroll=None,
+        post_process_workers=0,
+        writer_threads=WRITER_THREADS,
+        verify_model=None,
+        verify_sensitivity=[],
+        control_socket=None,
+        event_log=None,
+        event_log_size=EVENT_LOG_SIZE,
+        upload_url=None,
+        upload_queue=None,
+        upload_queue_size=UPLOAD_QUEUE_SIZE,
+        channels=None,
+        channel_mode="best",
+        segment_seconds=None,
+        segment_bytes=None,
+        devices=None,
+        agc=False,
+        agc_target=AGC_TARGET,
+        agc_recordings="raw",
+        chunk_seconds=None,
+        recovery_threads=RECOVERY_THREADS,
+        encrypt_key=None,
+        backpressure=True,
+        backpressure_pcm8=False,
+        tap=None):
+
+        if devices is not None and shared_preroll is not None:
+            raise ValueError("A shared pre-roll can't be used with several "
+                "devices")
+        if encrypt_key is not None and (post_process_workers > 0 or
+            chunk_seconds is not None or tap is not None):
+            raise ValueError("Encrypted recordings can't be post-processed, "
+                "stored as chunks or tapped")
 
         self._is_running = False
         self._is_interrupted = False
@@ -53,19 +156,118 @@ class Detector(object):
         self._led_listening = LED(led_listening_pin, 0)
         self._led_recording = LED(led_recording_pin, 0)
 
-        self._ready=False
-        self._startup_anim_thread = threading.Thread(
-            target=self._starting_up)
-        self._startup_anim_thread.daemon = False
-        self._startup_anim_thread.start()
+        self._leds = LEDWorker()
+        self._starting_up()
 
-        self.audio_handler = AudioHandler(
-            decoder_model=decoder_model,
-            sensitivity=sensitivity,
-            audio_gain=audio_gain,
-            output_dir=output_dir,
-            continue_recording=continue_recording,
-            delete_active_recording=delete_active_recording)
+        if recovery_threads > 0:
+            self.recovery = Recovery(
+                dirs=[output_dir] if devices is None else
+                    [device["output"] for device in devices],
+                workers=recovery_threads)
+        else:
+            self.recovery = None
+
+        if encrypt_key is None:
+            encryption = None
+        else:
+            encryption = Encryption(load_key(encrypt_key))
+
+        if tap is None:
+            self.tap = None
+        else:
+            self.tap = Tap(address=tap)
+
+        if post_process_workers > 0:
+            self.post_processor = PostProcessor(workers=post_process_workers)
+        else:
+            self.post_processor = None
+
+        if verify_model is not None:
+            # normalized recordings are verified on audio already controlled
+            verifier = Verifier(
+                decoder_model=verify_model,
+                sensitivity=verify_sensitivity,
+                audio_gain=1 if agc else audio_gain,
+                agc=agc and agc_recordings == "raw",
+                agc_target=agc_target)
+        else:
+            verifier = None
+
+        if event_log is None or devices is not None:
+            self.event_log = None
+        else:
+            self.event_log = EventLog(path=event_log, size=event_log_size)
+
+        if upload_url is None:
+            self.uploader = None
+        else:
+            self.uploader = Uploader(
+                url=upload_url,
+                queue_dir=upload_queue or os.path.join(output_dir,
+                    ".upload-queue"),
+                queue_size=upload_queue_size)
+
+        if devices is not None:
+            # each device keeps an event log in its own output directory
+            self.audio_handler = DeviceGroup(
+                devices=devices,
+                decoder_model=decoder_model,
+                sensitivity=sensitivity,
+                audio_gain=audio_gain,
+                continue_recording=continue_recording,
+                delete_active_recording=delete_active_recording,
+                frames_per_buffer=frames_per_buffer,
+                post_processor=self.post_processor,
+                writer_threads=writer_threads,
+                verifier=verifier,
+                event_log=None if event_log is None else
+                    os.path.basename(event_log),
+                event_log_size=event_log_size,
+                uploader=self.uploader,
+                channels=channels,
+                channel_mode=channel_mode,
+                segment_seconds=segment_seconds,
+                segment_bytes=segment_bytes,
+                agc=agc,
+                agc_target=agc_target,
+                agc_recordings=agc_recordings,
+                chunk_seconds=chunk_seconds,
+                encryption=encryption,
+                tap=self.tap)
+        else:
+            self.audio_handler = AudioHandler(
+                decoder_model=decoder_model,
+                sensitivity=sensitivity,
+                audio_gain=audio_gain,
+                output_dir=output_dir,
+                continue_recording=continue_recording,
+                delete_active_recording=delete_active_recording,
+                frames_per_buffer=frames_per_buffer,
+                shared_preroll=shared_preroll,
+                post_processor=self.post_processor,
+                writer_threads=writer_threads,
+                verifier=verifier,
+                event_log=self.event_log,
+                uploader=self.uploader,
+                channels=channels,
+                channel_mode=channel_mode,
+                segment_seconds=segment_seconds,
+                segment_bytes=segment_bytes,
+                agc=agc,
+                agc_target=agc_target,
+                agc_recordings=agc_recordings,
+                chunk_seconds=chunk_seconds,
+                encryption=encryption,
+                tap=self.tap)
+
+        if backpressure:
+            self.backpressure = Backpressure(
+                handlers=self.audio_handler.handlers,
+                post_processor=self.post_processor,
+                uploader=self.uploader,
+                cheap_encoding=backpressure_pcm8)
+        else:
+            self.backpressure = None
 
         if on_beep_audio_file is None:
             self.beep_handler = None
@@ -73,14 +275,24 @@ class Detector(object):
             self.beep_handler = BeepHandler(
                 on_beep_audio_file=on_beep_audio_file)
 
+        if control_socket is None:
+            self.control_server = None
+        else:
+            self.control_server = ControlServer(
+                audio_handler=self.audio_handler,
+                path=control_socket)
+
         signal.signal(signal.SIGINT, self.interrupt)
+        Profiler.handle_signals(output_dir)
+        signal.signal(signal.SIGHUP, self._report_memory)
         Log.debug(self._tag, "Detector created")
 
     def wait_on_button(self,
             button_pin=27,
             record_before=60,
             record_after=60,
-            sleep_time=0.03,
+            sleep_time=SLEEP_TIME,
+            wakeup_interval=WAKEUP_INTERVAL,
             start_enabled=False):
         """
         Wait for the button press to start hotword detection. Calls `start` 
@@ -95,6 +307,8 @@ class Detector(object):
                                 main loop needs to stop.
         :param float sleep_time: how much time in second every loop waits, set 
                                 to -1 for default time..
+        :param float wakeup_interval: how much time in seconds to wait after 
+                                running detection on a chunk of audio.
         :param bool start_enabled: if `true`, will simulate button press
                                 initially
         :return: None
@@ -107,6 +321,7 @@ class Detector(object):
             self._record_before = record_before
             self._record_after = record_after
             self._sleep_time = sleep_time
+            self._wakeup_interval = wakeup_interval
 
             Log.info(self._tag, "Wait for button press...")
             GPIO.add_event_detect(
@@ -115,7 +330,7 @@ class Detector(object):
                 callback=self.button_pressed,
                 bouncetime=300)
             self._ready_button_press=start_enabled
-            self._ready=True
+            self._started_up()
 
             while True:
                 if self._is_interrupted:
@@ -131,10 +346,10 @@ class Detector(object):
     def button_pressed(self, pin):
         Log.info(self._tag, "Button pressed")
 
-        if self.audio_handler.is_running and self._audio_thread.isAlive():
+        if self.audio_handler.is_running and self._audio_thread.is_alive():
             Log.info(self._tag, "Will interrupt AudioHandler")
-            self._led_recording.set(False)
-            self._led_listening.set(False)
+            self._leds.set(self._led_recording, False)
+            self._leds.set(self._led_listening, False)
             self.audio_handler.interrupt()
         else:
             self._detector_thread = threading.Thread(
@@ -143,7 +358,8 @@ class Detector(object):
                 self._record_before,
                 self._record_after,
                 self._sleep_time,
-                False))
+                False,
+                self._wakeup_interval))
             self._detector_thread.daemon = False
             self._detector_thread.start()
             Log.debug(self._tag, "New Detector Thread created")
@@ -152,8 +368,9 @@ class Detector(object):
     def start(self,
         record_before=60,
         record_after=60,
-        sleep_time=0.03,
-        terminate_on_stop=True):
+        sleep_time=SLEEP_TIME,
+        terminate_on_stop=True,
+        wakeup_interval=WAKEUP_INTERVAL):
         """
         Start hotwor detection. For every `sleep_time` second it checks the
         audio buffer for triggering keywords. Every loop it checks if the loop 
@@ -167,6 +384,8 @@ class Detector(object):
         :param Float sleep_time: how much time in second every loop waits.
         :param Boolean terminate_on_stop: True to terminate the detector when 
                                 hotword detection stops.
+        :param Float wakeup_interval: how much time in seconds to wait after 
+                                running detection on a chunk of audio.
         :return: None
         """
         Log.debug(self._tag, "Detector started")
@@ -177,17 +396,21 @@ class Detector(object):
             raise ValueError("Cannot record less than 0 seconds after hotword!")
         elif sleep_time < 0.0:
             raise ValueError("Cannot sleep less than 0 seconds!")
+        elif wakeup_interval < 0.0:
+            raise ValueError("Cannot wait less than 0 seconds after detection!")
 
-        self._led_listening.set(True)
+        self._leds.set(self._led_listening, True)
        
         self._audio_thread = threading.Thread(
+            name="detection",
             target=self.audio_handler.start,
             args=(record_before,
                 record_after,
                 sleep_time,
                 self._start_recording,
                 None,
-                self._stop_recording))
+                self._stop_recording,
+                wakeup_interval))
         self._audio_thread.daemon = False
         self._audio_thread.start()
         Log.debug(self._tag, "AudioHandler started")
@@ -216,16 +439,49 @@ class Detector(object):
 
         Log.debug(self._tag, "Will terminate Detector")
 
+        if self.control_server is not None:
+            Log.debug(self._tag, "Will terminate ControlServer")
+            self.control_server.terminate()
+
+        if self.tap is not None:
+            Log.debug(self._tag, "Will terminate Tap")
+            self.tap.terminate()
+
+        if self.backpressure is not None:
+            Log.debug(self._tag, "Will terminate Backpressure")
+            self.backpressure.terminate()
+
         Log.debug(self._tag, "Will terminate AudioHandler")
         self.audio_handler.terminate()
 
+        if self.event_log is not None:
+            Log.debug(self._tag, "Will close EventLog")
+            self.event_log.close()
+
         if self.beep_handler is not None:
             Log.debug(self._tag, "Will terminate BeepHandler")
             self.beep_handler.terminate()
 
+        if self.post_processor is not None:
+            Log.debug(self._tag, "Will terminate PostProcessor")
+            self.post_processor.terminate()
+
+        if self.uploader is not None:
+            Log.debug(self._tag, "Will terminate Uploader")
+            self.uploader.terminate()
+
+        if self.recovery is not None:
+            Log.debug(self._tag, "Will wait for Recovery")
+            self.recovery.wait()
+
+        if Profiler.enabled:
+            Log.debug(self._tag, "Will stop Profiler")
+            Profiler.stop()
+
         Log.debug(self._tag, "Will clean up GPIO")
-        self._led_listening.set(False)
-        self._led_recording.set(False)
+        self._leds.set(self._led_listening, False)
+        self._leds.set(self._led_recording, False)
+        self._leds.terminate()
         GPIO.cleanup();
 
     def interrupt(self, signal, frame):
@@ -237,68 +493,93 @@ class Detector(object):
         """
         Log.info(self._tag, "Interrupt triggered")
 
-        if self.audio_handler.is_running and self._audio_thread.isAlive():
+        if self.audio_handler.is_running and self._audio_thread.is_alive():
             Log.debug(self._tag, "Will interrupt AudioHandler")
             self.audio_handler.interrupt()
-            self._led_listening.set(False)
-            self._led_recording.set(False)
+            self._leds.set(self._led_listening, False)
+            self._leds.set(self._led_recording, False)
         else:
             Log.debug(self._tag, "Will interrupt Detector")
             self._is_interrupted = True
 
+    def _report_memory(self, signal, frame):
+        """
+        Log the memory held by the audio buffers and the CPU time spent on the
+        audio of each device, and the lag of the queues between them.
+
+        :return: None
+        """
+        for audio_handler in self.audio_handler.handlers:
+            MemoryReport.log(audio_handler)
+            usage = audio_handler.cpu_usage()
+            Log.info(self._tag, "%s%.1f%% CPU (callback %.2fs, detection "
+                "%.2fs)" % ("" if audio_handler.name is None else
+                audio_handler.name + ": ", usage["fraction"] * 100,
+                usage["callback"], usage["detection"]))
+        if self.backpressure is not None:
+            self.backpressure.report()
+        if self.tap is not None:
+            self.tap.report()
+
     def _starting_up(self):
         """
         Flash the LEDs while setting up.
 
         :return: None
         """
-        self._led_running.set(True)
-        self._led_listening.set(False)
-        self._led_recording.set(False)
-
-        while not self._ready:
-            self._led_running.toggle()
-            self._led_listening.toggle()
-            self._led_recording.toggle()
-            time.sleep(0.1)
-
-        self._led_running.set(True)
-        self._led_listening.set(True)
-        self._led_recording.set(False)
-
-        for i in range(0, 10):
-            self._led_running.toggle()
-            self._led_listening.toggle()
-            self._led_recording.toggle()
-            time.sleep(0.1)
-
-        self._led_running.set(True)
-        self._led_listening.set(True)
-        self._led_recording.set(True)
-        time.sleep(1)
-        self._led_running.set(True)
-        self._led_listening.set(False)
-        self._led_recording.set(False)
+        self._leds.play([
+            ({self._led_running: True, self._led_listening: False,
+                self._led_recording: False}, 0.1),
+            ({self._led_running: False, self._led_listening: True,
+                self._led_recording: True}, 0.1)],
+            repeat=None)
+
+    def _started_up(self):
+        """
+        Flash the LEDs to show setting up has finished.
 
+        :return: None
+        """
+        steps = [
+            ({self._led_running: False, self._led_listening: False,
+                self._led_recording: True}, 0.1),
+            ({self._led_running: True, self._led_listening: True,
+                self._led_recording: False}, 0.1)] * 5
+        steps.append(({self._led_running: True, self._led_listening: True,
+            self._led_recording: True}, 1))
+        steps.append(({self._led_running: True, self._led_listening: False,
+            self._led_recording: False}, 0))
+
+        self._leds.play(steps, then=self._finished_starting_up)
+
+    def _finished_starting_up(self):
+        """
+        Simulate a button press once the start up animation has finished, if
+        starting enabled.
+
+        :return: None
+        """
         if self._ready_button_press:
             self.button_pressed(self._button_pin)
 
-    def _start_recording(self):
+    def _start_recording(self, event):
         """
-        Turn the recording LED on.
+        Turn the recording LED on and beep, run off the detection thread.
 
+        :param RecordingEvent event: the recording that started.
         :return: None
         """
-        self._led_recording.set(True)
+        self._leds.set(self._led_recording, True)
         try:
             self.beep_handler.play()
         except AttributeError:
             pass
 
-    def _stop_recording(self):
+    def _stop_recording(self, event):
         """
         Turn the recording LED off.
 
+        :param RecordingEvent event: the recording that stopped.
         :return: None
         """
-        self._led_recording.set(False)
+        self._leds.set(self._led_recording, False)
@@ -0,0 +1,264 @@
+import os, sys, json, time
+import pyaudio
+
+from log import Log
+from audio import AudioHandler, FRAMES_PER_BUFFER, SLEEP_TIME, \
+    WAKEUP_INTERVAL
+from writer import WriterPool, WRITER_THREADS
+from hooks import HookDispatcher
+from events import EventLog, EVENT_LOG_SIZE
+from agc import AGC_TARGET
+
+DEVICE_SETTINGS = ["name", "device", "output", "channels", "channel_mode",
+    "sensitivity", "gain"]
+
+def load_devices(path, output_dir="."):
+    """
+    Load the devices to listen on from a config file, a JSON list of objects
+    (or an object with a `devices` list), e.g.
+
+        [{"name": "kitchen", "device": "USB", "channels": 2},
+         {"name": "lounge", "device": 3, "sensitivity": 0.4}]
+
+    `device` is a PortAudio input device index or part of its name, `output`
+    is where its recordings go (a directory named after it in `output_dir` by
+    default, created if need be), and `channels`, `channel_mode`,
+    `sensitivity` and `gain` override the command line for that device.
+
+    :param str path: the config file.
+    :param str output_dir: directory to put each device's directory in.
+    :return: list of dicts of the settings of each device.
+    """
+    with open(path, "r") as f:
+        config = json.load(f)
+    if isinstance(config, dict):
+        config = config.get("devices", [])
+    if len(config) == 0:
+        raise ValueError("No devices in %s" % path)
+
+    devices = []
+    for index, settings in enumerate(config):
+        unknown = set(settings) - set(DEVICE_SETTINGS)
+        if len(unknown) > 0:
+            raise ValueError("Unknown device settings %s in %s" %
+                (", ".join(sorted(unknown)), path))
+
+        device = dict(settings)
+        device.setdefault("name", "device-%d" % index)
+        device.setdefault("output", os.path.join(output_dir, device["name"]))
+        if not os.path.isdir(device["output"]):
+            os.makedirs(device["output"])
+        devices.append(device)
+
+    names = [device["name"] for device in devices]
+    if len(set(names)) != len(names):
+        raise ValueError("Device names in %s are not unique" % path)
+
+    Log.debug("devices", "Loaded %d devices from %s" % (len(devices), path))
+    return devices
+
+class DeviceGroup(object):
+    _tag = "device_group"
+
+    """
+    Listens on several input devices in one process, such as a USB microphone
+    in each room. Each device has an `AudioHandler` with its own buffers,
+    detector state and output directory, while they share one PortAudio
+    instance, writer pool, hook dispatcher, verifier, post-processor and
+    uploader, and detection for all of them runs on one thread. It can be used
+    wherever an `AudioHandler` is.
+
+    Snowboy keeps the state of the stream it is detecting on in the detector,
+    so each device loads the model into a `SnowboyDetect` of its own.
+
+    :param list devices: settings of each device, see `load_devices`.
+    :param decoder_model: decoder model file path; string or list of strings.
+    :param sensitivity: default decoder sensitivity.
+    :param audio_gain: default factor to multiply input volume by.
+    :param bool continue_recording: continue recording on repeated utterances
+                                of the hotword.
+    :param bool delete_active_recording: delete an active recording if
+                                interrupted.
+    :param int frames_per_buffer: frames PortAudio delivers per callback.
+    :param PostProcessor post_processor: post-processor to pass finished
+                                recordings to.
+    :param int writer_threads: number of threads writing recordings for all
+                                devices.
+    :param Verifier verifier: second stage of detection, shared by all devices.
+    :param str event_log: file name of the binary event log kept in each
+                                device's output directory, None to not log.
+    :param int event_log_size: bytes per event log file before rotating.
+    :param Uploader uploader: uploader to pass finished recordings to.
+    :param int channels: default number of channels to capture.
+    :param str channel_mode: default way to reduce channels for detection.
+    :param float segment_seconds: split recordings into files of this many
+                                seconds.
+    :param int segment_bytes: split recordings into files of this many bytes.
+    :param bool agc: control the gain of each device automatically.
+    :param float agc_target: level to bring audio to, in dBFS.
+    :param str agc_recordings: `raw` or `normalized` audio to record.
+    :param float chunk_seconds: store each device's audio in shared chunks of
+                                this many seconds, None to write WAV files.
+    :param Encryption encryption: encrypt recordings as they are written.
+    :param Tap tap: live tap to stream every device's triggered audio to.
+    """
+    def __init__(self,
+        devices,
+        decoder_model,
+        sensitivity=[],
+        audio_gain=1,
+        continue_recording=False,
+        delete_active_recording=False,
+        frames_per_buffer=FRAMES_PER_BUFFER,
+        post_processor=None,
+        writer_threads=WRITER_THREADS,
+        verifier=None,
+        event_log=None,
+        event_log_size=EVENT_LOG_SIZE,
+        uploader=None,
+        channels=None,
+        channel_mode="best",
+        segment_seconds=None,
+        segment_bytes=None,
+        agc=False,
+        agc_target=AGC_TARGET,
+        agc_recordings="raw",
+        chunk_seconds=None,
+        encryption=None,
+        tap=None):
+        self.is_interrupted = False
+        self.is_terminated = False
+
+        self.audio = pyaudio.PyAudio()
+        self.writer_pool = WriterPool(workers=writer_threads)
+        self.hooks = HookDispatcher()
+        self.event_logs = []
+
+        self.handlers = []
+        for device in devices:
+            if event_log is None:
+                device_event_log = None
+            else:
+                device_event_log = EventLog(
+                    path=os.path.join(device["output"], event_log),
+                    size=event_log_size)
+                self.event_logs.append(device_event_log)
+
+            self.handlers.append(AudioHandler(
+                decoder_model=decoder_model,
+                sensitivity=device.get("sensitivity", sensitivity),
+                audio_gain=device.get("gain", audio_gain),
+                output_dir=device["output"],
+                continue_recording=continue_recording,
+                delete_active_recording=delete_active_recording,
+                frames_per_buffer=frames_per_buffer,
+                post_processor=post_processor,
+                verifier=verifier,
+                event_log=device_event_log,
+                uploader=uploader,
+                channels=device.get("channels", channels),
+                channel_mode=device.get("channel_mode", channel_mode),
+                segment_seconds=segment_seconds,
+                segment_bytes=segment_bytes,
+                name=device["name"],
+                device=device.get("device"),
+                audio=self.audio,
+                writer_pool=self.writer_pool,
+                hooks=self.hooks,
+                agc=agc,
+                agc_target=agc_target,
+                agc_recordings=agc_recordings,
+                chunk_seconds=chunk_seconds,
+                encryption=encryption,
+                tap=tap))
+
+        Log.debug(self._tag, "DeviceGroup created (%s)" %
+            ", ".join(handler.name for handler in self.handlers))
+
+    @property
+    def is_running(self):
+        """Whether any device is detecting"""
+        return any(handler.is_running for handler in self.handlers)
+
+    def start(self,
+        record_before,
+        record_after,
+        sleep_time=SLEEP_TIME,
+        start_recording_callback=None,
+        continue_recording_callback=None,
+        stop_recording_callback=None,
+        wakeup_interval=WAKEUP_INTERVAL):
+        """
+        Start hotword detection on every device, on this thread, until
+        interrupted. Takes the same arguments as `AudioHandler.start`; each
+        device waits `wakeup_interval` after detection on it, and the loop
+        sleeps `sleep_time` between passes over the devices.
+
+        :return: None
+        """
+        self.is_interrupted = False
+
+        # the hooks are shared, so the callbacks only need registering once
+        for index, handler in enumerate(self.handlers):
+            if index == 0:
+                handler.listen(record_before, record_after,
+                    start_recording_callback, continue_recording_callback,
+                    stop_recording_callback, wakeup_interval)
+            else:
+                handler.listen(record_before, record_after,
+                    wakeup_interval=wakeup_interval)
+
+        Log.info(self._tag, "Started listening for hotword on %d devices..." %
+            len(self.handlers))
+
+        next_detection = [0] * len(self.handlers)
+        while not self.is_interrupted and not self.is_terminated:
+            for index, handler in enumerate(self.handlers):
+                if handler.is_interrupted or time.time() < next_detection[index]:
+                    continue
+                if handler.detect():
+                    next_detection[index] = time.time() + wakeup_interval
+            time.sleep(sleep_time)
+
+        Log.info(self._tag, "Stopped listening for hotword")
+        self.stop()
+
+    def interrupt(self):
+        """
+        Interrupt detection on every device.
+
+        :return: None
+        """
+        self.is_interrupted = True
+        for handler in self.handlers:
+            handler.interrupt()
+
+    def stop(self):
+        """
+        Stop detection on every device.
+
+        :return: None
+        """
+        self.is_interrupted = True
+        for handler in self.handlers:
+            handler.stop()
+
+    def terminate(self):
+        """
+        Terminate every device, then what they share. Cannot be recovered from.
+
+        :return: None
+        """
+        if self.is_terminated:
+            return
+        self.is_terminated = True
+
+        for handler in self.handlers:
+            handler.terminate()
+
+        self.writer_pool.terminate()
+        self.hooks.terminate()
+        self.audio.terminate()
+        for event_log in self.event_logs:
+            event_log.close()
+        Log.debug(self._tag, "DeviceGroup terminated")
@@ -0,0 +1,330 @@
+import os, sys, argparse, json, struct, hashlib, binascii, wave
+
+from log import Log
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    AESGCM = None
+
+ENCRYPTED_SUFFIX = ".enc"
+
+AUDIO = 0
+END = 1
+
+# bytes AES-GCM adds to each record
+TAG_SIZE = 16
+
+def generate_key(path):
+    """
+    Generate a random 256 bit key and save it, readable only by its owner.
+
+    :param String path: file to save the key to, as hex.
+    :return: None
+    """
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(descriptor, "w") as f:
+        f.write(binascii.hexlify(os.urandom(32)).decode("ascii") + "\n")
+
+def load_key(path):
+    """
+    Load a key saved by `generate_key`, or 32 raw bytes.
+
+    :param String path: the key file.
+    :return: bytes of the key.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) == 32:
+        return data
+    try:
+        key = binascii.unhexlify(data.strip())
+    except (TypeError, ValueError):
+        key = b""
+    if len(key) != 32:
+        raise ValueError("%s is not a 256 bit key" % path)
+    return key
+
+class Encryption(object):
+    _tag = "encryption"
+
+    """
+    Encrypts recordings with AES-GCM as they are written, so audio never
+    reaches the disk unencrypted and no second pass over the files is needed.
+    Encryption happens in `InstanceRecorder.write_pending`, on the writer
+    pool's threads, so it doesn't slow the audio callback down.
+
+    An encrypted recording `name.wav.enc` starts with a header of the audio
+    format, an ID of the key and a random nonce prefix for the file, followed
+    by records of up to `block_size` bytes of audio, each with its own nonce
+    and tag and authenticated with the header, its kind and its index, so
+    records can't be reordered or swapped between files. When the file is
+    closed a last record holds the number of frames and the cue points, in
+    place of the WAV header; a file cut short by a power cut still decrypts up
+    to its last whole record. `decrypt` turns the file back into a WAV file.
+
+    Needs the `cryptography` package.
+
+    :param bytes key: 256 bit key, see `load_key`.
+    :param int block_size: most bytes of audio to encrypt per record.
+    """
+    HEADER = struct.Struct("<4sHHIH8s8s")
+    MAGIC = b"CVRC"
+    VERSION = 1
+
+    # kind, length of the encrypted record
+    RECORD = struct.Struct("<BI")
+
+    def __init__(self, key, block_size=65536):
+        if AESGCM is None:
+            raise ImportError("cryptography is needed to encrypt recordings")
+        self.key_id = key_id(key)
+        self._aead = AESGCM(key)
+        self._block_size = block_size
+        Log.debug(self._tag, "Encryption created (key %s)" %
+            binascii.hexlify(self.key_id).decode("ascii"))
+
+    def open(self, path):
+        """
+        Open an encrypted file to write a recording to.
+
+        :param String path: the file, usually ending `.wav.enc`.
+        :return: EncryptedWaveWriter, used like a `wave.Wave_write`.
+        """
+        return EncryptedWaveWriter(path, self._aead, self.key_id,
+            self._block_size)
+
+def key_id(key):
+    """Retrieves the ID of a key stored in the files it encrypts"""
+    return hashlib.sha256(b"cvr-key-id" + key).digest()[:8]
+
+def _nonce(prefix, index):
+    """Retrieves the nonce of a record"""
+    return prefix + struct.pack("<I", index)
+
+def _associated_data(header, kind, index):
+    """Retrieves the data each record is authenticated with"""
+    return header + struct.pack("<BI", kind, index)
+
+class EncryptedWaveWriter(object):
+    _tag = "encryption"
+
+    """
+    Writes audio to an encrypted file, with the methods of `wave.Wave_write`
+    that `InstanceRecorder` uses. Create with `Encryption.open`.
+    """
+    def __init__(self, path, aead, key_id, block_size):
+        self._file = open(path, "wb")
+        self._aead = aead
+        self._key_id = key_id
+        self._block_size = block_size
+        self._channels = 1
+        self._sample_rate = 16000
+        self._sample_width = 2
+        self._header = None
+        self._index = 0
+        self._frames = 0
+
+    def setnchannels(self, channels):
+        self._channels = channels
+
+    def setframerate(self, sample_rate):
+        self._sample_rate = sample_rate
+
+    def setsampwidth(self, sample_width):
+        self._sample_width = sample_width
+
+    def writeframes(self, data):
+        """Encrypt and write some audio"""
+        if self._header is None:
+            self._write_header()
+        view = memoryview(data)
+        for start in range(0, len(view), self._block_size):
+            self._write_record(AUDIO,
+                view[start:start + self._block_size].tobytes())
+        self._frames += len(data) // (self._channels * self._sample_width)
+
+    writeframesraw = writeframes
+
+    def close(self, cues=[], encoding="pcm"):
+        """
+        Write the closing record and close the file.
+
+        :param list cues: list of (byte offset into the audio, label) tuples.
+        :param String encoding: encoding the audio was written in.
+        :return: None
+        """
+        if self._header is None:
+            self._write_header()
+        bytes_per_frame = self._channels * self._sample_width
+        self._write_record(END, json.dumps({
+            "frames": self._frames,
+            "encoding": encoding,
+            "cues": [{"frame": offset // bytes_per_frame, "label": label}
+                for offset, label in cues]}).encode("utf-8"))
+        self._file.close()
+
+    def _write_header(self):
+        """Write the format of the audio and the nonce prefix of the file"""
+        self._header = Encryption.HEADER.pack(Encryption.MAGIC,
+            Encryption.VERSION, self._channels, self._sample_rate,
+            self._sample_width, self._key_id, os.urandom(8))
+        self._file.write(self._header)
+
+    def _write_record(self, kind, data):
+        """Encrypt and write one record"""
+        prefix = self._header[-8:]
+        encrypted = self._aead.encrypt(_nonce(prefix, self._index), data,
+            _associated_data(self._header, kind, self._index))
+        self._file.write(Encryption.RECORD.pack(kind, len(encrypted)) +
+            encrypted)
+        self._index += 1
+
+def repair(path):
+    """
+    Truncate an encrypted recording left unfinished by a power cut to its last
+    whole record, in place. It needs no key, as the length of the audio in
+    each record is known from the length of the record.
+
+    :param String path: the encrypted file.
+    :return: int number of frames of audio in the repaired file.
+    """
+    size = os.path.getsize(path)
+    with open(path, "r+b") as f:
+        header = f.read(Encryption.HEADER.size)
+        if len(header) < Encryption.HEADER.size:
+            # nothing was encrypted before the power cut
+            f.truncate(0)
+            return 0
+        magic, version, channels, sample_rate, sample_width = \
+            Encryption.HEADER.unpack(header)[:5]
+        if magic != Encryption.MAGIC:
+            raise ValueError("%s is not an encrypted recording" % path)
+
+        audio = 0
+        end = position = Encryption.HEADER.size
+        while position + Encryption.RECORD.size <= size:
+            f.seek(position)
+            kind, length = Encryption.RECORD.unpack(
+                f.read(Encryption.RECORD.size))
+            position += Encryption.RECORD.size + length
+            if position > size:
+                break
+            end = position
+            if kind == AUDIO:
+                audio += length - TAG_SIZE
+        f.truncate(end)
+    return audio // (channels * sample_width)
+
+def decrypt(path, key, wav_path=None):
+    """
+    Decrypt an encrypted recording to a WAV file, with its cue points.
+
+    :param String path: the encrypted file.
+    :param bytes key: the key it was encrypted with.
+    :param String wav_path: file to write, the encrypted file's name without
+                                `.enc` if not given.
+    :return: tuple of the path of the WAV file and whether the recording was
+                                complete, rather than cut short.
+    """
+    from recorder import write_cue_chunks
+
+    if AESGCM is None:
+        raise ImportError("cryptography is needed to decrypt recordings")
+    if wav_path is None:
+        wav_path = path[:-len(ENCRYPTED_SUFFIX)] if \
+            path.endswith(ENCRYPTED_SUFFIX) else path + ".wav"
+
+    aead = AESGCM(key)
+    with open(path, "rb") as f:
+        header = f.read(Encryption.HEADER.size)
+        if len(header) < Encryption.HEADER.size:
+            raise ValueError("%s is not an encrypted recording" % path)
+        magic, version, channels, sample_rate, sample_width, file_key_id, \
+            prefix = Encryption.HEADER.unpack(header)
+        if magic != Encryption.MAGIC or version != Encryption.VERSION:
+            raise ValueError("%s is not a version %d encrypted recording" %
+                (path, Encryption.VERSION))
+        if file_key_id != key_id(key):
+            raise ValueError("%s was encrypted with a different key" % path)
+
+        wav = wave.open(wav_path, "w")
+        wav.setnchannels(channels)
+        wav.setframerate(sample_rate)
+        wav.setsampwidth(sample_width)
+        end = None
+        index = 0
+        while True:
+            record = f.read(Encryption.RECORD.size)
+            if len(record) < Encryption.RECORD.size:
+                break
+            kind, length = Encryption.RECORD.unpack(record)
+            encrypted = f.read(length)
+            if len(encrypted) < length:
+                break
+            try:
+                data = aead.decrypt(_nonce(prefix, index), encrypted,
+                    _associated_data(header, kind, index))
+            except InvalidTag:
+                raise ValueError("Record %d of %s has been tampered with" %
+                    (index, path))
+            index += 1
+            if kind == END:
+                end = json.loads(data.decode("utf-8"))
+                break
+            wav.writeframesraw(data)
+        wav.close()
+
+    bytes_per_frame = channels * sample_width
+    if end is None:
+        Log.warning("encryption", "%s was cut short, decrypted %d records" %
+            (os.path.basename(path), index))
+    else:
+        write_cue_chunks(wav_path, [(cue["frame"] * bytes_per_frame,
+            cue["label"]) for cue in end["cues"]], bytes_per_frame,
+            end.get("encoding", "pcm"))
+    return wav_path, end is not None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create keys for and decrypt recordings encrypted by the CVR.")
+    subparsers = parser.add_subparsers(dest="command")
+    keygen_parser = subparsers.add_parser("keygen",
+        help="Generate a new key.")
+    keygen_parser.add_argument("key",
+        help="File to save the key to.")
+    decrypt_parser = subparsers.add_parser("decrypt",
+        help="Decrypt recordings to WAV files.")
+    decrypt_parser.add_argument("recordings",
+        help="Encrypted recordings, e.g. recording-1500000000.wav.enc",
+        nargs="+")
+    decrypt_parser.add_argument("--key", "-k",
+        help="File the key is saved in.",
+        required=True)
+    decrypt_parser.add_argument("--output", "-o",
+        help="Directory to write the WAV files to. Default is alongside each recording.",
+        default=None)
+    args = parser.parse_args()
+
+    if args.command == "keygen":
+        generate_key(args.key)
+        print("Saved a new key to %s" % args.key)
+    elif args.command == "decrypt":
+        key = load_key(args.key)
+        failed = False
+        for path in args.recordings:
+            wav_path = None
+            if args.output is not None:
+                wav_path = os.path.join(args.output, os.path.basename(
+                    path[:-len(ENCRYPTED_SUFFIX)] if
+                    path.endswith(ENCRYPTED_SUFFIX) else path + ".wav"))
+            try:
+                wav_path, complete = decrypt(path, key, wav_path)
+                print("%s%s" % (wav_path, "" if complete else " (cut short)"))
+            except ValueError as e:
+                print("%s: %s" % (path, e))
+                failed = True
+        sys.exit(1 if failed else 0)
+    else:
+        parser.print_help()
@@ -0,0 +1,246 @@
+import os, sys, argparse, mmap, struct, time
+import threading
+
+from log import Log
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EVENT_LOG = "events.bin"
+EVENT_LOG_SIZE = 1024 * 1024
+EVENT_LOG_KEEP = 8
+
+DETECTION = 0
+TRIGGER = 1
+CONTINUE = 2
+VERIFIED = 3
+NOT_VERIFIED = 4
+RETRIEVE = 5
+
+KINDS = ["detection", "trigger", "continue", "verified", "not_verified",
+    "retrieve"]
+
+class EventLog(object):
+    _tag = "event_log"
+
+    """
+    Append-only binary log of detection events, for tuning sensitivity from
+    what the detector actually saw rather than from text logs. Each event is
+    a fixed-size record written into a memory-mapped file, so logging one is a
+    `pack_into` on the detection thread; once a file is full it is rotated to
+    `name.1`, `name.2`... keeping the newest `keep` files.
+
+    Every `RunDetection` result is logged, including silence (-2) and no
+    hotword (0), so near-misses can be told apart from quiet periods.
+
+    :param String path: file to log to.
+    :param int size: bytes per file before rotating.
+    :param int keep: number of rotated files to keep.
+    """
+    HEADER = struct.Struct("<4sHHQ")
+    MAGIC = b"CVRE"
+    VERSION = 1
+
+    # time, frame index, seconds in RunDetection, hotword, result, kind
+    RECORD = struct.Struct("<dQfhbB")
+
+    def __init__(self, path=EVENT_LOG, size=EVENT_LOG_SIZE,
+        keep=EVENT_LOG_KEEP):
+        self.path = path
+        self._capacity = (size - self.HEADER.size) // self.RECORD.size
+        self._keep = keep
+        self._lock = threading.Lock()
+        self._open()
+        Log.debug(self._tag, "EventLog created (%d events per file)" %
+            self._capacity)
+
+    def log(self, kind, frame, result=0, hotword=0, duration=0):
+        """
+        Append an event, or do nothing once the log is closed.
+
+        :param int kind: `DETECTION`, `TRIGGER`, `CONTINUE`, `VERIFIED`,
+                                `NOT_VERIFIED` or `RETRIEVE`.
+        :param int frame: index of the audio frame the event happened at.
+        :param int result: what `RunDetection` returned.
+        :param int hotword: index of the hotword, 0 if none.
+        :param float duration: seconds spent in `RunDetection`.
+        :return: None
+        """
+        with self._lock:
+            if self._map is None:
+                return
+            if self._count == self._capacity:
+                self._rotate()
+            self.RECORD.pack_into(self._map,
+                self.HEADER.size + self._count * self.RECORD.size,
+                time.time(), frame, duration, hotword, result, kind)
+            self._count += 1
+            struct.pack_into("<Q", self._map, self.HEADER.size - 8,
+                self._count)
+
+    def close(self):
+        """
+        Flush and close the log.
+
+        :return: None
+        """
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._file.close()
+        Log.debug(self._tag, "EventLog closed")
+
+    def _open(self):
+        """Open the log, carrying on from the events already in it"""
+        size = self.HEADER.size + self._capacity * self.RECORD.size
+        self._count = 0
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            self._file = open(self.path, "r+b")
+            self._map = mmap.mmap(self._file.fileno(), size)
+            magic, version, record_size, count = \
+                self.HEADER.unpack_from(self._map, 0)
+            if magic == self.MAGIC and version == self.VERSION and \
+                record_size == self.RECORD.size:
+                self._count = min(count, self._capacity)
+                return
+            self._map.close()
+            self._file.close()
+
+        self._file = open(self.path, "w+b")
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self.VERSION,
+            self.RECORD.size, 0)
+
+    def _rotate(self):
+        """Move the full log to `path.1`, shifting older logs up"""
+        self._map.close()
+        self._file.close()
+        for index in range(self._keep - 1, 0, -1):
+            older = "%s.%d" % (self.path, index)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self.path, index + 1))
+        if self._keep > 0:
+            os.rename(self.path, "%s.1" % self.path)
+        self._open()
+
+def read(path):
+    """
+    Read the events in a log.
+
+    :param String path: the log file.
+    :return: numpy record array with fields time, frame, duration, hotword,
+                                result and kind if numpy is available, else a
+                                list of tuples in that order.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, record_size, count = EventLog.HEADER.unpack_from(data, 0)
+    if magic != EventLog.MAGIC or version != EventLog.VERSION or \
+        record_size != EventLog.RECORD.size:
+        raise ValueError("%s is not a version %d event log" %
+            (path, EventLog.VERSION))
+
+    start = EventLog.HEADER.size
+    if numpy is not None:
+        dtype = numpy.dtype([("time", "<f8"), ("frame", "<u8"),
+            ("duration", "<f4"), ("hotword", "<i2"), ("result", "i1"),
+            ("kind", "u1")])
+        return numpy.frombuffer(data, dtype=dtype, count=count, offset=start)
+    return [EventLog.RECORD.unpack_from(data, start + i * record_size)
+        for i in range(count)]
+
+def summarize(paths):
+    """
+    Aggregate the events in some logs.
+
+    :param list paths: log files.
+    :return: dict of the number of each kind of event, the number of each
+                                `RunDetection` result, the number of triggers
+                                for each hotword, the time covered and the
+                                mean and maximum seconds spent in detection.
+    """
+    summary = {"events": 0, "kinds": {}, "results": {}, "hotwords": {},
+        "first": None, "last": None, "detection_mean": 0,
+        "detection_max": 0}
+    durations = []
+    for path in paths:
+        events = read(path)
+        if len(events) == 0:
+            continue
+
+        if numpy is not None:
+            times, kinds = events["time"], events["kind"]
+            detections = events[kinds == DETECTION]
+            triggers = events[kinds == TRIGGER]
+            kind_counts = zip(*numpy.unique(kinds, return_counts=True))
+            result_counts = zip(*numpy.unique(detections["result"],
+                return_counts=True))
+            hotword_counts = zip(*numpy.unique(triggers["hotword"],
+                return_counts=True))
+            durations.append(detections["duration"].astype("f8"))
+            first, last = float(times.min()), float(times.max())
+        else:
+            kind_counts, result_counts, hotword_counts = {}, {}, {}
+            for event in events:
+                kind_counts[event[5]] = kind_counts.get(event[5], 0) + 1
+                if event[5] == DETECTION:
+                    result_counts[event[4]] = result_counts.get(event[4], 0) + 1
+                    durations.append(event[2])
+                elif event[5] == TRIGGER:
+                    hotword_counts[event[3]] = \
+                        hotword_counts.get(event[3], 0) + 1
+            kind_counts, result_counts, hotword_counts = \
+                kind_counts.items(), result_counts.items(), \
+                hotword_counts.items()
+            first = min(event[0] for event in events)
+            last = max(event[0] for event in events)
+
+        summary["events"] += len(events)
+        for counts, key, names in [(kind_counts, "kinds", KINDS),
+            (result_counts, "results", None),
+            (hotword_counts, "hotwords", None)]:
+            for value, count in counts:
+                name = names[value] if names is not None and \
+                    value < len(names) else str(value)
+                summary[key][name] = summary[key].get(name, 0) + int(count)
+        summary["first"] = first if summary["first"] is None else \
+            min(summary["first"], first)
+        summary["last"] = last if summary["last"] is None else \
+            max(summary["last"], last)
+
+    if numpy is not None and len(durations) > 0:
+        durations = numpy.concatenate(durations)
+        if len(durations) > 0:
+            summary["detection_mean"] = float(durations.mean())
+            summary["detection_max"] = float(durations.max())
+    elif len(durations) > 0:
+        summary["detection_mean"] = float(sum(durations)) / len(durations)
+        summary["detection_max"] = float(max(durations))
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Summarise binary event logs written by the CVR.")
+    parser.add_argument("logs",
+        help="Event log files, e.g. events.bin events.bin.1",
+        nargs="+")
+    args = parser.parse_args()
+
+    summary = summarize(args.logs)
+    if summary["events"] == 0:
+        print("No events")
+        sys.exit(0)
+
+    hours = (summary["last"] - summary["first"]) / 3600.0
+    print("%d events over %.2f hours, %s to %s" % (summary["events"], hours,
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(summary["first"])),
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(summary["last"]))))
+    for key in ["kinds", "results", "hotwords"]:
+        print("%s: %s" % (key, ", ".join("%s=%d" % (name, count)
+            for name, count in sorted(summary[key].items()))))
+    print("detection: %.2f ms mean, %.2f ms max" %
+        (summary["detection_mean"] * 1000, summary["detection_max"] * 1000))
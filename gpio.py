@@ -0,0 +1,83 @@
+import os, sys, time
+import threading
+
+from log import Log
+
+class MockGPIO(object):
+    _tag = "mock_gpio"
+
+    """
+    Stand-in for `RPi.GPIO` so the CVR can run (and its LEDs be tested) off
+    the Raspberry Pi, used when `CVR_MOCK_GPIO` is set. Pin states are kept in
+    memory, with every output recorded in `history`, and `trigger` simulates
+    an edge on an input pin.
+    """
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    _states = {}
+    _callbacks = {}
+    _lock = threading.Lock()
+    history = []
+    delay = 0
+
+    @staticmethod
+    def setmode(mode):
+        pass
+
+    @staticmethod
+    def setup(pin, direction, pull_up_down=None, initial=None):
+        with MockGPIO._lock:
+            if pull_up_down == MockGPIO.PUD_UP:
+                MockGPIO._states[pin] = MockGPIO.HIGH
+            else:
+                MockGPIO._states.setdefault(pin, MockGPIO.LOW)
+
+    @staticmethod
+    def output(pin, state):
+        if MockGPIO.delay > 0:
+            time.sleep(MockGPIO.delay)
+        with MockGPIO._lock:
+            MockGPIO._states[pin] = state
+            MockGPIO.history.append((time.time(), pin, state))
+
+    @staticmethod
+    def input(pin):
+        with MockGPIO._lock:
+            return MockGPIO._states.get(pin, MockGPIO.LOW)
+
+    @staticmethod
+    def add_event_detect(pin, edge, callback=None, bouncetime=None):
+        MockGPIO._callbacks[pin] = callback
+
+    @staticmethod
+    def remove_event_detect(pin):
+        MockGPIO._callbacks.pop(pin, None)
+
+    @staticmethod
+    def trigger(pin):
+        """Simulate an edge on an input pin, calling its callback"""
+        callback = MockGPIO._callbacks.get(pin)
+        if callback is not None:
+            callback(pin)
+
+    @staticmethod
+    def cleanup():
+        with MockGPIO._lock:
+            MockGPIO._states.clear()
+        MockGPIO._callbacks.clear()
+
+if os.environ.get("CVR_MOCK_GPIO"):
+    Log.warning("gpio", "CVR_MOCK_GPIO is set, using mock GPIO")
+    GPIO = MockGPIO
+else:
+    import RPi.GPIO as GPIO
@@ -0,0 +1,184 @@
+import os, sys, time
+import threading
+
+from log import Log
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+HOOK_QUEUE_SIZE = 32
+OVERFLOW_POLICIES = ["drop_oldest", "drop_newest"]
+
+class RecordingEvent(object):
+    """
+    What happened to a recording, passed to each hook.
+
+    :param String kind: `start`, `continue` or `stop`.
+    :param InstanceRecorder instance_recorder: the recording.
+    :param int frame: index of the audio frame captured when it happened.
+    """
+    def __init__(self, kind, instance_recorder, frame):
+        self.kind = kind
+        self.time = time.time()
+        self.frame = frame
+        self.filename = instance_recorder.filename
+        self.filepath = instance_recorder.filepath
+        # frames into the recording, e.g. where the hotword was heard
+        self.recording_frame = int(instance_recorder.position() *
+            instance_recorder.sample_rate)
+
+    def __repr__(self):
+        return "RecordingEvent(%s, %s, frame %d)" % (self.kind, self.filename,
+            self.recording_frame)
+
+class HookDispatcher(object):
+    _tag = "hook_dispatcher"
+
+    """
+    Runs the hooks for recording events (the LEDs, the beep, notifications)
+    on worker threads, so slow hooks never hold up detection or the timers
+    that stop recordings. Events wait in a bounded queue; when it is full
+    either the oldest waiting event or the new one is dropped, and counted.
+    With one worker, the default, hooks run in the order events happened.
+
+    The time each hook takes is recorded, and hooks slower than `slow`
+    seconds are logged.
+
+    :param int workers: number of threads to run hooks on.
+    :param int queue_size: number of events that can wait to be run.
+    :param String overflow: `drop_oldest` or `drop_newest`, which event to
+                                drop when the queue is full.
+    :param float slow: seconds a hook may take before it is logged.
+    """
+    def __init__(self, workers=1, queue_size=HOOK_QUEUE_SIZE,
+        overflow="drop_oldest", slow=0.5):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %s" % overflow)
+
+        self.dropped = 0
+        self._hooks = {}
+        self._timings = {}
+        self._overflow = overflow
+        self._slow = slow
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name="hooks-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        Log.debug(self._tag, "HookDispatcher created (%d workers)" % workers)
+
+    def register(self, kind, hook):
+        """
+        Run a hook for every event of a kind.
+
+        :param String kind: `start`, `continue` or `stop`.
+        :param function hook: called with the `RecordingEvent`.
+        :return: None
+        """
+        with self._lock:
+            self._hooks.setdefault(kind, []).append(hook)
+
+    def unregister(self, kind, hook):
+        """
+        Stop running a hook.
+
+        :param String kind: the kind of event it was registered for.
+        :param function hook: the hook.
+        :return: None
+        """
+        with self._lock:
+            try:
+                self._hooks.get(kind, []).remove(hook)
+            except ValueError:
+                pass
+
+    def dispatch(self, event):
+        """
+        Queue an event for its hooks, without waiting.
+
+        :param RecordingEvent event: the event.
+        :return: None
+        """
+        with self._lock:
+            if len(self._hooks.get(event.kind, [])) == 0:
+                return
+
+        try:
+            self._queue.put_nowait(event)
+            return
+        except queue.Full:
+            pass
+
+        with self._lock:
+            self.dropped += 1
+        if self._overflow == "drop_newest":
+            Log.warning(self._tag, "Hook queue full, dropped %r" % event)
+            return
+        try:
+            Log.warning(self._tag, "Hook queue full, dropped %r" %
+                self._queue.get_nowait())
+            self._queue.put_nowait(event)
+        except (queue.Empty, queue.Full):
+            pass
+
+    def timings(self):
+        """
+        Retrieves how long each hook has taken.
+
+        :return: dict of hook name to (calls, total seconds, longest seconds).
+        """
+        with self._lock:
+            return dict((name, tuple(timing))
+                for name, timing in self._timings.items())
+
+    def terminate(self):
+        """
+        Stop once the queued events have been run.
+
+        :return: None
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+        for name, (calls, total, longest) in sorted(self.timings().items()):
+            Log.debug(self._tag, "%s: %d calls, %.2f ms mean, %.2f ms max" %
+                (name, calls, total * 1000 / calls, longest * 1000))
+        Log.debug(self._tag, "HookDispatcher terminated (%d events dropped)" %
+            self.dropped)
+
+    def _work(self):
+        """Run hooks for events from the queue until told to stop"""
+        while True:
+            event = self._queue.get()
+            if event is None:
+                break
+
+            with self._lock:
+                hooks = list(self._hooks.get(event.kind, []))
+            for hook in hooks:
+                name = getattr(hook, "__name__", repr(hook))
+                started = time.time()
+                try:
+                    hook(event)
+                except Exception as e:
+                    Log.error(self._tag, "%s hook failed on %r: %s" %
+                        (name, event, e))
+                elapsed = time.time() - started
+
+                with self._lock:
+                    timing = self._timings.setdefault(name, [0, 0.0, 0.0])
+                    timing[0] += 1
+                    timing[1] += elapsed
+                    timing[2] = max(timing[2], elapsed)
+                if elapsed > self._slow:
+                    Log.warning(self._tag, "%s hook took %.2f seconds on %r" %
+                        (name, elapsed, event))
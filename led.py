@@ -1,5 +1,13 @@
-import RPi.GPIO as GPIO
 import time
+import threading
+
+from gpio import GPIO
+from log import Log
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 class LED(object):
     """
@@ -15,7 +23,7 @@ class LED(object):
         if init_state == 0:
             self.set(False)
         elif init_state == 1:
-            self.set(T)
+            self.set(True)
 
     def set(self, state=False):
         """
@@ -52,3 +60,127 @@ class LED(object):
         self.set(state=True)
         time.sleep(on_for)
         self.set(state=False)
+
+class LEDWorker(object):
+    _tag = "led_worker"
+
+    """
+    Performs all LED I/O on one thread, so slow GPIO never holds up the
+    threads asking for changes. Requests are queued and coalesced: only the
+    final state of each LED is written, and only if it differs from what was
+    last written. Animations are played as patterns of steps scheduled by the
+    worker rather than by sleeping in the caller.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._desired = {}
+        self._written = {}
+        self._pattern = None
+
+        self._thread = threading.Thread(target=self._work, name="led-worker")
+        self._thread.daemon = True
+        self._thread.start()
+
+        Log.debug(self._tag, "LEDWorker created")
+
+    def set(self, led, state):
+        """
+        Set the state of an LED, stopping any pattern that is playing.
+
+        :param LED led: the LED to set.
+        :param Boolean state: new state of the LED.
+        :return: None
+        """
+        self._queue.put(("set", led, bool(state)))
+
+    def play(self, steps, repeat=1, then=None):
+        """
+        Play a pattern, replacing any pattern already playing.
+
+        :param list steps: list of (dict of LED to state, seconds to hold)
+                                tuples.
+        :param int repeat: times to play the steps, None to loop until another
+                                pattern is played or an LED is set.
+        :param function then: called on the worker thread once the pattern
+                                has finished (not if it is replaced).
+        :return: None
+        """
+        self._queue.put(("play", steps, repeat, then))
+
+    def terminate(self):
+        """
+        Write any outstanding changes, then stop the worker.
+
+        :return: None
+        """
+        self._queue.put(("stop",))
+        self._thread.join()
+        Log.debug(self._tag, "LEDWorker terminated")
+
+    def _work(self):
+        """Apply queued requests and pattern steps until told to stop"""
+        running = True
+        while running:
+            timeout = None
+            if self._pattern is not None:
+                timeout = max(0, self._pattern["due"] - time.time())
+
+            commands = []
+            try:
+                commands.append(self._queue.get(timeout=timeout))
+                while True:
+                    commands.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            finished = None
+            for command in commands:
+                if command[0] == "set":
+                    self._pattern = None
+                    self._desired[command[1]] = command[2]
+                elif command[0] == "play":
+                    self._pattern = {"steps": command[1], "repeat": command[2],
+                        "then": command[3], "index": 0, "due": time.time()}
+                elif command[0] == "stop":
+                    running = False
+
+            if self._pattern is not None and \
+                self._pattern["due"] <= time.time():
+                finished = self._step()
+
+            self._flush()
+
+            if finished is not None:
+                finished()
+
+    def _step(self):
+        """
+        Apply the next step of the pattern, or end it once the last step has
+        been held for its time.
+
+        :return: the pattern's `then` callback if the pattern finished.
+        """
+        pattern = self._pattern
+        if pattern["index"] is None:
+            self._pattern = None
+            return pattern["then"] or (lambda: None)
+
+        states, hold = pattern["steps"][pattern["index"]]
+        self._desired.update(states)
+        pattern["due"] += hold
+        pattern["index"] += 1
+
+        if pattern["index"] == len(pattern["steps"]):
+            pattern["index"] = 0
+            if pattern["repeat"] is not None:
+                pattern["repeat"] -= 1
+                if pattern["repeat"] <= 0:
+                    pattern["index"] = None
+        return None
+
+    def _flush(self):
+        """Write the LEDs whose desired state differs from their last write"""
+        for led, state in self._desired.items():
+            if self._written.get(led) != state:
+                led.set(state)
+                self._written[led] = state
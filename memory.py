@@ -0,0 +1,113 @@
+import os, sys, time
+
+from log import Log
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class MemoryReport(object):
+    _tag = "memory"
+
+    @staticmethod
+    def start_tracing(frames=10):
+        """
+        Start tracing allocations so reports can include the top allocation
+        sites. Tracing slows allocation down, so is off unless asked for.
+
+        :param int frames: frames of traceback to keep per allocation.
+        :return: Boolean, False if tracing isn't available.
+        """
+        if tracemalloc is None:
+            Log.warning(MemoryReport._tag,
+                "tracemalloc is not available in this version of Python")
+            return False
+        tracemalloc.start(frames)
+        Log.info(MemoryReport._tag, "Tracing memory allocations")
+        return True
+
+    @staticmethod
+    def buffers(audio_handler):
+        """
+        Report the bytes held by each buffer of an `AudioHandler`.
+
+        :param AudioHandler audio_handler: the handler to report on.
+        :return: dict of the bytes held by the detector buffer, the backward
+                                buffer and each recorder's forward buffer, the
+                                number of live recorders and the total.
+        """
+        report = {
+            "detector_buffer": audio_handler.detector_buffer.memory_usage(),
+            "backward_buffer": 0,
+            "forward_buffers": {},
+        }
+        if audio_handler.backward_buffer is not None:
+            report["backward_buffer"] = \
+                audio_handler.backward_buffer.memory_usage()
+
+        recorders = audio_handler.instance_recorders.recorders() + \
+            audio_handler.retrievals.recorders()
+        for instance_recorder in recorders:
+            report["forward_buffers"][instance_recorder.filename] = \
+                instance_recorder.memory_usage()
+
+        report["live_recorders"] = len(recorders)
+        report["total"] = report["detector_buffer"] + \
+            report["backward_buffer"] + sum(report["forward_buffers"].values())
+        return report
+
+    @staticmethod
+    def top(limit=10):
+        """
+        Retrieve the top allocation sites, if tracing.
+
+        :param int limit: number of allocation sites to retrieve.
+        :return: list of tracemalloc Statistics, empty if not tracing.
+        """
+        if tracemalloc is None or not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)])
+        return snapshot.statistics("lineno")[:limit]
+
+    @staticmethod
+    def log(audio_handler, limit=10):
+        """
+        Log the buffer report and, if tracing, the top allocation sites.
+
+        :param AudioHandler audio_handler: the handler to report on.
+        :param int limit: number of allocation sites to log.
+        :return: dict of the buffer report.
+        """
+        report = MemoryReport.buffers(audio_handler)
+        device = getattr(audio_handler, "name", None)
+        Log.info(MemoryReport._tag,
+            "%s%d bytes held in buffers by %d live recorders "
+            "(detector %d, backward %d, forward %d)" % (
+                "" if device is None else device + ": ", report["total"],
+                report["live_recorders"], report["detector_buffer"],
+                report["backward_buffer"],
+                sum(report["forward_buffers"].values())))
+        for filename, size in sorted(report["forward_buffers"].items()):
+            Log.info(MemoryReport._tag, "%d bytes held for %s" %
+                (size, filename))
+
+        for stat in MemoryReport.top(limit):
+            Log.info(MemoryReport._tag, str(stat))
+        return report
+
+    @staticmethod
+    def process_usage():
+        """
+        Retrieve the memory currently allocated by Python, or the peak resident
+        size of the process if allocations aren't being traced.
+
+        :return: int bytes.
+        """
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[0]
+
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
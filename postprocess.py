@@ -0,0 +1,256 @@
+import os, sys, json, wave
+import threading
+
+from log import Log
+from recorder import audioop
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class PostProcessor(object):
+    _tag = "post_processor"
+
+    """
+    Trims leading silence, normalises loudness and summarises the peaks of
+    finished recordings, using the audio the `InstanceRecorder` kept in memory
+    so the file isn't read back from disk, unless the recording was too long
+    to keep (see `InstanceRecorder.KEEP_AUDIO_LIMIT`). Work is done by a small pool of low
+    priority threads fed from a bounded queue; recordings that arrive while
+    the queue is full, or while processing is paused because the writers are
+    behind, are skipped rather than holding up the writers, and counted in
+    `skipped`.
+
+    Each recording `name.wav` gains `name.processed.wav` and `name.peaks.json`.
+
+    :param int workers: number of worker threads.
+    :param int queue_size: number of recordings that can wait to be processed.
+    :param int niceness: how much to lower the priority of the workers.
+    :param float silence_threshold: level in dBFS below which audio is silence.
+    :param float target_level: RMS level in dBFS to normalise to.
+    :param int peaks: number of min/max pairs in the peak summary.
+    """
+    def __init__(self,
+        workers=1,
+        queue_size=4,
+        niceness=10,
+        silence_threshold=-50,
+        target_level=-20,
+        peaks=500):
+        if numpy is None:
+            raise ImportError("Post-processing requires numpy")
+
+        self._niceness = niceness
+        self._silence_threshold = 10 ** (silence_threshold / 20.0)
+        self._target_level = 10 ** (target_level / 20.0)
+        self._peaks = peaks
+
+        self.skipped = 0
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                name="post-processor-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        Log.debug(self._tag, "PostProcessor created with %d workers" % workers)
+
+    def submit(self, instance_recorder):
+        """
+        Queue a finished recording for processing, without blocking.
+
+        :param InstanceRecorder instance_recorder: recorder that kept its audio.
+        :return: Boolean, False if the queue was full or processing paused and
+                                it was skipped.
+        """
+        if not self._resumed.is_set():
+            Log.warning(self._tag, "Post-processing paused, skipping %s" %
+                instance_recorder.filename)
+        else:
+            try:
+                self._queue.put_nowait(instance_recorder)
+                return True
+            except queue.Full:
+                Log.warning(self._tag, "Post-processing queue full, skipping "
+                    "%s" % instance_recorder.filename)
+        self.skipped += 1
+        instance_recorder.audio = None
+        return False
+
+    def pending(self):
+        """Retrieves the number of recordings waiting to be processed"""
+        return self._queue.qsize()
+
+    def pause(self):
+        """
+        Stop processing after the current recordings, skipping any submitted
+        until `resume` is called.
+
+        :return: None
+        """
+        self._resumed.clear()
+
+    def resume(self):
+        """
+        Carry on processing after `pause`.
+
+        :return: None
+        """
+        self._resumed.set()
+
+    def is_paused(self):
+        """Retrieves whether processing is paused"""
+        return not self._resumed.is_set()
+
+    def terminate(self):
+        """
+        Stop the workers once they have processed the queued recordings.
+        """
+        self._resumed.set()
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        Log.debug(self._tag, "PostProcessor terminated")
+
+    def _work(self):
+        """Process recordings from the queue until told to stop"""
+        self._lower_priority()
+        while True:
+            instance_recorder = self._queue.get()
+            if instance_recorder is None:
+                break
+
+            self._resumed.wait()
+            try:
+                self.process(instance_recorder)
+            except Exception as e:
+                Log.error(self._tag, "Could not post-process %s: %s" %
+                    (instance_recorder.filename, e))
+            instance_recorder.audio = None
+
+    def _lower_priority(self):
+        """Lower the scheduling priority of the calling thread, where possible"""
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(),
+                self._niceness)
+        except (AttributeError, OSError):
+            Log.debug(self._tag, "Could not lower post-processor priority")
+
+    def process(self, instance_recorder):
+        """
+        Trim, normalise and summarise one recording.
+
+        :param InstanceRecorder instance_recorder: recorder that kept its audio.
+        :return: None
+        """
+        if instance_recorder.bytes_per_sample != 2:
+            Log.warning(self._tag, "Can only post-process 16-bit audio")
+            return
+
+        data = self._read_audio(instance_recorder)
+        if data is None:
+            Log.warning(self._tag, "Couldn't read the audio of %s back" %
+                instance_recorder.filename)
+            return
+
+        channels = instance_recorder.num_channels
+        rate = instance_recorder.sample_rate
+        samples = numpy.frombuffer(data, dtype="<i2")
+        samples = samples[:len(samples) // channels * channels]
+        samples = samples.reshape(-1, channels).astype(numpy.float32) / 32768
+
+        # trim leading silence, in blocks of 10ms
+        block = max(1, rate // 100)
+        blocks = len(samples) // block
+        rms = numpy.sqrt(numpy.mean(
+            samples[:blocks * block].reshape(blocks, -1) ** 2, axis=1))
+        loud = numpy.nonzero(rms > self._silence_threshold)[0]
+        start = loud[0] * block if len(loud) > 0 else len(samples)
+        samples = samples[start:]
+
+        # normalise loudness, without letting the peak clip
+        gain = 1.0
+        if len(samples) > 0:
+            level = numpy.sqrt(numpy.mean(samples ** 2))
+            peak = numpy.max(numpy.abs(samples))
+            if level > 0:
+                gain = min(self._target_level / level, 0.99 / peak)
+            samples = samples * gain
+
+        base = os.path.splitext(instance_recorder.filepath)[0]
+        self._write_wav(base + ".processed.wav", samples, channels, rate)
+        self._write_peaks(base + ".peaks.json", samples, rate, start, gain)
+
+        Log.debug(self._tag, "Post-processed %s, trimmed %.2f seconds and "
+            "applied a gain of %.2f" % (instance_recorder.filename,
+                float(start) / rate, gain))
+
+    def _read_audio(self, instance_recorder):
+        """
+        Retrieves the audio of a recording as captured, joined from memory or
+        read back from its WAV files if it was too long to keep.
+
+        :return: bytes of 16-bit audio, or None if it couldn't be read.
+        """
+        if instance_recorder.audio is not None:
+            return b"".join(instance_recorder.audio)
+
+        paths = [path for path in instance_recorder.files()
+            if path.endswith(".wav")]
+        if len(paths) == 0:
+            return None
+        data = []
+        for path in paths:
+            wav = wave.open(path, "rb")
+            try:
+                frames = wav.readframes(wav.getnframes())
+                sample_width = wav.getsampwidth()
+            finally:
+                wav.close()
+            if sample_width == 1 and audioop is not None:
+                # written with 8 bit samples to shed work, which are unsigned
+                frames = audioop.lin2lin(audioop.bias(frames, 1, -128), 1, 2)
+            elif sample_width != 2:
+                return None
+            data.append(frames)
+        return b"".join(data)
+
+    def _write_wav(self, filepath, samples, channels, rate):
+        """Write normalised samples as 16-bit audio"""
+        out = wave.open(filepath, "wb")
+        out.setnchannels(channels)
+        out.setframerate(rate)
+        out.setsampwidth(2)
+        out.writeframes((samples * 32767).astype("<i2").tobytes())
+        out.close()
+
+    def _write_peaks(self, filepath, samples, rate, start, gain):
+        """Write the min/max of each slice of the recording, for thumbnails"""
+        mono = samples.mean(axis=1)
+        bins = min(self._peaks, len(mono))
+        if bins > 0:
+            sliced = mono[:len(mono) // bins * bins].reshape(bins, -1)
+            peaks = numpy.stack([sliced.min(axis=1), sliced.max(axis=1)],
+                axis=1)
+        else:
+            peaks = numpy.zeros((0, 2))
+
+        with open(filepath, "w") as f:
+            json.dump({
+                "duration": float(len(samples)) / rate,
+                "trimmed": float(start) / rate,
+                "gain": float(gain),
+                "peaks": numpy.round(peaks, 4).tolist()
+            }, f)
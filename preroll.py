@@ -0,0 +1,221 @@
+import os, sys, mmap, struct, time
+
+from log import Log
+from recorder import BackwardBuffer
+
+PREROLL_SEGMENT = "/dev/shm/cvr-preroll"
+# seconds the back buffer holds beyond the recorder's --before, for the
+# writers to catch up when reading recordings from it
+PREROLL_MARGIN = 10
+# seconds capture.py keeps by default, enough for the default --before of 60
+PREROLL_SECONDS = 60 + PREROLL_MARGIN
+
+class SharedRingBuffer(object):
+    _tag = "shared_ring_buffer"
+
+    MAGIC = b"CVR1"
+    HEADER = struct.Struct("<4sIIIQ")
+
+    """
+    Ring buffer of audio kept in a named, memory-mapped segment (on tmpfs by
+    default) so it outlives the process reading it. The segment starts with a
+    header holding the ring size, the audio format and a write cursor of the
+    total bytes ever written, followed by the ring itself.
+
+    :param str path: path of the segment.
+    :param int size: number of bytes to store in the ring, only used when
+                                creating the segment.
+    :param int bytes_per_second: bytes of audio per second, only used when
+                                creating the segment.
+    :param bool create: create (or reset) the segment rather than attaching to
+                                an existing one.
+    """
+    def __init__(self, path=PREROLL_SEGMENT, size=0, bytes_per_second=0,
+        create=False):
+        self.path = path
+
+        if create:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.ftruncate(fd, self.HEADER.size + size)
+        else:
+            fd = os.open(path, os.O_RDWR)
+        try:
+            self._map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+        if create:
+            self.HEADER.pack_into(self._map, 0,
+                self.MAGIC, size, bytes_per_second, 0, 0)
+
+        magic, self.size, self.bytes_per_second, _, _ = \
+            self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            raise ValueError("%s is not a pre-roll segment" % path)
+
+        Log.debug(self._tag, "%s %s (%d bytes)" %
+            ("Created" if create else "Attached to", path, self.size))
+
+    def cursor(self):
+        """Retrieves the total length of data ever written to the ring"""
+        return self.HEADER.unpack_from(self._map, 0)[4]
+
+    def extend(self, data):
+        """Adds data to the end of the ring, then moves the cursor"""
+        cursor = self.cursor()
+        length = len(data)
+        if length > self.size:
+            data = data[-self.size:]
+            cursor += length - self.size
+            length = self.size
+
+        start = self.HEADER.size + cursor % self.size
+        first = min(length, self.HEADER.size + self.size - start)
+        self._map[start:start + first] = data[:first]
+        if first < length:
+            self._map[self.HEADER.size:self.HEADER.size + length - first] = \
+                data[first:]
+
+        struct.pack_into("<Q", self._map, self.HEADER.size - 8,
+            cursor + length)
+
+    def read(self, start, end):
+        """
+        Retrieves the data written between two cursor positions. Anything
+        that has since been overwritten is skipped.
+
+        :param int start: cursor position to read from.
+        :param int end: cursor position to read to.
+        :return: bytes
+        """
+        start = max(start, end - self.size)
+        if end <= start:
+            return b""
+
+        offset = start % self.size
+        length = end - start
+        first = min(length, self.size - offset)
+        begin = self.HEADER.size + offset
+        data = self._map[begin:begin + first]
+        if first < length:
+            data += self._map[self.HEADER.size:
+                self.HEADER.size + length - first]
+        return data
+
+    def read_since(self, start):
+        """
+        Retrieves the data written since a cursor position.
+
+        :param int start: cursor position to read from.
+        :return: tuple of the bytes and the new cursor position.
+        """
+        end = self.cursor()
+        return self.read(start, end), end
+
+    def close(self):
+        """Detach from the segment, leaving it in place"""
+        self._map.close()
+
+    def unlink(self):
+        """Remove the segment"""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class SharedBackwardBuffer(BackwardBuffer):
+    _tag = "shared_backward_buffer"
+
+    """
+    Backward buffer that reads its audio from a `SharedRingBuffer` rather than
+    holding its own copy, so the pre-roll survives restarts of this process.
+    The ring must hold at least `record_for` seconds.
+
+    Like a backward buffer of its own, it ends at the audio passed on to the
+    other buffers: `read` retrieves what is new in the ring, and `extend`
+    moves the end of the buffer past it, so the pre-roll of a recording ends
+    where its forward buffer starts.
+
+    :param SharedRingBuffer ring: the shared ring filled by the capture process.
+    :param int num_channels: number of audio channels to write.
+    :param int sample_rate: sample rate
+    :param int bytes_per_sample: bytes per sample
+    :param int record_for: seconds to record in the back buffer.
+    """
+    def __init__(self,
+        ring,
+        num_channels=1,
+        sample_rate=16000,
+        bytes_per_sample=2,
+        record_for=60):
+        # nothing is held here, but keep the lock and counts of a ring buffer
+        super(SharedBackwardBuffer, self).__init__(
+            num_channels=num_channels,
+            sample_rate=sample_rate,
+            bytes_per_sample=bytes_per_sample,
+            record_for=0)
+        self._ring = ring
+        self._size=record_for*self._bytes_per_second
+        self._end = self._read_to = ring.cursor()
+
+        if ring.size < self._size:
+            raise ValueError("Shared pre-roll only holds %.2f of %d seconds, "
+                "start capture.py with --seconds %d" % (float(ring.size) /
+                self._bytes_per_second, record_for, record_for))
+
+    def read(self):
+        """
+        Retrieves the audio written to the ring since it was last read, to
+        pass on to the buffers.
+
+        :return: bytes
+        """
+        data, self._read_to = self._ring.read_since(self._end)
+        return data
+
+    def extend(self, data):
+        """
+        The capture process fills the ring, so this only moves the end of the
+        buffer past the audio last read
+        """
+        self._end = self._read_to
+
+    def clear(self):
+        """The capture process owns the ring, so this does nothing"""
+        pass
+
+    def get_copy(self):
+        """Retrieves a copy of the data of the buffer"""
+        return self._ring.read(self._end - self._size, self._end)
+
+    def get_last(self, length):
+        """Retrieves a copy of the last `length` bytes of the buffer"""
+        return self._ring.read(self._end - min(length, self._size), self._end)
+
+    def get_range(self, start, end):
+        """Retrieves a copy of the bytes between two positions in the ring"""
+        end = min(end, self._end)
+        start = max(start, self._end - self._size)
+        if end <= start:
+            return b""
+        return self._ring.read(start, end)
+
+    def get(self):
+        """Retrieves a copy of the data of the buffer"""
+        return self.get_copy()
+
+    def length(self):
+        """Retrieves the length of data in the buffer"""
+        return min(self._end, self._size)
+
+    def total_length(self):
+        """Retrieves the length of data ever put in the buffer"""
+        return self._end
+
+    def max_length(self):
+        """Retrieves the maximum length of data ever put in the buffer"""
+        return self._size
+
+    def memory_usage(self):
+        """Retrieves the bytes of memory held, none as the ring is shared"""
+        return 0
@@ -0,0 +1,183 @@
+import os, sys, time, signal
+import threading
+
+from log import Log
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+class Profiler(object):
+    _tag = "profiler"
+
+    enabled = False
+    interval = 0.005
+
+    _lock = threading.Lock()
+    _thread = None
+    _output_dir = "."
+    _started = None
+    _stacks = {}
+    _timings = {}
+    _thread_names = {}
+
+    @staticmethod
+    def start(output_dir=".", interval=0.005):
+        """
+        Start sampling the stacks of every thread and timing the hot paths.
+
+        :param String output_dir: directory to dump the profile to on `stop`.
+        :param float interval: seconds between samples.
+        :return: None
+        """
+        with Profiler._lock:
+            if Profiler.enabled:
+                Log.debug(Profiler._tag, "Profiler already running")
+                return
+
+            Profiler._output_dir = output_dir
+            Profiler.interval = interval
+            Profiler._started = time.time()
+            Profiler._stacks = {}
+            Profiler._timings = {}
+            Profiler.enabled = True
+
+            Profiler._thread = threading.Thread(target=Profiler._sample,
+                name="profiler")
+            Profiler._thread.daemon = True
+            Profiler._thread.start()
+
+        Log.info(Profiler._tag, "Profiler started")
+
+    @staticmethod
+    def stop():
+        """
+        Stop profiling and dump the collapsed stacks and timings.
+
+        :return: String path of the collapsed stacks, or None if the profiler
+                                wasn't running.
+        """
+        with Profiler._lock:
+            if not Profiler.enabled:
+                Log.debug(Profiler._tag, "Profiler not running")
+                return None
+            Profiler.enabled = False
+
+        Profiler._thread.join()
+        Profiler._thread = None
+        Log.info(Profiler._tag, "Profiler stopped")
+        return Profiler.dump()
+
+    @staticmethod
+    def handle_signals(output_dir="."):
+        """
+        Start profiling on SIGUSR1, and stop and dump the profile on SIGUSR2.
+
+        :param String output_dir: directory to dump the profile to.
+        :return: None
+        """
+        signal.signal(signal.SIGUSR1,
+            lambda signum, frame: Profiler.start(output_dir))
+        signal.signal(signal.SIGUSR2,
+            lambda signum, frame: Profiler.stop())
+
+    @staticmethod
+    def start_timer():
+        """
+        Start timing a hot path, this costs one attribute lookup when the
+        profiler is off.
+
+        :return: float start time, or None if the profiler is off.
+        """
+        if Profiler.enabled:
+            return time.time()
+        return None
+
+    @staticmethod
+    def stop_timer(name, started):
+        """
+        Finish timing a hot path started with `start_timer`.
+
+        :param String name: name of the hot path, also used to name the thread
+                                it runs on in the collapsed stacks.
+        :param float started: value returned by `start_timer`.
+        :return: None
+        """
+        if started is None:
+            return
+
+        elapsed = time.time() - started
+        with Profiler._lock:
+            Profiler._thread_names[get_ident()] = name
+            try:
+                timing = Profiler._timings[name]
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+            except KeyError:
+                Profiler._timings[name] = [1, elapsed, elapsed]
+
+    @staticmethod
+    def dump():
+        """
+        Write the collapsed stacks (for flamegraph.pl or speedscope) and the
+        hot path timings to the output directory.
+
+        :return: String path of the collapsed stacks.
+        """
+        name = "profile-%d" % int(Profiler._started)
+        stacks_path = os.path.join(Profiler._output_dir, name + ".folded")
+        timings_path = os.path.join(Profiler._output_dir, name + ".timings")
+
+        with Profiler._lock:
+            stacks = sorted(Profiler._stacks.items())
+            timings = sorted(Profiler._timings.items())
+
+        with open(stacks_path, "w") as f:
+            for stack, count in stacks:
+                f.write("%s %d\n" % (stack, count))
+
+        with open(timings_path, "w") as f:
+            f.write("name\tcalls\ttotal_s\tmean_ms\tmax_ms\n")
+            for name, (calls, total, longest) in timings:
+                f.write("%s\t%d\t%.3f\t%.3f\t%.3f\n" % (name, calls, total,
+                    total * 1000 / calls, longest * 1000))
+
+        Log.info(Profiler._tag, "Profile written to %s and %s" %
+            (stacks_path, timings_path))
+        return stacks_path
+
+    @staticmethod
+    def _sample():
+        """
+        Sample the stack of every other thread every `interval` seconds until
+        the profiler is stopped.
+
+        :return: None
+        """
+        own_ident = get_ident()
+        while Profiler.enabled:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            with Profiler._lock:
+                names.update(Profiler._thread_names)
+
+            samples = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name,
+                        os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread-%d" % ident))
+                samples.append(";".join(reversed(stack)))
+
+            with Profiler._lock:
+                for sample in samples:
+                    Profiler._stacks[sample] = Profiler._stacks.get(sample, 0) + 1
+
+            time.sleep(Profiler.interval)
@@ -1,45 +1,93 @@
-import os, sys, signal, time
+import os, sys, signal, time, struct, json
 import threading, collections, copy
-import pyaudio, wave, snowboydetect
+import wave
+
+try:
+	import audioop
+except ImportError:
+	audioop = None
 
 from log import Log
+from profiler import Profiler
+from writer import WriterPool
+from recovery import mark_open, mark_closed
+from encryption import ENCRYPTED_SUFFIX
 
 TOP_DIR = os.path.dirname(os.path.realpath(__file__))
 RESOURCE_FILE = os.path.join(TOP_DIR, "resources/common.res")
 
-class RingBuffer(object):
-	_total_length=0
-	_length=0
+# audio is written as captured, or with 8 bit samples to halve what is written
+# when the writers fall behind
+ENCODINGS = ["pcm", "pcm8"]
 
+class RingBuffer(object):
 	"""
-	Ring buffer to hold audio from PortAudio, from the Snowboy project
+	Ring buffer to hold audio from PortAudio, from the Snowboy project. Audio
+	is kept as bytes in a fixed-size `bytearray`, written and sliced with
+	`memoryview`s, and every method holds a lock so the audio callback can't
+	slip data in between `get` copying and clearing the buffer. Bytes
+	overwritten before they were read are counted in `dropped`.
 
 	:param Int size: number of bytes to store in the buffer.
 	"""
 	def __init__(self, size=4096):
-		self._buf = collections.deque(maxlen=size)
+		self._size = int(size)
+		self._buf = bytearray(self._size)
+		self._lock = threading.Lock()
+		self._length = 0
+		self._total_length = 0
+		self.dropped = 0
 
 	def extend(self, data):
 		"""Adds data to the end of buffer"""
-		self._buf.extend(data)
 		length = len(data)
-		self._length += length
-		self._total_length += length
+		with self._lock:
+			if self._size > 0:
+				view = memoryview(data)
+				if length > self._size:
+					view = view[length - self._size:]
+				start = (self._total_length + length - len(view)) % self._size
+				first = min(len(view), self._size - start)
+				self._buf[start:start + first] = view[:first]
+				if first < len(view):
+					self._buf[:len(view) - first] = view[first:]
+				self.dropped += max(0, self._length + length - self._size)
+				self._length = min(self._length + length, self._size)
+			self._total_length += length
 
 	def clear(self):
 		"""Clear the buffer"""
-		self._buf.clear()
-		self._length = 0
+		with self._lock:
+			self._length = 0
 
 	def get_copy(self):
 		"""Retrieves a copy of the data of the buffer"""
-		return copy.deepcopy(bytes(bytearray(self._buf)))
+		with self._lock:
+			return self._read(self._total_length - self._length,
+				self._total_length)
+
+	def get_last(self, length):
+		"""Retrieves a copy of the last `length` bytes of the buffer"""
+		with self._lock:
+			return self._read(self._total_length - min(length, self._length),
+				self._total_length)
+
+	def get_range(self, start, end):
+		"""
+		Retrieves a copy of the bytes between two positions in everything ever
+		put in the buffer (see `total_length`), clipped to what it still holds.
+		"""
+		with self._lock:
+			return self._read(max(start, self._total_length - self._length),
+				min(end, self._total_length))
 
 	def get(self):
 		"""Retrieves data from the beginning of buffer and clears it"""
-		tmp = bytes(bytearray(self._buf))
-		self.clear()
-		return tmp
+		with self._lock:
+			tmp = self._read(self._total_length - self._length,
+				self._total_length)
+			self._length = 0
+			return tmp
 
 	def length(self):
 		"""Retrieves the length of data in the buffer"""
@@ -51,7 +99,22 @@ class RingBuffer(object):
 
 	def max_length(self):
 		"""Retrieves the maximum length of data ever put in the buffer"""
-		return self._buf.maxlen
+		return self._size
+
+	def memory_usage(self):
+		"""Retrieves the number of bytes of memory held by the buffer"""
+		return sys.getsizeof(self._buf)
+
+	def _read(self, start, end):
+		"""Copies the bytes between two positions, which must still be held"""
+		if end <= start:
+			return b""
+		offset = start % self._size
+		first = min(end - start, self._size - offset)
+		view = memoryview(self._buf)
+		if first == end - start:
+			return view[offset:offset + first].tobytes()
+		return view[offset:].tobytes() + view[:end - start - first].tobytes()
 
 class DetectorRingBuffer(RingBuffer):
 	"""
@@ -77,8 +140,8 @@ class InstanceBuffer(RingBuffer):
 		bytes_per_sample=2,
 		record_for=60):
 		self._bytes_per_second=num_channels*sample_rate*bytes_per_sample
-		self._size=record_for*self._bytes_per_second
-		self._buf = collections.deque(maxlen=self._size)
+		super(InstanceBuffer, self).__init__(
+			size=record_for*self._bytes_per_second)
 
 class BackwardBuffer(InstanceBuffer):
 	_tag = "backward_buffer"
@@ -100,9 +163,113 @@ class ForwardBuffer(InstanceBuffer):
 		if not self._stop_capture:
 			return super(ForwardBuffer, self).extend(data)
 
+def write_cue_chunks(filepath, cues, bytes_per_frame, encoding="pcm"):
+	"""
+	Append `cue ` and `LIST`/`adtl` chunks to a closed WAV file, marking
+	positions in the audio, and update the RIFF size to include them. Audio
+	not written as captured is noted in a `LIST`/`INFO` comment too.
+
+	:param String filepath: the WAV file.
+	:param list cues: list of (byte offset into the audio, label) tuples.
+	:param int bytes_per_frame: bytes per frame of audio.
+	:param String encoding: encoding the audio was written in (`ENCODINGS`).
+	:return: None
+	"""
+	if len(cues) == 0 and encoding == "pcm":
+		return
+
+	chunks = b""
+	if encoding != "pcm":
+		text = ("encoding=%s" % encoding).encode("ascii") + b"\x00"
+		info = b"INFO" + struct.pack("<4sI", b"ICMT", len(text)) + text
+		if len(text) % 2 == 1:
+			info += b"\x00"
+		chunks += struct.pack("<4sI", b"LIST", len(info)) + info
+	if len(cues) > 0:
+		chunks += _cue_chunks(cues, bytes_per_frame)
+
+	with open(filepath, "r+b") as f:
+		f.seek(0, os.SEEK_END)
+		if f.tell() % 2 == 1:
+			f.write(b"\x00")
+		f.write(chunks)
+		size = f.tell()
+		f.seek(4)
+		f.write(struct.pack("<I", size - 8))
+
+def _cue_chunks(cues, bytes_per_frame):
+	"""Retrieves the `cue ` and `LIST`/`adtl` chunks marking some cues"""
+	cue = struct.pack("<I", len(cues))
+	labels = b""
+	for cue_id, (offset, label) in enumerate(cues, 1):
+		frame = offset // bytes_per_frame
+		cue += struct.pack("<II4sIII", cue_id, frame, b"data", 0, 0, frame)
+		text = label.encode("ascii") + b"\x00"
+		labels += struct.pack("<4sI", b"labl", 4 + len(text)) + \
+			struct.pack("<I", cue_id) + text
+		if len(text) % 2 == 1:
+			labels += b"\x00"
+	adtl = b"adtl" + labels
+	return struct.pack("<4sI", b"cue ", len(cue)) + cue + \
+		struct.pack("<4sI", b"LIST", len(adtl)) + adtl
+
+class RecorderList(object):
+	_tag = "recorder_list"
+
+	"""
+	Thread-safe list of the active `InstanceRecorder`s, which drops recorders
+	once they have finished writing.
+	"""
+	def __init__(self):
+		self._recorders = []
+		self._lock = threading.Lock()
+
+	def append(self, instance_recorder):
+		"""Add a recorder to the end of the list"""
+		with self._lock:
+			self._recorders.append(instance_recorder)
+
+	def extend(self, data):
+		"""Extend every recorder with data, dropping finished recorders"""
+		with self._lock:
+			self._recorders = [r for r in self._recorders if not r.clean_up]
+			for instance_recorder in self._recorders:
+				instance_recorder.extend(data)
+
+	def interrupt(self):
+		"""Interrupt every recorder and empty the list"""
+		with self._lock:
+			recorders = self._recorders
+			self._recorders = []
+		for instance_recorder in recorders:
+			instance_recorder.interrupt()
+
+	def last(self):
+		"""Retrieves the most recent recorder, or None if there are none"""
+		with self._lock:
+			try:
+				return self._recorders[-1]
+			except IndexError:
+				return None
+
+	def recorders(self):
+		"""Retrieves a copy of the list of recorders"""
+		with self._lock:
+			return list(self._recorders)
+
+	def __len__(self):
+		return len(self._recorders)
+
+	def __getitem__(self, index):
+		with self._lock:
+			return self._recorders[index]
+
 class InstanceRecorder(object):
 	_tag = "instance_record"
 
+	WRITE_THRESHOLD = 3
+	KEEP_AUDIO_LIMIT = 180
+
 	"""
 	Object to handle file writing that records an instance of hotword use.
 
@@ -115,6 +282,39 @@ class InstanceRecorder(object):
 	:param String file_prefix: prefix of files to save to.
     :param bool delete_active_recording: Delete an active recording if 
                                 interrupted
+	:param bool keep_audio: keep the audio written in memory, in `audio`, for
+                                the finished callback, up to
+                                `KEEP_AUDIO_LIMIT` seconds; `audio` is None
+                                for longer recordings.
+	:param function finished_callback: called with this recorder once the file
+                                has been written and closed.
+	:param WriterPool writer_pool: threads to write the file with, the shared 
+                                pool if not given.
+	:param bool provisional: buffer but don't write anything until `commit` is
+                                called, or `discard` to drop the recording.
+	:param tuple before_range: (start, end) positions in `buf_before` (see
+                                `RingBuffer.get_range`) to write before
+                                `buf_after`, all it holds when created if not
+                                given. It is read when writing starts, which
+                                may be a while after the trigger, so
+                                `buf_before` must hold a few seconds more.
+	:param String trigger_label: label of the cue point marking when the
+                                recording was triggered.
+	:param float segment_seconds: roll over to a new file after this many
+                                seconds of audio, None to write one file.
+	:param int segment_bytes: roll over to a new file after this many bytes of
+                                audio, None to write one file.
+	:param ChunkStore chunk_store: store the audio in shared chunks, read from
+                                `buf_before` by position so overlapping
+                                recordings share it, and write a manifest of
+                                the chunks rather than a WAV file; None to
+                                write WAV files.
+	:param Encryption encryption: encrypt the WAV files as they are written,
+                                to `name.wav.enc`; None to write them as is.
+	:param String encoding: `pcm` to write the audio as captured, or `pcm8`
+                                to write 8 bit samples, half as many bytes;
+                                chunked recordings are always written as
+                                captured.
 	"""
 	def __init__(self,
 		buf_before,
@@ -124,54 +324,199 @@ class InstanceRecorder(object):
 		bytes_per_sample=2,
 		dir=TOP_DIR,
 		file_prefix="recording-",
-		delete_active_recording=False):
+		delete_active_recording=False,
+		keep_audio=False,
+		finished_callback=None,
+		writer_pool=None,
+		provisional=False,
+		before_range=None,
+		trigger_label="hotword",
+		segment_seconds=None,
+		segment_bytes=None,
+		chunk_store=None,
+		encryption=None,
+		encoding="pcm"):
 		self.buf_before=buf_before
 		self.buf_after=buf_after
+		self.num_channels=num_channels
+		self.sample_rate=sample_rate
+		self.bytes_per_sample=bytes_per_sample
 		self._bytes_per_second=num_channels*sample_rate*bytes_per_sample
 		self._file_prefix=file_prefix
 		self._delete_active_recording=delete_active_recording
+		self._keep_audio=keep_audio
+		self._finished_callback=finished_callback
+		self.audio=[]
+		self._kept_bytes=0
+
+		# audio is converted to the encoding as it is written
+		if chunk_store is not None:
+			encoding="pcm"
+		if encoding=="pcm8" and audioop is None:
+			raise ImportError("audioop is needed to write 8 bit audio")
+		self.encoding=encoding
+		self.file_bytes_per_sample=1 if encoding=="pcm8" else bytes_per_sample
+
+		# where the hotwords are, as bytes captured in the back buffer when
+		# triggered and bytes captured in the forward buffer for continuations
+		self._trigger_total_length=buf_before.total_length()
+		self._trigger_label=trigger_label
+		held_from=self._trigger_total_length-buf_before.length()
+		if before_range is None:
+			before_range=(held_from, self._trigger_total_length)
+		before_range=(max(before_range[0], held_from), before_range[1])
+		self._before_range=before_range
+		self._continuations=[]
+		self.cues=[]
+
+		# writing is done by the pool once enough audio is buffered
+		self._writer_pool=writer_pool or WriterPool.shared()
+		self._write_threshold=min(self.WRITE_THRESHOLD*self._bytes_per_second,
+			buf_after.max_length()//2)
+		self._write_lock=threading.Lock()
+		self._started_writing=False
+		self._provisional=provisional
+		self._discarded=False
+		self.failed=False
+		self._dropped=0
+		self._before_dropped=0
 
 		self.clean_up = False
 		self._will_stop_capture=False
-		self._actual_before_length=buf_before.length()/self._bytes_per_second
-		self._desired_after_length=buf_after.max_length()/self._bytes_per_second
+		self._is_writing_interrupted = False
+		self._time_written = 0
+		before_length=max(0, min(before_range[1], self._trigger_total_length)-
+			before_range[0])
+		self._actual_before_length=float(before_length)/self._bytes_per_second
+		self._desired_after_length=float(buf_after.max_length())/self._bytes_per_second
 		self._desired_length=self._actual_before_length+self._desired_after_length
 		Log.debug(self._tag, "Will record for %d (%d before, %f after)" % (self._desired_length, self._actual_before_length, self._desired_after_length))
 
-		# File setup
-		self.filename =  "%s%d.wav" % (self._file_prefix, int(time.time()))
+		# File setup, the file is opened when writing starts
+		self._encryption = encryption
+		self._wav_suffix = ".wav" if encryption is None else \
+			".wav" + ENCRYPTED_SUFFIX
+		self.filename =  "%s%d%s" % (self._file_prefix, int(time.time()),
+			self._wav_suffix)
 		self.filepath = os.path.join(dir, self.filename)
-		self._file = wave.open(self.filepath, "w")
-		self._file.setnchannels(num_channels)
-		self._file.setframerate(sample_rate)
-		self._file.setsampwidth(bytes_per_sample)
+		self._file = None
+
+		# Segmented files are `name.000.wav`, `name.001.wav`... tied together
+		# by the manifest `name.json`, which is the recording's file
+		limits = [int(segment_seconds*self._bytes_per_second)
+			if segment_seconds else None, segment_bytes]
+		limits = [limit for limit in limits if limit]
+		bytes_per_frame = num_channels*bytes_per_sample
+		if len(limits) > 0 and chunk_store is None:
+			self._segment_bytes = max(bytes_per_frame,
+				min(limits) // bytes_per_frame * bytes_per_frame)
+			self._segment_base = self.filepath[:-len(self._wav_suffix)]
+			self.filename = os.path.basename(self._segment_base) + ".json"
+			self.filepath = self._segment_base + ".json"
+		else:
+			self._segment_bytes = None
+		self.segments = []
+		self._segment_written = 0
+		self._frames_written = 0
+
+		# Chunked recordings are a manifest `name.json` of ranges of chunks
+		self._chunk_store = chunk_store
+		if chunk_store is not None:
+			self.filename = "%s%d.json" % (self._file_prefix, int(time.time()))
+			self.filepath = os.path.join(dir, self.filename)
+			self._chunk_start = None
+			self._chunk_position = None
 
 	def start(self):
 		"""
-		Start writing the file from the buffers in a seperate thread.
+		Start writing the file from the buffers in the writer pool.
 		"""
-		self._thread = threading.Thread(target=self.run)
-		self._thread.daemon = True
-		self._thread.start()
+		self._writer_pool.schedule(self)
 
 	def stop_capture(self):
 		"""
 		Stop capturing audio once enough has been captured.
 		"""
 		self._will_stop_capture=True
-		captured_after_length=self.buf_after.total_length()/self._bytes_per_second
+		captured_after_length=float(self.buf_after.total_length())/self._bytes_per_second
 
-		while captured_after_length < self._desired_after_length:
+		while captured_after_length < self._desired_after_length and not self._discarded and not self.failed:
 			Log.warning(self._tag, "Will stop capture when captured enough data (%.2f/%.2f)" % (captured_after_length, self._desired_after_length))
 			time.sleep((self._desired_after_length-captured_after_length/10))
-			captured_after_length=self.buf_after.total_length()/self._bytes_per_second
+			captured_after_length=float(self.buf_after.total_length())/self._bytes_per_second
 
 		self.buf_after.stop_capture()
+		self._writer_pool.schedule(self)
 		Log.debug(self._tag, "Capture stopped with enough data (%.2f/%.2f)" % (captured_after_length, self._desired_after_length))
 
 	def capture_stopped(self):
 		"""Stopped extending the buffer with new data (or will stop)"""
-		return self._will_stop_capture or self._is_writing_interrupted
+		return self._will_stop_capture or self._is_writing_interrupted or self._discarded or self.failed
+
+	def commit(self):
+		"""
+		Start writing a provisional recording.
+		"""
+		self._provisional = False
+		self._writer_pool.schedule(self)
+
+	def is_discarded(self):
+		"""Was the provisional recording discarded?"""
+		return self._discarded
+
+	def discard(self):
+		"""
+		Drop a provisional recording without writing anything.
+		"""
+		Log.debug(self._tag, "Discarded %s" % self.filename)
+		self._discarded = True
+		self.buf_after.stop_capture()
+		self.buf_after.clear()
+		self.clean_up = True
+
+	def fail(self, error):
+		"""
+		Give up on a recording that couldn't be written, such as when the disk
+		is full, called from the writer pool. The file being written is closed
+		with what was written of it, or removed if it can't be or is a
+		segment, and the recorder is cleaned up without calling the finished
+		callback.
+
+		:param Exception error: why writing failed.
+		"""
+		with self._write_lock:
+			if self.clean_up:
+				return
+			self.failed = True
+			self.buf_after.stop_capture()
+			self.buf_after.clear()
+
+			# a segment cut short isn't in the manifest, so is removed
+			path = None
+			if self._segment_bytes is not None:
+				if self._file is not None:
+					self.segments.pop()
+				path = self._segment_path()
+			elif self._chunk_store is None:
+				path = self.filepath
+			if path is not None:
+				closed = False
+				if self._file is not None:
+					try:
+						self._file.close()
+						closed = self._segment_bytes is None
+					except Exception:
+						pass
+					self._file = None
+				if not closed:
+					try:
+						os.remove(path)
+					except OSError:
+						pass
+				mark_closed(path)
+			Log.error(self._tag, "Gave up writing %s after %.2f seconds of "
+				"audio: %s" % (self.filename, self._time_written, error))
+			self.clean_up = True
 
 	def extend_desired_length(self,desired_length):
 		"""
@@ -180,7 +525,9 @@ class InstanceRecorder(object):
 
 		:param int desired_length: new desired length
 		"""
-		captured_after_length=self.buf_after.total_length()/self._bytes_per_second
+		captured_after_total_length=self.buf_after.total_length()
+		self._continuations.append(captured_after_total_length)
+		captured_after_length=float(captured_after_total_length)/self._bytes_per_second
 		self._desired_after_length=captured_after_length+desired_length
 		new_desired_length=self._actual_before_length+self._desired_after_length
 		Log.debug(self._tag, "Extend designed length to %ds from now, from a total of %ds to %ds" % (desired_length, self._desired_length, new_desired_length))
@@ -188,8 +535,62 @@ class InstanceRecorder(object):
 		self._desired_length=new_desired_length
 
 	def extend(self, data):
-		"""Extend the forward buffer"""
-		return self.buf_after.extend(data)
+		"""Extend the forward buffer, writing once enough is buffered"""
+		if self.buf_after.capture_stopped():
+			# stopping capture scheduled the last write
+			return
+		self.buf_after.extend(data)
+		if not self._provisional and self.buf_after.length() >= self._write_threshold:
+			self._writer_pool.schedule(self)
+
+	def position(self):
+		"""Retrieves the seconds of audio captured so far, before and after the hotword"""
+		return self._actual_before_length+float(self.buf_after.total_length())/self._bytes_per_second
+
+	def trigger_position(self):
+		"""
+		Retrieves the position in the back buffer (see `RingBuffer.get_range`)
+		the recording was triggered at.
+		"""
+		return self._trigger_total_length
+
+	def files(self):
+		"""Retrieves the paths of the files written, with the manifest last"""
+		if self._chunk_store is not None:
+			directory = os.path.dirname(self.filepath)
+			paths = []
+			for chunk in self._chunk_ranges():
+				path = os.path.normpath(os.path.join(directory, chunk["file"]))
+				if path not in paths:
+					paths.append(path)
+			return paths + [self.filepath]
+		if self._segment_bytes is None:
+			return [self.filepath]
+		return [segment["path"] for segment in self.segments] + [self.filepath]
+
+	def memory_usage(self):
+		"""Retrieves the number of bytes of memory held by the forward buffer"""
+		return self.buf_after.memory_usage()
+
+	def lag(self):
+		"""Retrieves the seconds of audio captured but not yet written"""
+		return float(self.buf_after.length())/self._bytes_per_second
+
+	def backlog(self):
+		"""
+		Retrieves how far the writers are behind, as the fraction of the room in
+		the forward buffer beyond the write threshold that holds audio not yet
+		written: 0 while writing keeps up, 1 once audio is being dropped.
+		"""
+		if self._provisional:
+			return 0.0
+		room=self.buf_after.max_length()-self._write_threshold
+		waiting=self.buf_after.length()-self._write_threshold
+		return min(1.0, max(0.0, float(waiting)/max(1, room)))
+
+	def dropped(self):
+		"""Retrieves the bytes of audio dropped as the writers fell behind"""
+		return self.buf_after.dropped+self._before_dropped
 
 	def interrupt(self):
 		"""
@@ -197,48 +598,299 @@ class InstanceRecorder(object):
 		"""
 		Log.debug(self._tag, "Interrupt triggered")
 		self._is_writing_interrupted = True
-
-	def run(self):
+		self._writer_pool.schedule(self)
+
+	def _update_cues(self):
+		"""Work out where the hotword and each continuation hotword are"""
+		self.cues = [(self._trigger_offset, self._trigger_label)]
+		for continuation in self._continuations:
+			self.cues.append((self._before_bytes + continuation, "continue"))
+
+	def _open_file(self, filepath):
+		"""Open a WAV file, or an encrypted one, to write audio to"""
+		if self._encryption is None:
+			wav = wave.open(filepath, "w")
+		else:
+			wav = self._encryption.open(filepath)
+		wav.setnchannels(self.num_channels)
+		wav.setframerate(self.sample_rate)
+		wav.setsampwidth(self.file_bytes_per_sample)
+		return wav
+
+	def _encode(self, data):
+		"""Convert audio as captured to the encoding it is written in"""
+		if self.encoding == "pcm8":
+			# 8 bit WAV samples are unsigned
+			return audioop.bias(audioop.lin2lin(data, self.bytes_per_sample, 1),
+				1, 128)
+		return data
+
+	def _close_file(self, filepath, start=0, end=None):
 		"""
-		Start writing the file from the buffers in this thread.
+		Close the file, marking the hotword and each continuation hotword in
+		it, so they can be found without running detection again. Encrypted
+		files keep the cue points in their closing record.
+
+		:param String filepath: the file.
+		:param int start: byte offset into the recording the file starts at.
+		:param int end: byte offset into the recording the file ends at.
 		"""
-		self._is_writing_interrupted = False
+		self._update_cues()
+		bytes_per_frame = self.num_channels * self.bytes_per_sample
+		file_bytes_per_frame = self.num_channels * self.file_bytes_per_sample
+		cues = [((offset - start) // bytes_per_frame * file_bytes_per_frame,
+			label) for offset, label in self.cues
+			if offset >= start and (end is None or offset < end)]
+
+		if self._encryption is not None:
+			self._file.close(cues, self.encoding)
+			self._file = None
+			return
+		self._file.close()
+		self._file = None
 
-		# copy back buffer
-		buf_before = self.buf_before.get_copy()
-		self._buf_before_length=len(buf_before) / self._bytes_per_second
-		self._file.writeframes("".join(buf_before))
-		buf_before = None
-		self._time_written = self._buf_before_length
-		Log.debug(self._tag,
-			"Writen %.2f seconds from before the hotword" % self._buf_before_length)
+		try:
+			write_cue_chunks(filepath, cues, file_bytes_per_frame, self.encoding)
+		except (IOError, OSError) as e:
+			Log.error(self._tag, "Couldn't write cue points to %s: %s" % (os.path.basename(filepath), e))
+
+	def _write(self, data):
+		"""
+		Write audio to the file, or across segments, splitting it on the frame
+		that fills each segment so there are no gaps between them, or to the
+		chunk store.
+		"""
+		if self._chunk_store is not None:
+			self._chunk_store.write(self._chunk_position, data)
+			self._chunk_position += len(data)
+			return
+		if self._segment_bytes is None:
+			self._file.writeframes(self._encode(data))
+			return
+
+		view = memoryview(data)
+		while len(view) > 0:
+			if self._file is None:
+				self._open_segment()
+			part = view[:self._segment_bytes - self._segment_written]
+			self._file.writeframesraw(self._encode(part.tobytes()))
+			self._segment_written += len(part)
+			view = view[len(part):]
+			if self._segment_written == self._segment_bytes:
+				self._close_segment()
+
+	def _segment_path(self):
+		"""Retrieves the path of the next segment of a segmented recording"""
+		return "%s.%03d%s" % (self._segment_base, len(self.segments),
+			self._wav_suffix)
+
+	def _open_segment(self):
+		"""Open the next segment of a segmented recording"""
+		path = self._segment_path()
+		mark_open(path, self.filepath, self._frames_written)
+		self._file = self._open_file(path)
+		self._segment_written = 0
+		self.segments.append({"file": os.path.basename(path), "path": path,
+			"start_frame": self._frames_written, "frames": 0})
+
+	def _close_segment(self):
+		"""Close the current segment, then add it to the manifest"""
+		bytes_per_frame = self.num_channels * self.bytes_per_sample
+		segment = self.segments[-1]
+		segment["frames"] = self._segment_written // bytes_per_frame
+		self._frames_written += segment["frames"]
+		start = segment["start_frame"] * bytes_per_frame
+		self._close_file(segment["path"], start, start + self._segment_written)
+		self._write_manifest(complete=False)
+		mark_closed(segment["path"])
+		Log.debug(self._tag, "Closed segment %s" % segment["file"])
+
+	def _write_manifest(self, complete):
+		"""
+		Write the manifest listing the closed segments and where the hotwords
+		are, replacing the last one in one step.
+		"""
+		bytes_per_frame = self.num_channels * self.bytes_per_sample
+		manifest = {
+			"channels": self.num_channels,
+			"sample_rate": self.sample_rate,
+			"bytes_per_sample": self.file_bytes_per_sample,
+			"encoding": self.encoding,
+			"complete": complete,
+			"cues": [{"frame": offset // bytes_per_frame, "label": label}
+				for offset, label in self.cues],
+		}
+		if self._chunk_store is None:
+			manifest["segments"] = [{"file": segment["file"],
+				"start_frame": segment["start_frame"],
+				"frames": segment["frames"]}
+				for segment in self.segments if segment["frames"] > 0]
+		else:
+			manifest["session"] = self._chunk_store.session
+			manifest["chunks"] = self._chunk_ranges()
+		tmp = self.filepath + ".tmp"
+		try:
+			with open(tmp, "w") as f:
+				json.dump(manifest, f, indent=4, sort_keys=True)
+			os.rename(tmp, self.filepath)
+		except (IOError, OSError) as e:
+			Log.error(self._tag, "Couldn't write manifest %s: %s" % (self.filename, e))
+
+	def write_pending(self):
+		"""
+		Write the audio buffered so far, called from the writer pool. The first
+		call writes the back buffer, and the file is finished once capture has
+		stopped and everything buffered has been written.
+		"""
+		with self._write_lock:
+			if self.clean_up:
+				return
+			elif self._provisional:
+				if self._is_writing_interrupted:
+					self.discard()
+				return
+
+			if not self._started_writing:
+				self._started_writing = True
+				self._write_before()
 
-		# copy forward buffer
-		while True:
 			if self._is_writing_interrupted:
 				Log.debug(self._tag, "Interrupt detected")
-				break
-
-			bytes = self.buf_after.get()
-			self._file.writeframes("".join(bytes))
-
-			additional_time_written = (len(bytes) / self._bytes_per_second)
+				self._finish()
+				return
+
+			started = Profiler.start_timer()
+			if self._chunk_store is None:
+				data = self.buf_after.get()
+				if self.buf_after.dropped > self._dropped:
+					Log.error(self._tag, "Lost %d bytes of %s, the writers fell "
+						"behind" % (self.buf_after.dropped - self._dropped,
+						self.filename))
+					self._dropped = self.buf_after.dropped
+			else:
+				data = self._read_after()
+			if len(data) > 0:
+				self._write(data)
+				self._keep(data)
+			Profiler.stop_timer("writer", started)
+
+			additional_time_written = float(len(data)) / self._bytes_per_second
 			Log.debug(self._tag, "Written %.2f seconds" % additional_time_written)
 			self._time_written += additional_time_written
 
 			if self.buf_after.capture_stopped() and self.buf_after.length() == 0:
-				break
+				if self._chunk_store is not None and \
+					self._chunk_position < self._chunk_end():
+					# the back buffer is extended just after the forward one
+					self._writer_pool.schedule(self)
+					return
+				self._finish()
+
+	def _chunk_end(self):
+		"""Retrieves the position of the end of the audio captured so far"""
+		return self._before_range[1] + self.buf_after.total_length()
+
+	def _chunk_ranges(self):
+		"""Retrieves the chunk ranges of the audio written so far"""
+		if self._chunk_start is None:
+			return []
+		return self._chunk_store.ranges(self._chunk_start,
+			self._chunk_position, os.path.dirname(self.filepath))
+
+	def _read_after(self):
+		"""
+		Read the audio captured since it was last read from the back buffer,
+		by position, emptying the forward buffer, which only counts it.
+		"""
+		self.buf_after.clear()
+		end = min(self._chunk_end(), self.buf_before.total_length())
+		data = self.buf_before.get_range(self._chunk_position, end)
+		if len(data) < end - self._chunk_position:
+			Log.error(self._tag, "Lost %d bytes of %s, the back buffer was "
+				"overwritten before they were written" %
+				(end - self._chunk_position - len(data), self.filename))
+			self._chunk_position = end - len(data)
+		return data
+
+	def _write_before(self):
+		"""
+		Open the file and write the audio from before the hotword.
+		"""
+		if self._segment_bytes is None and self._chunk_store is None:
+			mark_open(self.filepath)
+			self._file = self._open_file(self.filepath)
+
+		# the range is fixed when triggered, however long writing waited
+		before_start = self._before_range[0]
+		before_end = min(self._before_range[1],
+			self.buf_before.total_length())
+		buf_before = self.buf_before.get_range(before_start, before_end)
+		if len(buf_before) < before_end - before_start:
+			self._before_dropped = before_end - before_start - len(buf_before)
+			Log.error(self._tag, "Lost %d bytes of %s, the back buffer was "
+				"overwritten before they were written" % (self._before_dropped,
+				self.filename))
+		self._buf_before_length=float(len(buf_before)) / self._bytes_per_second
+		self._before_bytes=len(buf_before)
+		self._trigger_offset=min(self._before_bytes, max(0, self._before_bytes -
+			(before_end - self._trigger_total_length)))
+		if self._chunk_store is not None:
+			self._chunk_start = self._chunk_position = before_end - len(buf_before)
+		self._write(buf_before)
+		self._keep(buf_before)
+		if self._chunk_store is not None:
+			# so the session's chunks aren't pruned if the power is cut
+			self._update_cues()
+			self._write_manifest(complete=False)
+		buf_before = None
+		self._time_written = self._buf_before_length
+		Log.debug(self._tag,
+			"Writen %.2f seconds from before the hotword" % self._buf_before_length)
 
-			time.sleep(3)
+	def _keep(self, data):
+		"""
+		Keep audio written in memory, if asked to, until the recording grows
+		longer than `KEEP_AUDIO_LIMIT` seconds, then let it go.
+		"""
+		if not self._keep_audio or self.audio is None:
+			return
+		self._kept_bytes+=len(data)
+		if self._kept_bytes > self.KEEP_AUDIO_LIMIT*self._bytes_per_second:
+			Log.debug(self._tag, "%s is longer than %d seconds, no longer "
+				"keeping its audio" % (self.filename, self.KEEP_AUDIO_LIMIT))
+			self.audio=None
+		else:
+			self.audio.append(data)
 
-		self._file.close()
+	def _finish(self):
+		"""
+		Close the file, then delete it if it was interrupted or let the
+		finished callback know about it.
+		"""
+		if self._chunk_store is not None:
+			self._update_cues()
+			self._write_manifest(complete=True)
+		elif self._segment_bytes is None:
+			self._close_file(self.filepath)
+			mark_closed(self.filepath)
+		else:
+			if self._file is not None:
+				self._close_segment()
+			self._update_cues()
+			self._write_manifest(complete=True)
 
 		if self._is_writing_interrupted and self._delete_active_recording:
 			try:
-				os.remove(self.filepath)
+				# chunks may be shared with other recordings, so are kept
+				for filepath in self.files()[-1:] if self._chunk_store \
+					is not None else self.files():
+					os.remove(filepath)
 				Log.debug(self._tag, "Writing of %s interrupted after %.2f seconds of audio so file was deleted" % (self.filename, self._time_written))
 			except OSError:
 				Log.error(self._tag, "Writing of %s interrupted after %.2f seconds of audio, but COULDNT DELETE" % (self.filename, self._time_written))
 		else:
 			Log.debug(self._tag, "Written %.2f seconds of audio in %s" % (self._time_written, self.filename))
-			self.clean_up = True
+			if self._finished_callback is not None:
+				self._finished_callback(self)
+
+		self.clean_up = True
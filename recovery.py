@@ -0,0 +1,251 @@
+import os, sys, argparse, json, struct
+import threading
+
+from log import Log
+from encryption import ENCRYPTED_SUFFIX, repair as repair_encrypted
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+OPEN_MARKER = ".open"
+WAV_HEADER_SIZE = 44
+RECOVERY_THREADS = 2
+
+def mark_open(path, manifest=None, start_frame=None):
+    """
+    Leave a marker next to a WAV file while it is written, so a file left
+    unfinished by a power cut can be found and repaired by `Recovery`.
+
+    :param String path: the WAV file.
+    :param String manifest: path of the manifest the file is a segment of.
+    :param int start_frame: frame of the recording the segment starts at.
+    :return: None
+    """
+    marker = {}
+    if manifest is not None:
+        marker = {"manifest": os.path.basename(manifest),
+            "start_frame": start_frame}
+    with open(path + OPEN_MARKER, "w") as f:
+        json.dump(marker, f)
+
+def mark_closed(path):
+    """
+    Remove the marker of a WAV file once it has been finished.
+
+    :param String path: the WAV file.
+    :return: None
+    """
+    try:
+        os.remove(path + OPEN_MARKER)
+    except OSError:
+        pass
+
+def repair(path):
+    """
+    Correct the RIFF and data sizes in the header of a WAV file to match the
+    audio that reached the disk, in place. Audio written after the header was
+    last updated is kept, up to the last whole frame, and chunks after the
+    audio that were cut short, such as cue points, are dropped.
+
+    :param String path: the WAV file.
+    :return: int number of frames of audio in the repaired file.
+    """
+    size = os.path.getsize(path)
+    with open(path, "r+b") as f:
+        riff, riff_size, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise ValueError("%s is not a WAV file" % path)
+
+        # walk the chunks to the audio
+        block_align = None
+        position = 12
+        while position + 8 <= size:
+            f.seek(position)
+            chunk_id, length = struct.unpack("<4sI", f.read(8))
+            if chunk_id == b"fmt ":
+                block_align = struct.unpack("<HHIIH", f.read(14))[4]
+            elif chunk_id == b"data":
+                break
+            position += 8 + length + length % 2
+        else:
+            raise ValueError("%s has no audio" % path)
+        if block_align is None or block_align == 0:
+            raise ValueError("%s has no format" % path)
+
+        data_start = position + 8
+        available = size - data_start
+        end = data_start + length + length % 2
+        f.seek(end)
+        following = f.read(4)
+        if length <= available and (end >= size or
+            following in (b"cue ", b"LIST")):
+            # the audio is all there, keep whole chunks after it
+            while end + 8 <= size:
+                f.seek(end)
+                chunk_length = struct.unpack("<4sI", f.read(8))[1]
+                if end + 8 + chunk_length > size:
+                    break
+                end += 8 + chunk_length + chunk_length % 2
+            end = min(end, size)
+        else:
+            length = available // block_align * block_align
+            end = data_start + length
+
+        f.truncate(end)
+        f.seek(4)
+        f.write(struct.pack("<I", end - 8))
+        f.seek(data_start - 4)
+        f.write(struct.pack("<I", length))
+    return length // block_align
+
+class Recovery(object):
+    _tag = "recovery"
+
+    """
+    Repairs recordings left unfinished by a power cut, found by the markers
+    `InstanceRecorder` leaves next to files while they are written. Each file
+    has its header corrected in place by `repair`, without rewriting the
+    audio, or is cut back to its last whole record if it is encrypted, or is
+    removed if it is too short to hold a header, and a segment missing from
+    its recording's manifest is added to it. The output
+    directories are scanned when created, before anything new is recorded,
+    and the files are repaired by a pool of low priority threads in the
+    background, so detection can start straight away.
+
+    :param list dirs: directories to look for unfinished recordings in.
+    :param int workers: number of threads to repair files with.
+    :param int niceness: how much to lower the priority of the workers.
+    """
+    def __init__(self, dirs, workers=RECOVERY_THREADS, niceness=10):
+        self.repaired = 0
+        self.failed = 0
+        self._niceness = niceness
+        self._lock = threading.Lock()
+
+        self._queue = queue.Queue()
+        for directory in dirs:
+            for filename in sorted(os.listdir(directory)):
+                if filename.endswith(OPEN_MARKER):
+                    self._queue.put(os.path.join(directory,
+                        filename[:-len(OPEN_MARKER)]))
+        found = self._queue.qsize()
+
+        self._threads = []
+        for i in range(min(workers, found)):
+            thread = threading.Thread(target=self._work,
+                name="recovery-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        Log.info(self._tag, "Found %d unfinished recordings" % found)
+
+    def wait(self):
+        """
+        Wait for every unfinished recording found to be repaired.
+
+        :return: None
+        """
+        for thread in self._threads:
+            thread.join()
+        Log.debug(self._tag, "Recovery finished (%d repaired, %d failed)" %
+            (self.repaired, self.failed))
+
+    def recover(self, path):
+        """
+        Repair an unfinished recording and remove its marker.
+
+        :param String path: the WAV file.
+        :return: None
+        """
+        with open(path + OPEN_MARKER, "r") as f:
+            try:
+                marker = json.load(f)
+            except ValueError:
+                marker = {}
+
+        if os.path.exists(path) and not path.endswith(ENCRYPTED_SUFFIX) and \
+            os.path.getsize(path) < WAV_HEADER_SIZE:
+            # nothing was written before the power cut, not even the header
+            os.remove(path)
+            Log.info(self._tag, "Removed empty %s" % os.path.basename(path))
+        elif os.path.exists(path):
+            if path.endswith(ENCRYPTED_SUFFIX):
+                frames = repair_encrypted(path)
+            else:
+                frames = repair(path)
+            if marker.get("manifest") is not None:
+                self._add_segment(path, marker, frames)
+            Log.info(self._tag, "Repaired %s (%d frames)" %
+                (os.path.basename(path), frames))
+        mark_closed(path)
+
+    def _add_segment(self, path, marker, frames):
+        """Add a repaired segment to its recording's manifest, if missing"""
+        manifest_path = os.path.join(os.path.dirname(path), marker["manifest"])
+        try:
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            Log.warning(self._tag, "Couldn't read %s to add %s to it" %
+                (marker["manifest"], os.path.basename(path)))
+            return
+
+        segments = manifest.setdefault("segments", [])
+        if os.path.basename(path) in [segment["file"] for segment in segments]:
+            return
+        segments.append({"file": os.path.basename(path),
+            "start_frame": marker["start_frame"], "frames": frames})
+        segments.sort(key=lambda segment: segment["start_frame"])
+        manifest["recovered"] = True
+
+        tmp = manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        os.rename(tmp, manifest_path)
+
+    def _work(self):
+        """Repair recordings from the queue until it is empty"""
+        self._lower_priority()
+        while True:
+            try:
+                path = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            try:
+                self.recover(path)
+                with self._lock:
+                    self.repaired += 1
+            except Exception as e:
+                Log.error(self._tag, "Couldn't repair %s: %s" %
+                    (os.path.basename(path), e))
+                with self._lock:
+                    self.failed += 1
+
+    def _lower_priority(self):
+        """Lower the scheduling priority of the calling thread, where possible"""
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(),
+                self._niceness)
+        except (AttributeError, OSError):
+            Log.debug(self._tag, "Could not lower recovery priority")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Repair recordings left unfinished by a power cut.")
+    parser.add_argument("dirs",
+        help="Output directories of the CVR.",
+        nargs="+")
+    parser.add_argument("--threads",
+        help="Number of threads to repair files with. Default is %d." % RECOVERY_THREADS,
+        default=RECOVERY_THREADS,
+        type=int)
+    args = parser.parse_args()
+
+    Log.init(Log.INFO)
+    recovery = Recovery(args.dirs, workers=args.threads)
+    recovery.wait()
+    sys.exit(1 if recovery.failed > 0 else 0)
@@ -0,0 +1,220 @@
+import os, sys, argparse, time, shutil, tempfile
+
+from log import Log
+from memory import MemoryReport
+from recorder import *
+from preroll import PREROLL_MARGIN
+
+class SoakTest(object):
+    _tag = "soak"
+
+    """
+    Replay hours of synthetic audio and hotword triggers through the buffers
+    and recorders faster than real time, checking memory settles rather than
+    growing with the number of recordings.
+
+    :param float hours: hours of audio to replay.
+    :param float speed: how many times faster than real time to replay.
+    :param float trigger_every: seconds of audio between triggers.
+    :param int record_before: seconds to record before each trigger.
+    :param int record_after: seconds to record after each trigger.
+    :param int frames_per_buffer: frames per simulated callback.
+    :param float tolerance: fraction memory may grow by after warming up.
+    :param String output_dir: directory for the recordings, which are deleted
+                                as they finish; a temporary directory if None.
+    """
+    def __init__(self,
+        hours=6,
+        speed=500,
+        trigger_every=45,
+        record_before=10,
+        record_after=10,
+        frames_per_buffer=2048,
+        tolerance=0.1,
+        output_dir=None):
+        self._hours = hours
+        self._speed = speed
+        self._trigger_every = trigger_every
+        self._record_before = record_before
+        self._record_after = record_after
+        self._frames_per_buffer = frames_per_buffer
+        self._tolerance = tolerance
+        self._output_dir = output_dir
+
+        self.samples = []
+
+    def run(self):
+        """
+        Replay the audio and triggers.
+
+        :return: Boolean, True if memory stayed bounded.
+        """
+        num_channels, sample_rate, bytes_per_sample = 1, 16000, 2
+        chunk_time = float(self._frames_per_buffer) / sample_rate
+        chunk = b"\x01\x02" * self._frames_per_buffer
+        total_chunks = int(self._hours * 3600 / chunk_time)
+        chunks_per_trigger = int(self._trigger_every / chunk_time)
+        chunks_per_sample = max(1, total_chunks // 40)
+
+        output_dir = self._output_dir or tempfile.mkdtemp(prefix="cvr-soak-")
+
+        detector_buffer = DetectorRingBuffer(
+            num_channels * sample_rate * bytes_per_sample * 5)
+        # as in AudioHandler, the back buffer holds a margin for the writers
+        backward_buffer = BackwardBuffer(
+            num_channels=num_channels,
+            sample_rate=sample_rate,
+            bytes_per_sample=bytes_per_sample,
+            record_for=self._record_before + PREROLL_MARGIN)
+        record_before_bytes = num_channels * sample_rate * bytes_per_sample * \
+            self._record_before
+        recorders = RecorderList()
+        stops = []
+        finished = []
+
+        def recording_finished(instance_recorder):
+            finished.append(instance_recorder.filename)
+            try:
+                os.remove(instance_recorder.filepath)
+            except OSError:
+                pass
+
+        Log.info(self._tag, "Replaying %.1f hours at %dx with a trigger every "
+            "%ds" % (self._hours, self._speed, self._trigger_every))
+
+        started = time.time()
+        for i in range(total_chunks):
+            recorders.extend(chunk)
+            detector_buffer.extend(chunk)
+            backward_buffer.extend(chunk)
+
+            if i % 8 == 0:
+                detector_buffer.get()
+
+            if i > 0 and i % chunks_per_trigger == 0:
+                last_recorder = recorders.last()
+                if last_recorder is not None and \
+                    not last_recorder.capture_stopped() and \
+                    (i // chunks_per_trigger) % 3 == 0:
+                    last_recorder.extend_desired_length(self._record_after)
+                else:
+                    trigger = backward_buffer.total_length()
+                    last_recorder = InstanceRecorder(
+                        buf_before=backward_buffer,
+                        buf_after=ForwardBuffer(
+                            num_channels=num_channels,
+                            sample_rate=sample_rate,
+                            bytes_per_sample=bytes_per_sample,
+                            record_for=self._record_after),
+                        num_channels=num_channels,
+                        sample_rate=sample_rate,
+                        bytes_per_sample=bytes_per_sample,
+                        dir=output_dir,
+                        file_prefix="soak-%d-" % i,
+                        finished_callback=recording_finished,
+                        before_range=(max(0, trigger - record_before_bytes),
+                            trigger))
+                    recorders.append(last_recorder)
+                    last_recorder.start()
+                stops = [s for s in stops if s[1] is not last_recorder]
+                stops.append((i + int(self._record_after / chunk_time) + 1,
+                    last_recorder))
+
+            while len(stops) > 0 and stops[0][0] <= i:
+                stops.pop(0)[1].stop_capture()
+
+            if i % chunks_per_sample == 0:
+                self._sample(i * chunk_time, recorders, detector_buffer,
+                    backward_buffer)
+
+            # pace the replay so the writers keep up
+            behind = (i + 1) * chunk_time / self._speed - \
+                (time.time() - started)
+            if behind > 0:
+                time.sleep(behind)
+
+        live = recorders.recorders()
+        recorders.interrupt()
+        while not all(r.clean_up for r in live):
+            time.sleep(0.1)
+        if self._output_dir is None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+        Log.info(self._tag, "Replayed %d recordings in %.1f seconds" %
+            (len(finished), time.time() - started))
+        return self._check()
+
+    def _sample(self, audio_time, recorders, detector_buffer, backward_buffer):
+        """Record memory in use at a point in the replay"""
+        live = recorders.recorders()
+        buffers = detector_buffer.memory_usage() + \
+            backward_buffer.memory_usage() + \
+            sum(r.memory_usage() for r in live)
+        usage = MemoryReport.process_usage()
+        self.samples.append((audio_time, usage, buffers, len(live)))
+        Log.info(self._tag, "%.2f hours: %d bytes in use, %d bytes in buffers, "
+            "%d live recorders" % (audio_time / 3600, usage, buffers, len(live)))
+
+    def _check(self):
+        """
+        Compare memory in use over the last quarter of the replay with the
+        second quarter, once warmed up.
+
+        :return: Boolean, True if memory stayed within tolerance.
+        """
+        quarter = len(self.samples) // 4
+        if quarter == 0:
+            Log.error(self._tag, "Replay too short to compare memory use")
+            return False
+
+        warm = max(s[1] for s in self.samples[quarter:2 * quarter])
+        end = max(s[1] for s in self.samples[-quarter:])
+        allowed = warm * (1 + self._tolerance) + 1024 * 1024
+        if end > allowed:
+            Log.error(self._tag, "Memory grew from %d to %d bytes (allowed %d)" %
+                (warm, end, allowed))
+            return False
+
+        Log.info(self._tag, "Memory bounded, %d bytes warm and %d bytes at end" %
+            (warm, end))
+        return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay synthetic triggers and fail if memory grows without bound.")
+    parser.add_argument("--log",
+        help="Minimum level of log output.",
+        choices={"DEBUG","INFO","WARNING","ERROR","CRITICAL"},
+        default="INFO")
+    parser.add_argument("--hours",
+        help="Hours of audio to replay. Default is 6.",
+        default=6,
+        type=float)
+    parser.add_argument("--speed",
+        help="How many times faster than real time to replay. Default is 500.",
+        default=500,
+        type=float)
+    parser.add_argument("--trigger-every",
+        help="Seconds of audio between triggers. Default is 45.",
+        dest='trigger_every',
+        default=45,
+        type=float)
+    parser.add_argument("--tolerance",
+        help="Fraction memory may grow by after warming up. Default is 0.1.",
+        default=0.1,
+        type=float)
+    parser.add_argument("--trace-memory",
+        help="Measure memory allocated by Python rather than the peak resident size.",
+        dest='trace_memory',
+        action='store_true')
+    args = parser.parse_args()
+
+    Log.init(getattr(Log,args.log))
+    if args.trace_memory:
+        MemoryReport.start_tracing()
+
+    soak = SoakTest(hours=args.hours,
+        speed=args.speed,
+        trigger_every=args.trigger_every,
+        tolerance=args.tolerance)
+    sys.exit(0 if soak.run() else 1)
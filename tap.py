@@ -0,0 +1,404 @@
+import os, sys, argparse, json, stat, struct, socket, time, wave
+import threading
+
+from log import Log
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+TAP_SOCKET = "/tmp/cvr-tap"
+TAP_PREROLL = 2
+TAP_MAX_LAG = 2
+
+# kind (`S`tart, `A`udio or `E`nd), stream, length of the payload
+MESSAGE = struct.Struct("<cII")
+
+class TapStream(object):
+    """
+    Triggered audio being streamed to the tap's subscribers, read from the
+    back buffer of the device it was heard on by position.
+
+    :param int id: number of the stream, unique to the tap.
+    :param AudioHandler audio_handler: the device's handler.
+    :param InstanceRecorder instance_recorder: the recording triggered.
+    :param int start: position in the back buffer to stream from.
+    """
+    def __init__(self, id, audio_handler, instance_recorder, start):
+        self.id = id
+        self.ring = audio_handler.backward_buffer
+        self.instance_recorder = instance_recorder
+        self.start = start
+        self.bytes_per_frame = instance_recorder.num_channels * \
+            instance_recorder.bytes_per_sample
+        self.bytes_per_second = self.bytes_per_frame * \
+            instance_recorder.sample_rate
+        self.header = {
+            "stream": id,
+            "device": audio_handler.name,
+            "recording": instance_recorder.filename,
+            "channels": instance_recorder.num_channels,
+            "sample_rate": instance_recorder.sample_rate,
+            "bytes_per_sample": instance_recorder.bytes_per_sample,
+            "preroll": float(instance_recorder.trigger_position() - start) /
+                self.bytes_per_second,
+        }
+
+    def end(self):
+        """
+        Retrieves the position the stream ends at, or None while the recording
+        is still capturing.
+        """
+        instance_recorder = self.instance_recorder
+        if instance_recorder.buf_after.capture_stopped():
+            return instance_recorder.trigger_position() + \
+                instance_recorder.buf_after.total_length()
+        if instance_recorder.is_discarded() or instance_recorder.clean_up:
+            return self.ring.total_length()
+        return None
+
+class Tap(object):
+    _tag = "tap"
+
+    """
+    Live tap of triggered audio, for a local service such as speech
+    recognition to hear what follows a hotword as it is said, rather than
+    once the recording has been written. Subscribers connect to a Unix socket,
+    only open to the user running the CVR, or a TCP port on localhost, and whenever a recording starts each is sent
+    the `preroll` seconds before the trigger, then the audio as it is
+    captured until the recording stops.
+
+    The audio isn't copied for each subscriber: each keeps its position in
+    the device's back buffer, the ring of recent audio, and its own thread
+    reads from there and sends whatever is new as soon as the audio callback
+    wakes it. The callback never waits on a subscriber; one that falls more
+    than `max_lag` seconds behind, or whose audio has left the ring, is
+    dropped and disconnected. `lags` gives how far behind each subscriber is.
+
+    Each message is a header of a kind, `S`, `A` or `E`, a stream number and
+    the length of the payload (`MESSAGE`), followed by the payload: for `S`
+    a JSON object of the device, recording, audio format and seconds of
+    pre-roll; for `A` raw audio as captured; for `E` a JSON object of the
+    number of frames sent. `python tap.py` subscribes and saves each stream.
+
+    :param String address: path of the Unix socket, or `[host:]port` to
+                                listen on TCP, localhost if no host is given.
+    :param float preroll: seconds before the trigger to send.
+    :param float max_lag: seconds a subscriber may fall behind before it is
+                                dropped.
+    :param float send_timeout: seconds a send may block before the
+                                subscriber is dropped.
+    """
+    def __init__(self,
+        address=TAP_SOCKET,
+        preroll=TAP_PREROLL,
+        max_lag=TAP_MAX_LAG,
+        send_timeout=1.0):
+        self.address = address
+        self.dropped = 0
+        self._preroll = preroll
+        self._max_lag = max_lag
+        self._send_timeout = send_timeout
+        self._streams = []
+        self._next_stream = 0
+        self._subscribers = {}
+        self._next_subscriber = 0
+        self._lock = threading.Lock()
+        self._published = threading.Condition(threading.Lock())
+        self._generation = 0
+        self._is_terminated = False
+
+        tap = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                tap._serve(self.request, self.client_address)
+
+        host, port = _parse_address(address)
+        if port is None:
+            # only replace a socket left behind, never some other file
+            if os.path.exists(address):
+                if not stat.S_ISSOCK(os.stat(address).st_mode):
+                    raise ValueError("%s exists and isn't a socket" % address)
+                os.remove(address)
+            # the audio is only for this user, so nobody else can connect
+            # before the socket starts listening
+            self._server = socketserver.ThreadingUnixStreamServer(address,
+                Handler, bind_and_activate=False)
+            self._server.server_bind()
+            os.chmod(address, 0o600)
+            self._server.server_activate()
+        else:
+            socketserver.ThreadingTCPServer.allow_reuse_address = True
+            self._server = socketserver.ThreadingTCPServer((host, port),
+                Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="tap")
+        self._thread.daemon = True
+        self._thread.start()
+
+        Log.info(self._tag, "Tap listening on %s" % address)
+
+    def open_stream(self, audio_handler, instance_recorder):
+        """
+        Start streaming a recording to the subscribers, from `preroll`
+        seconds before its trigger. Nothing is streamed if there are no
+        subscribers, as only streams still live are joined.
+
+        :param AudioHandler audio_handler: the device it was heard on.
+        :param InstanceRecorder instance_recorder: the recording.
+        :return: None
+        """
+        if len(self._subscribers) == 0:
+            return
+        ring = audio_handler.backward_buffer
+        bytes_per_frame = instance_recorder.num_channels * \
+            instance_recorder.bytes_per_sample
+        start = max(ring.total_length() - ring.length(),
+            instance_recorder.trigger_position() - int(self._preroll *
+            instance_recorder.sample_rate) * bytes_per_frame)
+        with self._lock:
+            self._prune()
+            stream = TapStream(self._next_stream, audio_handler,
+                instance_recorder, start)
+            self._next_stream += 1
+            self._streams.append(stream)
+        Log.debug(self._tag, "Streaming %s to %d subscribers" %
+            (instance_recorder.filename, len(self._subscribers)))
+        self.publish()
+
+    def publish(self):
+        """
+        Wake the subscribers to send any new audio, called from the audio
+        callback once the back buffer has been extended, once finished
+        streams have been dropped.
+
+        :return: None
+        """
+        if len(self._streams) == 0:
+            return
+        with self._lock:
+            self._prune()
+        if len(self._streams) > 0:
+            with self._published:
+                self._generation += 1
+                self._published.notify_all()
+
+    def lags(self):
+        """
+        Retrieves how far behind each subscriber is.
+
+        :return: dict of each subscriber's name to the seconds of audio
+                                captured but not yet sent to it.
+        """
+        with self._lock:
+            return dict((name, subscriber["lag"])
+                for name, subscriber in self._subscribers.items())
+
+    def report(self):
+        """
+        Log how far behind each subscriber is.
+
+        :return: None
+        """
+        lags = self.lags()
+        Log.info(self._tag, "%d subscribers%s, %d dropped" % (len(lags),
+            "".join(", %s %.2fs behind" % (name, lags[name])
+            for name in sorted(lags)), self.dropped))
+
+    def terminate(self):
+        """
+        Disconnect the subscribers, stop listening and remove the socket.
+
+        :return: None
+        """
+        self._is_terminated = True
+        with self._published:
+            self._published.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if _parse_address(self.address)[1] is None:
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+        Log.debug(self._tag, "Tap terminated")
+
+    def _serve(self, connection, client_address):
+        """Send the streams to a subscriber until it disconnects or lags"""
+        with self._lock:
+            if isinstance(client_address, tuple):
+                name = "%s:%d" % client_address[:2]
+            else:
+                name = "subscriber-%d" % self._next_subscriber
+            self._next_subscriber += 1
+            subscriber = {"lag": 0.0, "positions": {}, "done": set()}
+            self._subscribers[name] = subscriber
+        Log.info(self._tag, "%s subscribed" % name)
+
+        connection.settimeout(self._send_timeout)
+        seen = None
+        try:
+            while not self._is_terminated:
+                with self._published:
+                    if self._generation == seen:
+                        self._published.wait(0.5)
+                    seen = self._generation
+                if not self._send(connection, name, subscriber):
+                    break
+        except socket.timeout:
+            self._drop(name, "a send took over %.2f seconds" %
+                self._send_timeout)
+        except socket.error as e:
+            Log.info(self._tag, "%s disconnected: %s" % (name, e))
+        finally:
+            with self._lock:
+                del self._subscribers[name]
+        Log.info(self._tag, "%s unsubscribed" % name)
+
+    def _send(self, connection, name, subscriber):
+        """
+        Send a subscriber whatever is new in each stream.
+
+        :return: Boolean, False if the subscriber was dropped.
+        """
+        with self._lock:
+            streams = list(self._streams)
+
+        lag = 0.0
+        for stream in streams:
+            if stream.id in subscriber["done"]:
+                continue
+            end = stream.end()
+            total = stream.ring.total_length()
+            position = subscriber["positions"].get(stream.id)
+            if position is None:
+                if end is not None:
+                    # only streams still live are joined
+                    subscriber["done"].add(stream.id)
+                    continue
+                position = max(stream.start, total - stream.ring.length())
+                _send_message(connection, b"S", stream.id,
+                    json.dumps(stream.header).encode("utf-8"))
+
+            if position < total - stream.ring.length():
+                self._drop(name, "its audio has left the ring")
+                return False
+
+            data = stream.ring.get_range(position, total if end is None else
+                min(end, total))
+            if len(data) > 0:
+                _send_message(connection, b"A", stream.id, data)
+                position += len(data)
+            subscriber["positions"][stream.id] = position
+
+            if end is not None and position >= end:
+                _send_message(connection, b"E", stream.id, json.dumps({
+                    "frames": (position - stream.start) //
+                    stream.bytes_per_frame}).encode("utf-8"))
+                subscriber["done"].add(stream.id)
+                del subscriber["positions"][stream.id]
+                continue
+
+            # audio captured while sending is what it is behind by
+            behind = float(stream.ring.total_length() - position) / \
+                stream.bytes_per_second
+            if behind > self._max_lag:
+                self._drop(name, "%.2f seconds behind" % behind)
+                return False
+            lag = max(lag, behind)
+        subscriber["lag"] = lag
+
+        with self._lock:
+            self._prune()
+        return True
+
+    def _prune(self):
+        """
+        Drop finished streams no subscriber is still sending, called holding
+        the lock.
+        """
+        self._streams = [stream for stream in self._streams
+            if stream.end() is None or any(stream.id in subscriber["positions"]
+            for subscriber in self._subscribers.values())]
+
+    def _drop(self, name, reason):
+        """Log and count dropping a subscriber"""
+        Log.warning(self._tag, "Dropped %s, %s" % (name, reason))
+        with self._lock:
+            self.dropped += 1
+
+def _send_message(connection, kind, stream, payload):
+    """Send a message, its header and payload"""
+    connection.sendall(MESSAGE.pack(kind, stream, len(payload)) + payload)
+
+def _parse_address(address):
+    """
+    Retrieves the host and port of a TCP address, or None for the port of a
+    Unix socket path.
+    """
+    host, separator, port = str(address).rpartition(":")
+    if port.isdigit() and "/" not in address:
+        return host or "127.0.0.1", int(port)
+    return None, None
+
+def _receive(connection, length):
+    """Receive exactly `length` bytes, or None if the connection closed"""
+    data = b""
+    while len(data) < length:
+        part = connection.recv(length - len(data))
+        if len(part) == 0:
+            return None
+        data += part
+    return data
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Subscribe to a CVR's live tap, saving each stream of triggered audio to a WAV file.")
+    parser.add_argument("address",
+        help="Unix socket or [host:]port the tap listens on. Default is %s." % TAP_SOCKET,
+        nargs="?",
+        default=TAP_SOCKET)
+    parser.add_argument("--output", "-o",
+        help="Directory to save the streams to. Default is the current directory.",
+        default=".")
+    args = parser.parse_args()
+
+    host, port = _parse_address(args.address)
+    if port is None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(args.address)
+    else:
+        connection = socket.create_connection((host, port))
+
+    files = {}
+    while True:
+        header = _receive(connection, MESSAGE.size)
+        if header is None:
+            break
+        kind, stream, length = MESSAGE.unpack(header)
+        payload = _receive(connection, length)
+        if payload is None:
+            break
+        if kind == b"S":
+            details = json.loads(payload.decode("utf-8"))
+            path = os.path.join(args.output, "tap-" + os.path.splitext(
+                details["recording"])[0].split(".")[0] + ".wav")
+            wav = wave.open(path, "w")
+            wav.setnchannels(details["channels"])
+            wav.setframerate(details["sample_rate"])
+            wav.setsampwidth(details["bytes_per_sample"])
+            files[stream] = (wav, path)
+            print("%s started, %.2f seconds of pre-roll" % (path,
+                details["preroll"]))
+        elif kind == b"A":
+            files[stream][0].writeframesraw(payload)
+        elif kind == b"E":
+            wav, path = files.pop(stream)
+            wav.close()
+            print("%s finished, %d frames" % (path,
+                json.loads(payload.decode("utf-8"))["frames"]))
+    for wav, path in files.values():
+        wav.close()
@@ -0,0 +1,81 @@
+import unittest
+
+from backpressure import Backpressure
+from recorder import DetectorRingBuffer, RecorderList
+
+BYTES_PER_SECOND = 32000
+
+class _Detector(object):
+    """Stands in for Snowboy's detector, 16-bit mono at 16kHz"""
+    def NumChannels(self):
+        return 1
+
+    def SampleRate(self):
+        return 16000
+
+    def BitsPerSample(self):
+        return 16
+
+class _WriterPool(object):
+    """Stands in for an idle writer pool"""
+    def lag(self):
+        return 0.0
+
+class _Handler(object):
+    """Stands in for an `AudioHandler` with the default detector buffer"""
+    name = None
+    is_running = True
+    wakeup_interval = 1
+
+    def __init__(self):
+        self.detector = _Detector()
+        self.detector_buffer = DetectorRingBuffer(16000 * 5)
+        self.writer_pool = _WriterPool()
+        self.instance_recorders = RecorderList()
+        self.retrievals = RecorderList()
+
+class _PostProcessor(object):
+    """Stands in for a post-processor, counting pauses"""
+    def __init__(self):
+        self.paused = 0
+
+    def pending(self):
+        return 0
+
+    def pause(self):
+        self.paused += 1
+
+    def resume(self):
+        pass
+
+class BackpressureTest(unittest.TestCase):
+    def setUp(self):
+        self.handler = _Handler()
+        self.post_processor = _PostProcessor()
+        self.backpressure = Backpressure([self.handler],
+            post_processor=self.post_processor, interval=3600)
+
+    def tearDown(self):
+        self.backpressure.terminate()
+
+    def _fill(self, seconds):
+        """Leave `seconds` of audio waiting in the detector buffer"""
+        self.handler.detector_buffer.get()
+        self.handler.detector_buffer.extend(
+            b"\x00" * int(seconds * BYTES_PER_SECOND))
+
+    def test_idle_handler_stays_at_tier_0(self):
+        # audio builds up while detection waits after each run, a little
+        # late now and then
+        for tenth in range(0, 12):
+            self._fill(tenth / 10.0)
+            self.assertEqual(self.backpressure.check(), 0)
+        self.assertEqual(self.post_processor.paused, 0)
+
+    def test_detection_behind_sheds(self):
+        self._fill(2)
+        self.assertEqual(self.backpressure.check(), 2)
+        self.assertEqual(self.post_processor.paused, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import json, os, shutil, tempfile, unittest
+
+from chunks import ChunkStore, CHUNK_DIR, _add, _missing
+
+class IntervalsTest(unittest.TestCase):
+    def test_missing_from_nothing_is_everything(self):
+        self.assertEqual(_missing([], 10, 20), [(10, 20)])
+
+    def test_missing_around_and_between_intervals(self):
+        intervals = [[2, 4], [6, 8]]
+        self.assertEqual(_missing(intervals, 0, 10),
+            [(0, 2), (4, 6), (8, 10)])
+        self.assertEqual(_missing(intervals, 3, 7), [(4, 6)])
+        self.assertEqual(_missing(intervals, 2, 4), [])
+        self.assertEqual(_missing(intervals, 8, 9), [(8, 9)])
+
+    def test_add_keeps_intervals_sorted_and_disjoint(self):
+        intervals = []
+        _add(intervals, 6, 8)
+        _add(intervals, 0, 2)
+        self.assertEqual(intervals, [[0, 2], [6, 8]])
+
+    def test_add_merges_overlapping_and_touching_intervals(self):
+        intervals = [[0, 2], [4, 6], [8, 10]]
+        _add(intervals, 2, 4)
+        self.assertEqual(intervals, [[0, 6], [8, 10]])
+        _add(intervals, 5, 9)
+        self.assertEqual(intervals, [[0, 10]])
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = ChunkStore(self.dir, sample_rate=10, chunk_seconds=1)
+        self.store.new_session()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_overlapping_audio_is_written_once(self):
+        self.assertEqual(self.store.write(0, b"\x01" * 30), 30)
+        self.assertEqual(self.store.write(10, b"\x01" * 30), 10)
+        self.assertEqual(self.store.bytes_requested, 60)
+        self.assertEqual(self.store.bytes_written, 40)
+
+    def test_forgotten_chunks_are_written_again(self):
+        self.store.write(0, b"\x01" * 40)
+        self.store.forget(30)
+        self.assertEqual(self.store.write(0, b"\x01" * 40), 20)
+
+    def test_prune_deletes_sessions_no_manifest_refers_to(self):
+        referenced = self.store.session
+        self.store.write(0, b"\x01" * 20)
+        with open(os.path.join(self.dir, "recording-1.json"), "w") as f:
+            json.dump({"session": referenced, "chunks": []}, f)
+        self.store.new_session()
+        orphaned = self.store.session
+        self.store.write(0, b"\x01" * 20)
+
+        store = ChunkStore(self.dir, sample_rate=10, chunk_seconds=1)
+        sessions = os.listdir(os.path.join(self.dir, CHUNK_DIR))
+        self.assertIn(referenced, sessions)
+        self.assertNotIn(orphaned, sessions)
+        self.assertEqual(store.prune(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
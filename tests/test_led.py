@@ -0,0 +1,72 @@
+import os, threading, time, unittest
+
+os.environ.setdefault("CVR_MOCK_GPIO", "1")
+
+from gpio import GPIO, MockGPIO
+from led import LED, LEDWorker
+
+class LEDWorkerTest(unittest.TestCase):
+    def setUp(self):
+        if GPIO is not MockGPIO:
+            self.skipTest("CVR_MOCK_GPIO isn't in effect")
+        MockGPIO.delay = 0
+        del MockGPIO.history[:]
+        self.led = LED(15)
+        self.other = LED(18)
+        self.worker = LEDWorker()
+
+    def tearDown(self):
+        if GPIO is MockGPIO:
+            self.worker.terminate()
+            MockGPIO.delay = 0
+            MockGPIO.cleanup()
+
+    def _writes(self, led):
+        """Retrieves the states written to an LED's pin, in order"""
+        return [state for when, pin, state in MockGPIO.history
+            if pin == led.pin]
+
+    def test_requests_made_while_writing_are_coalesced(self):
+        MockGPIO.delay = 0.2
+        self.worker.set(self.led, True)
+        time.sleep(0.05)
+        for state in [False, True, False, True]:
+            self.worker.set(self.led, state)
+        self.worker.set(self.led, True)
+        self.worker.terminate()
+
+        self.assertEqual(self._writes(self.led), [GPIO.HIGH])
+
+    def test_only_changes_are_written(self):
+        self.worker.set(self.led, True)
+        deadline = time.time() + 2
+        while len(self._writes(self.led)) == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.worker.set(self.led, True)
+        self.worker.set(self.other, True)
+        self.worker.terminate()
+
+        self.assertEqual(self._writes(self.led), [GPIO.HIGH])
+        self.assertEqual(self._writes(self.other), [GPIO.HIGH])
+
+    def test_play_calls_then_once_the_pattern_finishes(self):
+        finished = threading.Event()
+        self.worker.play([({self.led: True}, 0.01), ({self.led: False}, 0.01)],
+            repeat=2, then=finished.set)
+
+        self.assertTrue(finished.wait(2))
+        self.assertEqual(self._writes(self.led),
+            [GPIO.HIGH, GPIO.LOW, GPIO.HIGH, GPIO.LOW])
+
+    def test_then_isnt_called_when_the_pattern_is_replaced(self):
+        replaced = threading.Event()
+        finished = threading.Event()
+        self.worker.play([({self.led: True}, 10)], then=replaced.set)
+        self.worker.play([({self.other: True}, 0.01)], then=finished.set)
+
+        self.assertTrue(finished.wait(2))
+        self.assertFalse(replaced.is_set())
+        self.assertEqual(self._writes(self.other), [GPIO.HIGH])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import os, shutil, tempfile, unittest
+
+from preroll import SharedRingBuffer, SharedBackwardBuffer
+
+BYTES_PER_SECOND = 32000
+
+class SharedBackwardBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.ring = SharedRingBuffer(path=os.path.join(self.dir, "preroll"),
+            size=4 * BYTES_PER_SECOND, bytes_per_second=BYTES_PER_SECOND,
+            create=True)
+        self.buf = SharedBackwardBuffer(ring=self.ring, record_for=2)
+
+    def tearDown(self):
+        self.ring.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _pass_on(self):
+        """Read from the ring and pass it on, as the audio handler does"""
+        data = self.buf.read()
+        self.buf.extend(data)
+        return data
+
+    def test_pre_roll_ends_where_the_forward_read_starts(self):
+        self.ring.extend(b"\x01" * BYTES_PER_SECOND)
+        self._pass_on()
+
+        # the capture process carries on between reads
+        self.ring.extend(b"\x02" * (BYTES_PER_SECOND // 2))
+        trigger = self.buf.total_length()
+        self.assertEqual(trigger, BYTES_PER_SECOND)
+
+        after = self._pass_on()
+        self.assertEqual(after, b"\x02" * (BYTES_PER_SECOND // 2))
+        self.assertEqual(self.buf.get_range(0, trigger),
+            b"\x01" * BYTES_PER_SECOND)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import errno, os, shutil, tempfile, time, unittest, wave
+import threading
+
+from recorder import BackwardBuffer, ForwardBuffer, InstanceRecorder, \
+    RecorderList
+from writer import WriterPool
+
+BYTES_PER_SECOND = 32000
+
+def _audio(seconds, value):
+    """Retrieves `seconds` of 16-bit mono audio, every sample `value`"""
+    return bytearray([value, 0]) * (seconds * BYTES_PER_SECOND // 2)
+
+def _wait(instance_recorder, timeout=5):
+    """Wait for a recorder to finish writing"""
+    deadline = time.time() + timeout
+    while not instance_recorder.clean_up and time.time() < deadline:
+        time.sleep(0.01)
+
+def _samples(filepath):
+    """Retrieves the audio of a WAV file"""
+    wav = wave.open(filepath, "rb")
+    try:
+        return wav.readframes(wav.getnframes())
+    finally:
+        wav.close()
+
+class _BusyRecorder(object):
+    """Stands in for a recorder whose writes stall until released"""
+    filename = "busy"
+
+    def __init__(self):
+        self.writing = threading.Event()
+        self.released = threading.Event()
+
+    def write_pending(self):
+        self.writing.set()
+        self.released.wait(5)
+
+class InstanceRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.writer_pool = WriterPool(workers=1)
+        self.buf_before = BackwardBuffer(record_for=4)
+
+    def tearDown(self):
+        self.writer_pool.terminate()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _capture(self, instance_recorder, data):
+        """Extend the buffers as the audio callback does"""
+        instance_recorder.buf_after.extend(bytes(data))
+        self.buf_before.extend(bytes(data))
+
+    def _recorder(self, **kwargs):
+        return InstanceRecorder(
+            buf_before=self.buf_before,
+            buf_after=ForwardBuffer(record_for=1),
+            dir=self.dir,
+            writer_pool=self.writer_pool,
+            **kwargs)
+
+    def test_provisional_pre_roll_is_from_the_trigger(self):
+        self.buf_before.extend(bytes(_audio(1, 1) + _audio(1, 2)))
+        instance_recorder = self._recorder(provisional=True)
+        instance_recorder.start()
+
+        # verification takes a while, capture carries on meanwhile
+        self._capture(instance_recorder, _audio(1, 3))
+        instance_recorder.commit()
+        instance_recorder.stop_capture()
+        _wait(instance_recorder)
+
+        data = _samples(instance_recorder.filepath)
+        self.assertEqual(len(data), 3 * BYTES_PER_SECOND)
+        self.assertEqual(data[:2], b"\x01\x00")
+        self.assertEqual(data[2 * BYTES_PER_SECOND:2 * BYTES_PER_SECOND + 2],
+            b"\x03\x00")
+        self.assertEqual(instance_recorder.cues,
+            [(2 * BYTES_PER_SECOND, "hotword")])
+
+    def test_pre_roll_is_from_the_trigger_when_the_writers_are_busy(self):
+        busy = _BusyRecorder()
+        self.writer_pool.schedule(busy)
+        busy.writing.wait(5)
+
+        self.buf_before.extend(bytes(_audio(1, 1) + _audio(1, 2)))
+        instance_recorder = self._recorder()
+        instance_recorder.start()
+
+        # the recording waits behind the busy one while capture carries on
+        self._capture(instance_recorder, _audio(1, 3))
+        self.assertGreater(self.writer_pool.pending(), 0)
+        busy.released.set()
+        instance_recorder.stop_capture()
+        self.writer_pool.schedule(instance_recorder)
+        _wait(instance_recorder)
+
+        data = _samples(instance_recorder.filepath)
+        self.assertEqual(data[:2], b"\x01\x00")
+        self.assertEqual(len(data), 3 * BYTES_PER_SECOND)
+        self.assertEqual(instance_recorder.dropped(), 0)
+
+    def test_recorder_that_cant_open_its_file_is_given_up_on(self):
+        finished = []
+        self.buf_before.extend(bytes(_audio(1, 1)))
+        instance_recorder = self._recorder(finished_callback=finished.append)
+        recorders = RecorderList()
+        recorders.append(instance_recorder)
+
+        def _open_file(filepath):
+            raise IOError(errno.ENOSPC, "No space left on device")
+        instance_recorder._open_file = _open_file
+        instance_recorder.start()
+        _wait(instance_recorder)
+
+        self.assertTrue(instance_recorder.clean_up)
+        self.assertTrue(instance_recorder.failed)
+        self.assertEqual(os.listdir(self.dir), [])
+        instance_recorder.stop_capture()
+        recorders.extend(bytes(_audio(1, 2)))
+        self.assertEqual(len(recorders), 0)
+        self.assertEqual(finished, [])
+
+if __name__ == "__main__":
+    unittest.main()
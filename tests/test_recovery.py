@@ -0,0 +1,51 @@
+import os, shutil, tempfile, unittest, wave
+
+from recovery import Recovery, OPEN_MARKER, mark_open
+
+class RecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _recover(self):
+        """Recover the unfinished recordings in the directory"""
+        recovery = Recovery([self.dir])
+        recovery.wait()
+        return recovery
+
+    def test_empty_file_is_removed_with_its_marker(self):
+        path = os.path.join(self.dir, "a.wav")
+        mark_open(path)
+        open(path, "wb").close()
+
+        recovery = self._recover()
+
+        self.assertEqual(recovery.failed, 0)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_unfinished_file_is_repaired(self):
+        path = os.path.join(self.dir, "a.wav")
+        mark_open(path)
+        wav = wave.open(path, "wb")
+        wav.setnchannels(1)
+        wav.setframerate(16000)
+        wav.setsampwidth(2)
+        wav.writeframes(b"\x01\x00" * 100)
+        # audio reaches the disk after the header was last written
+        wav._file.write(b"\x02\x00" * 50)
+        wav._file.flush()
+
+        recovery = self._recover()
+
+        self.assertEqual(recovery.repaired, 1)
+        self.assertFalse(os.path.exists(path + OPEN_MARKER))
+        wav = wave.open(path, "rb")
+        try:
+            self.assertEqual(wav.getnframes(), 150)
+        finally:
+            wav.close()
+
+if __name__ == "__main__":
+    unittest.main()
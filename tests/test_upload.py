@@ -0,0 +1,55 @@
+import json, os, shutil, tempfile, time, unittest
+
+from upload import Uploader, UPLOAD_FAILED_DIR, serve
+
+class UploaderTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.collected = os.path.join(self.dir, "collected")
+        os.makedirs(self.collected)
+        self.server = serve(0, self.collected, max_size=1000)
+        self.uploader = Uploader(
+            url="http://127.0.0.1:%d/cvr" % self.server.server_address[1],
+            queue_dir=os.path.join(self.dir, "queue"),
+            max_backoff=1)
+
+    def tearDown(self):
+        self.uploader.terminate()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _queue(self, name, size):
+        """Queue a recording of `size` bytes"""
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(b"\x01" * size)
+        self.uploader.queue(path, {"host": "test", "name": name})
+
+    def _wait(self, timeout=5):
+        """Wait for the queue to empty"""
+        deadline = time.time() + timeout
+        while self.uploader.pending() > 0 and time.time() < deadline:
+            time.sleep(0.05)
+
+    def test_refused_upload_is_moved_aside_and_the_queue_continues(self):
+        self._queue("big.wav", 2000)
+        self._queue("small.wav", 100)
+        self._wait()
+
+        self.assertEqual(self.uploader.pending(), 0)
+        self.assertEqual(self.uploader.failed, 1)
+        failed = os.listdir(os.path.join(self.dir, "queue", UPLOAD_FAILED_DIR))
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0].endswith("big.wav.json"))
+
+        self.assertTrue(os.path.exists(os.path.join(self.collected,
+            "recordings", "test", "small.wav")))
+        self.assertFalse(os.path.exists(os.path.join(self.collected,
+            "recordings", "test", "big.wav")))
+        with open(os.path.join(self.collected, "index.jsonl")) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual([row["name"] for row in rows], ["small.wav"])
+
+if __name__ == "__main__":
+    unittest.main()
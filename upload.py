@@ -0,0 +1,504 @@
+import os, sys, argparse, json, socket, time, wave
+import threading
+
+from log import Log
+
+try:
+    import http.client as httplib
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse
+except ImportError:
+    import httplib
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse
+
+UPLOAD_QUEUE_SIZE = 1000
+UPLOAD_BATCH_SIZE = 8
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_FAILED_DIR = "failed"
+
+# client errors that are worth retrying, timeouts and rate limits
+RETRY_STATUSES = (408, 429)
+
+class PermanentUploadError(IOError):
+    """The collector refused an upload, so retrying it won't help"""
+
+def _raise_for_status(status, what):
+    """
+    Raise an error for a collector reply that isn't a success, permanent for
+    client errors other than `RETRY_STATUSES`.
+    """
+    if 400 <= status < 500 and status not in RETRY_STATUSES:
+        raise PermanentUploadError("%s was refused with HTTP %d" %
+            (what, status))
+    raise IOError("%s failed with HTTP %d" % (what, status))
+
+class Uploader(object):
+    _tag = "uploader"
+
+    """
+    Pushes finished recordings and an index row describing each of them to a
+    collector over HTTP, so recordings don't have to be gathered from every
+    device by scanning their output directories.
+
+    `submit` only writes a small job file to the on-disk queue, so it never
+    waits on the network; the queue survives restarts and is bounded, the
+    oldest jobs being dropped once it is full. One thread works through the
+    queue over a single kept-alive connection, uploading each recording in
+    chunks with `Content-Range` so an interrupted upload resumes from what
+    the collector already has, then posting the index rows of a batch of
+    recordings in one request. Failures are retried with a growing backoff,
+    except client errors (4xx other than 408 and 429), which won't succeed
+    however often they are retried: those jobs are moved aside to the
+    `failed` directory of the queue, counted in `failed`, and the rest of
+    the queue carries on.
+
+    The collector protocol is that of `serve` below:
+        PUT <url>/recordings/<host>/<name>, Content-Range: bytes */<size>
+            asks how much the collector has, replying 308 with a
+            `Range: bytes=0-<last>` header, or 201 if it has all of it.
+        PUT <url>/recordings/<host>/<name>, Content-Range: bytes <a>-<b>/<size>
+            sends a chunk, replying the same way.
+        POST <url>/index with a JSON list of rows.
+
+    :param String url: base URL of the collector.
+    :param String queue_dir: directory to keep the queue of uploads in.
+    :param int queue_size: most recordings waiting to be uploaded.
+    :param int batch_size: most recordings to post index rows for at once.
+    :param int chunk_size: bytes of recording to send per request.
+    :param float timeout: seconds to wait on the collector.
+    :param float max_backoff: most seconds to wait before retrying.
+    """
+    def __init__(self,
+        url,
+        queue_dir,
+        queue_size=UPLOAD_QUEUE_SIZE,
+        batch_size=UPLOAD_BATCH_SIZE,
+        chunk_size=UPLOAD_CHUNK_SIZE,
+        timeout=10,
+        max_backoff=60):
+        parsed = urlparse(url)
+        if parsed.scheme != "http":
+            raise ValueError("Can only upload over http, not %s" % url)
+        self._address = (parsed.hostname, parsed.port or 80)
+        self._path = parsed.path.rstrip("/")
+        self._host = socket.gethostname()
+
+        self._queue_dir = queue_dir
+        if not os.path.isdir(queue_dir):
+            os.makedirs(queue_dir)
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._chunk_size = chunk_size
+        self._timeout = timeout
+        self._max_backoff = max_backoff
+
+        self.failed = 0
+        self._connection = None
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._is_terminated = False
+
+        self._thread = threading.Thread(target=self._work, name="uploader")
+        self._thread.daemon = True
+        self._thread.start()
+
+        Log.debug(self._tag, "Uploader created (%d queued)" % len(self._jobs()))
+
+    def submit(self, instance_recorder):
+        """
+        Queue the files of a finished recording to be uploaded, without
+        waiting on the network. If the queue is full the oldest file is
+        dropped from it.
+
+        :param InstanceRecorder instance_recorder: the finished recorder.
+        :return: None
+        """
+        for path in instance_recorder.files():
+            self.queue(path, {
+                "host": self._host,
+                "name": os.path.basename(path),
+                "recording": instance_recorder.filename,
+                "channels": instance_recorder.num_channels,
+                "sample_rate": instance_recorder.sample_rate,
+                "bytes_per_sample": instance_recorder.bytes_per_sample,
+                "encoding": instance_recorder.encoding,
+                "cues": instance_recorder.cues,
+            })
+
+    def queue(self, path, row):
+        """
+        Queue a file to be uploaded.
+
+        :param String path: the file.
+        :param dict row: index row describing the file.
+        :return: None
+        """
+        with self._lock:
+            self._sequence += 1
+            name = "%015d-%04d-%s.json" % (int(time.time() * 1000),
+                self._sequence % 10000, os.path.basename(path))
+            tmp = os.path.join(self._queue_dir, "." + name)
+            with open(tmp, "w") as f:
+                json.dump({"path": os.path.abspath(path), "row": row}, f)
+            os.rename(tmp, os.path.join(self._queue_dir, name))
+
+            jobs = self._jobs()
+            for job in jobs[:max(0, len(jobs) - self._queue_size)]:
+                Log.warning(self._tag, "Upload queue full, dropping %s" % job)
+                self._remove(job)
+        self._wake.set()
+
+    def pending(self):
+        """Retrieves the number of recordings waiting to be uploaded"""
+        return len(self._jobs())
+
+    def pause(self):
+        """
+        Stop uploading after the current batch, so the disk is left to the
+        writers, while recordings are still queued.
+
+        :return: None
+        """
+        self._resumed.clear()
+
+    def resume(self):
+        """
+        Carry on uploading after `pause`.
+
+        :return: None
+        """
+        self._resumed.set()
+
+    def is_paused(self):
+        """Retrieves whether uploading is paused"""
+        return not self._resumed.is_set()
+
+    def terminate(self):
+        """
+        Stop uploading, leaving anything not yet uploaded queued on disk for
+        next time.
+
+        :return: None
+        """
+        self._is_terminated = True
+        self._wake.set()
+        self._resumed.set()
+        self._thread.join()
+        if self._connection is not None:
+            self._connection.close()
+        Log.debug(self._tag, "Uploader terminated")
+
+    def _jobs(self):
+        """Retrieves the queued job files, oldest first"""
+        return sorted(name for name in os.listdir(self._queue_dir)
+            if name.endswith(".json") and not name.startswith("."))
+
+    def _remove(self, job):
+        """Remove a job from the queue"""
+        try:
+            os.remove(os.path.join(self._queue_dir, job))
+        except OSError:
+            pass
+
+    def _dead_letter(self, job, reason):
+        """Move a job that can never succeed aside, out of the queue"""
+        failed_dir = os.path.join(self._queue_dir, UPLOAD_FAILED_DIR)
+        Log.error(self._tag, "Giving up on %s, moved to %s: %s" %
+            (job, failed_dir, reason))
+        self.failed += 1
+        try:
+            if not os.path.isdir(failed_dir):
+                os.makedirs(failed_dir)
+            os.rename(os.path.join(self._queue_dir, job),
+                os.path.join(failed_dir, job))
+        except OSError:
+            self._remove(job)
+
+    def _work(self):
+        """Upload batches from the queue until terminated"""
+        backoff = 1
+        while not self._is_terminated:
+            self._resumed.wait()
+            if self._is_terminated:
+                break
+            jobs = self._jobs()[:self._batch_size]
+            if len(jobs) == 0:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            try:
+                self._upload_batch(jobs)
+                backoff = 1
+            except (EnvironmentError, httplib.HTTPException) as e:
+                Log.warning(self._tag, "Upload failed, retrying in %ds: %s" %
+                    (backoff, e))
+                self._wake.wait(backoff)
+                self._wake.clear()
+                backoff = min(backoff * 2, self._max_backoff)
+
+    def _upload_batch(self, jobs):
+        """
+        Upload the recordings of some jobs, then post their index rows and
+        remove them from the queue.
+
+        :param list jobs: job file names.
+        :return: None
+        """
+        rows = []
+        uploaded = []
+        for job in jobs:
+            if self._is_terminated:
+                break
+            try:
+                with open(os.path.join(self._queue_dir, job)) as f:
+                    job_data = json.load(f)
+            except (IOError, ValueError):
+                # dropped from a full queue, or unreadable
+                continue
+
+            path = job_data["path"]
+            if not os.path.exists(path):
+                Log.warning(self._tag, "%s no longer exists, not uploading" %
+                    path)
+                self._remove(job)
+                continue
+
+            row = job_data["row"]
+            row["size"] = os.path.getsize(path)
+            row["time"] = os.path.getmtime(path)
+            try:
+                recording = wave.open(path, "rb")
+                row["duration"] = float(recording.getnframes()) / \
+                    recording.getframerate()
+                recording.close()
+            except (wave.Error, EOFError):
+                pass
+
+            started = time.time()
+            try:
+                self._upload(path, row)
+            except PermanentUploadError as e:
+                self._dead_letter(job, e)
+                continue
+            Log.debug(self._tag, "Uploaded %s (%d bytes) in %.2f seconds" %
+                (row["name"], row["size"], time.time() - started))
+            rows.append(row)
+            uploaded.append(job)
+
+        if len(rows) > 0:
+            body = json.dumps(rows).encode("utf-8")
+            status, _ = self._request("POST", self._path + "/index", body,
+                {"Content-Type": "application/json"})
+            if status not in (200, 201, 204):
+                try:
+                    _raise_for_status(status, "Posting index rows")
+                except PermanentUploadError as e:
+                    for job in uploaded:
+                        self._dead_letter(job, e)
+                    return
+            Log.info(self._tag, "Uploaded %d recordings" % len(rows))
+
+        for job in uploaded:
+            self._remove(job)
+
+    def _upload(self, path, row):
+        """
+        Upload a recording in chunks, starting from what the collector already
+        has.
+
+        :param String path: the recording.
+        :param dict row: its index row.
+        :return: None
+        """
+        url = str("%s/recordings/%s/%s" %
+            (self._path, row["host"], row["name"]))
+        size = row["size"]
+        offset = self._received(*self._request("PUT", url, b"",
+            {"Content-Range": "bytes */%d" % size}))
+
+        with open(path, "rb") as f:
+            while offset is not None:
+                f.seek(offset)
+                chunk = f.read(self._chunk_size)
+                if len(chunk) == 0:
+                    raise IOError("%s is shorter than %d bytes" % (path, size))
+                offset = self._received(*self._request("PUT", url, chunk,
+                    {"Content-Range": "bytes %d-%d/%d" %
+                        (offset, offset + len(chunk) - 1, size)}))
+
+    def _received(self, status, received_range):
+        """
+        Work out how much of a recording the collector has from its reply.
+
+        :return: bytes received, or None if it has all of it.
+        """
+        if status in (200, 201):
+            return None
+        elif status != 308:
+            _raise_for_status(status, "Upload")
+        elif received_range is None:
+            return 0
+        return int(received_range.split("-")[-1]) + 1
+
+    def _request(self, method, url, body, headers):
+        """
+        Make a request over the kept-alive connection, opening a new one if
+        there isn't one.
+
+        :return: tuple of the status and the `Range` header.
+        """
+        if self._connection is None:
+            self._connection = httplib.HTTPConnection(*self._address,
+                timeout=self._timeout)
+        try:
+            self._connection.request(method, url, body, headers)
+            response = self._connection.getresponse()
+            response.read()
+        except (EnvironmentError, httplib.HTTPException):
+            self._connection.close()
+            self._connection = None
+            raise
+        return response.status, response.getheader("Range")
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    """Stand-in collector for `Uploader`, storing uploads in `server.dir`"""
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        parts = self.path.rstrip("/").split("/")
+        if len(parts) < 3 or parts[-3] != "recordings":
+            return self._reply(404)
+        directory = os.path.join(self.server.dir, "recordings",
+            os.path.basename(parts[-2]))
+        path = os.path.join(directory, os.path.basename(parts[-1]))
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(path):
+            return self._reply(201)
+
+        content_range = self.headers.get("Content-Range", "")
+        try:
+            span, total = content_range.split(" ")[1].split("/")
+            total = int(total)
+        except (IndexError, ValueError):
+            return self._reply(400)
+        if self.server.max_size is not None and total > self.server.max_size:
+            return self._reply(413)
+
+        part = path + ".part"
+        received = os.path.getsize(part) if os.path.exists(part) else 0
+        if span != "*" and int(span.split("-")[0]) == received:
+            with open(part, "ab") as f:
+                f.write(body)
+            received += len(body)
+
+        if received >= total:
+            os.rename(part, path)
+            return self._reply(201)
+        elif received > 0:
+            return self._reply(308, {"Range": "bytes=0-%d" % (received - 1)})
+        return self._reply(308)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/index"):
+            return self._reply(404)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with open(os.path.join(self.server.dir, "index.jsonl"), "a") as f:
+            for row in json.loads(body.decode("utf-8")):
+                f.write(json.dumps(row, sort_keys=True) + "\n")
+        return self._reply(204)
+
+    def _reply(self, status, headers={}):
+        self.send_response(status,
+            "Resume Incomplete" if status == 308 else None)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        Log.debug("collector", format % args)
+
+class CollectorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(port, directory, max_size=None):
+    """
+    Run a stand-in collector, storing recordings in `directory/recordings`
+    and index rows in `directory/index.jsonl`.
+
+    :param int port: port to listen on.
+    :param String directory: directory to store uploads in.
+    :param int max_size: most bytes a recording may be, refusing larger ones
+                                with HTTP 413; None for no limit.
+    :return: CollectorServer, serving on its own thread.
+    """
+    server = CollectorServer(("", port), CollectorHandler)
+    server.dir = directory
+    server.max_size = max_size
+    thread = threading.Thread(target=server.serve_forever, name="collector")
+    thread.daemon = True
+    thread.start()
+    Log.info("collector", "Collecting into %s on port %d" %
+        (directory, server.server_address[1]))
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Upload recordings to a collector, or run a stand-in collector.")
+    parser.add_argument("command",
+        help="`serve` a stand-in collector, or `upload` some files to a collector.",
+        choices={"serve", "upload"})
+    parser.add_argument("files",
+        help="Recordings to upload.",
+        nargs="*")
+    parser.add_argument("--log",
+        help="Minimum level of log output.",
+        choices={"DEBUG","INFO","WARNING","ERROR","CRITICAL"},
+        default="INFO")
+    parser.add_argument("--port",
+        help="Port for `serve` to listen on. Default is 8080.",
+        default=8080,
+        type=int)
+    parser.add_argument("--dir",
+        help="Directory for `serve` to store uploads in. Default is the current directory.",
+        default=".")
+    parser.add_argument("--max-size",
+        help="Most bytes `serve` accepts per recording, refusing larger ones. Default is no limit.",
+        dest='max_size',
+        default=None,
+        type=int)
+    parser.add_argument("--url",
+        help="Collector to `upload` to. Default is http://localhost:8080.",
+        default="http://localhost:8080")
+    parser.add_argument("--queue",
+        help="Directory to queue uploads in. Default is .upload-queue.",
+        default=".upload-queue")
+    args = parser.parse_args()
+
+    Log.init(getattr(Log,args.log))
+
+    if args.command == "serve":
+        serve(args.port, args.dir, args.max_size)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    uploader = Uploader(url=args.url, queue_dir=args.queue)
+    for path in args.files:
+        uploader.queue(path, {"host": socket.gethostname(),
+            "name": os.path.basename(path)})
+    while uploader.pending() > 0:
+        time.sleep(0.5)
+    uploader.terminate()
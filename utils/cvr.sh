@@ -14,6 +14,11 @@ LOCK_FILE='/var/lock/cvr'
 PID_FILE='/var/run/cvr'
 DIR='/home/username/cvr/'
 COMMAND="python cvr.py Alexa.pmdl"
+# Set PREROLL to a path such as '/dev/shm/cvr-preroll' to keep the pre-roll in
+# shared memory, in a capture process, so it survives the detector being
+# restarted. Give capture.py --seconds of the detector's --before plus 10.
+PREROLL=''
+CAPTURE_COMMAND="python capture.py --segment ${PREROLL}"
 
 # This allows us to interrupt kindly before killing the process
 interrupt_process() {
@@ -44,56 +49,98 @@ interrupt_process() {
     fi
 }
 
-# Carry out specific functions when asked to by the system
-case "$1" in
-  start)
-    # Only allow CVR once
-    if [ -e "${LOCK_FILE}" ]; then
-        echo "CVR might be running already. Try running stop first."
-        exit 0
-    fi
-    touch $LOCK_FILE
-
-    cd "$DIR"
+# Restart the detector within a second whenever it exits, until stopped
+supervise() {
+    while [ -e "${LOCK_FILE}" ]; do
+        if [ -z "${PREROLL}" ]; then
+            eval "${COMMAND}" >>/var/log/cvr.log 2>&1
+        else
+            eval "${COMMAND} --shared-preroll ${PREROLL}" >>/var/log/cvr.log 2>&1
+        fi
 
-    echo -n "Starting CVR... "
-    eval "${COMMAND}" >>/var/log/cvr.log 2>&1 &
-    echo $! > "${PID_FILE}"
-    echo "Done"
-    ;;
-  stop)
-    echo -n "Stopping CVR... "
+        if [ -e "${LOCK_FILE}" ]; then
+            echo "CVR exited, restarting" >>/var/log/cvr.log
+            sleep 0.5
+        fi
+    done
+}
 
-    interrupt_process "${COMMAND}" "INT"
+# Stop a process kindly, then forcefully
+stop_process() {
+    interrupt_process "$1" "INT"
     result=$?
     if [ $result -eq 3 ]; then
         echo "Not Running"
     elif [ $result -eq 2 ]; then
         echo "Done"
     else
-        interrupt_process "${COMMAND}"
+        interrupt_process "$1"
         if [ $? -eq 2 ]; then
             echo "Done"
         else
-            interrupt_process "${COMMAND}" "INT"
+            interrupt_process "$1" "INT"
             if [ $? -eq 2 ]; then
                 echo "Done"
             else
-                interrupt_process "${COMMAND}" "KILL"
+                interrupt_process "$1" "KILL"
             fi
         fi
     fi
+}
 
+# Carry out specific functions when asked to by the system
+case "$1" in
+  start)
+    # Only allow CVR once
+    if [ -e "${LOCK_FILE}" ]; then
+        echo "CVR might be running already. Try running stop first."
+        exit 0
+    fi
+    touch $LOCK_FILE
+
+    cd "$DIR"
+
+    if [ -n "${PREROLL}" ]; then
+        echo -n "Starting CVR capture... "
+        rm -f "${PREROLL}"
+        eval "${CAPTURE_COMMAND}" >>/var/log/cvr.log 2>&1 &
+        while [ ! -e "${PREROLL}" ]; do
+            sleep 0.1
+        done
+        echo "Done"
+    fi
+
+    echo -n "Starting CVR... "
+    supervise &
+    echo $! > "${PID_FILE}"
+    echo "Done"
+    ;;
+  stop)
+    # Removing the lock stops the supervisor restarting the detector
     if [ -e "${LOCK_FILE}" ]; then
         rm $LOCK_FILE
     fi
+
+    echo -n "Stopping CVR... "
+    stop_process "${COMMAND}"
+
+    if [ -n "${PREROLL}" ]; then
+        echo -n "Stopping CVR capture... "
+        stop_process "${CAPTURE_COMMAND}"
+    fi
+    ;;
+  reload)
+    # Restart only the detector, the supervisor brings it back and the
+    # pre-roll is kept by the capture process
+    echo -n "Reloading CVR... "
+    stop_process "${COMMAND}"
     ;;
   restart)
     /etc/init.d/cvr stop && /etc/init.d/cvr start
     exit 1
     ;;
   *)
-    echo "Usage: /etc/init.d/cvr {start|stop|restart}"
+    echo "Usage: /etc/init.d/cvr {start|stop|reload|restart}"
     exit 1
     ;;
 esac
@@ -0,0 +1,138 @@
+import os, sys, time
+import threading
+import snowboydetect
+
+from log import Log
+from recorder import RESOURCE_FILE
+from agc import AutomaticGainControl, AGC_TARGET
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class Verifier(object):
+    _tag = "verifier"
+
+    """
+    Second stage of hotword detection, which re-scores the audio around a
+    trigger with a stricter `SnowboyDetect` (or a different model) on its own
+    thread, so false triggers can be discarded before anything is written.
+
+    :param decoder_model: decoder model file path; stirng or list of strings
+    :param Path resource: resource file path.
+    :param sensitivity: decoder sensitivity, a float of a list of floats.
+    :param audio_gain: multiply input volume by this factor.
+    :param bool agc: run the audio through automatic gain control before
+                                re-scoring it, as the first detector heard
+                                it, starting from the gain given to `submit`.
+    :param float agc_target: level the gain control brings audio to, in dBFS.
+    :param float chunk_time: seconds of audio to pass to each `RunDetection`.
+    :param int queue_size: number of triggers that can wait to be verified.
+    """
+    def __init__(self,
+        decoder_model,
+        resource=RESOURCE_FILE,
+        sensitivity=[],
+        audio_gain=1,
+        agc=False,
+        agc_target=AGC_TARGET,
+        chunk_time=0.1,
+        queue_size=4):
+        if type(decoder_model) is not list:
+            decoder_model = [decoder_model]
+        if type(sensitivity) is not list:
+            sensitivity = [sensitivity]
+
+        self.detector = snowboydetect.SnowboyDetect(
+            resource_filename=resource.encode(),
+            model_str=",".join(decoder_model).encode())
+        self.detector.SetAudioGain(audio_gain)
+        num_hotwords = self.detector.NumHotwords()
+        if len(sensitivity) == 1:
+            sensitivity = sensitivity*num_hotwords
+        if len(sensitivity) != 0:
+            self.detector.SetSensitivity(
+                ",".join([str(t) for t in sensitivity]).encode())
+
+        if agc:
+            self._agc = AutomaticGainControl(
+                channels=self.detector.NumChannels(),
+                sample_rate=self.detector.SampleRate(),
+                bytes_per_sample=self.detector.BitsPerSample() // 8,
+                target=agc_target)
+        else:
+            self._agc = None
+
+        self._chunk_size = int(chunk_time * self.detector.SampleRate()) * \
+            self.detector.NumChannels() * self.detector.BitsPerSample() // 8
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._work, name="verifier")
+        self._thread.daemon = True
+        self._thread.start()
+
+        Log.debug(self._tag, "Verifier created")
+
+    def submit(self, instance_recorder, audio, callback, agc_gain=0.0):
+        """
+        Queue a trigger to be verified, without blocking. If the queue is
+        full the trigger is accepted unverified, so hotwords aren't lost.
+
+        :param InstanceRecorder instance_recorder: the provisional recording.
+        :param bytes audio: the audio around the trigger.
+        :param function callback: called on the verifier thread with the
+                                recorder and whether it passed.
+        :param float agc_gain: gain in dB the first detector's gain control
+                                had reached, used with `agc`.
+        :return: None
+        """
+        try:
+            self._queue.put_nowait((instance_recorder, audio, callback,
+                agc_gain))
+        except queue.Full:
+            Log.warning(self._tag, "Verification queue full, accepting %s" %
+                instance_recorder.filename)
+            callback(instance_recorder, True)
+
+    def verify(self, audio, agc_gain=0.0):
+        """
+        Run the second detector over some audio.
+
+        :param bytes audio: the audio to check.
+        :param float agc_gain: gain in dB to start the gain control from, used
+                                with `agc`.
+        :return: Boolean, True if a hotword was detected.
+        """
+        if self._agc is not None:
+            self._agc.reset(agc_gain)
+            audio = self._agc.process(audio)
+        self.detector.Reset()
+        for start in range(0, len(audio), self._chunk_size):
+            if self.detector.RunDetection(
+                audio[start:start + self._chunk_size]) > 0:
+                return True
+        return False
+
+    def terminate(self):
+        """
+        Stop the verifier once the queued triggers have been verified.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        Log.debug(self._tag, "Verifier terminated")
+
+    def _work(self):
+        """Verify triggers from the queue until told to stop"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            instance_recorder, audio, callback, agc_gain = item
+            started = time.time()
+            passed = self.verify(audio, agc_gain)
+            Log.info(self._tag, "%s %s verification in %.3f seconds" %
+                (instance_recorder.filename, "passed" if passed else "failed",
+                    time.time() - started))
+            callback(instance_recorder, passed)
@@ -0,0 +1,111 @@
+import os, sys, time
+import threading
+
+from log import Log
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+WRITER_THREADS = 2
+
+class WriterPool(object):
+    _tag = "writer_pool"
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    """
+    Fixed number of threads that write every active recording, so the number
+    of threads (and their stacks) stays the same however many recordings
+    overlap. Recordings are put on a ready queue when they have enough audio
+    buffered to be worth writing, or when they finish; a recording is only
+    ever queued once at a time. How long the oldest has waited is its `lag`.
+
+    :param int workers: number of writer threads.
+    """
+    def __init__(self, workers=WRITER_THREADS):
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._queued = {}
+
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name="writer-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        Log.debug(self._tag, "WriterPool created with %d workers" % workers)
+
+    @staticmethod
+    def shared():
+        """
+        Retrieve the pool shared by recorders that weren't given one.
+
+        :return: WriterPool
+        """
+        with WriterPool._shared_lock:
+            if WriterPool._shared is None:
+                WriterPool._shared = WriterPool()
+            return WriterPool._shared
+
+    def schedule(self, instance_recorder):
+        """
+        Queue a recorder to have its buffered audio written, unless it is
+        already queued. Never blocks, so is safe to call from the audio
+        callback.
+
+        :param InstanceRecorder instance_recorder: recorder with audio to write.
+        :return: None
+        """
+        with self._lock:
+            if id(instance_recorder) in self._queued:
+                return
+            self._queued[id(instance_recorder)] = time.time()
+        self._ready.put(instance_recorder)
+
+    def pending(self):
+        """Retrieves the number of recorders waiting to be written"""
+        return self._ready.qsize()
+
+    def lag(self):
+        """Retrieves the seconds the longest waiting recorder has waited"""
+        with self._lock:
+            if len(self._queued) == 0:
+                return 0.0
+            return time.time() - min(self._queued.values())
+
+    def terminate(self):
+        """
+        Stop the writer threads once the queued recorders have been written.
+        """
+        for thread in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+        with WriterPool._shared_lock:
+            if WriterPool._shared is self:
+                WriterPool._shared = None
+        Log.debug(self._tag, "WriterPool terminated")
+
+    def _work(self):
+        """Write recorders from the ready queue until told to stop"""
+        while True:
+            instance_recorder = self._ready.get()
+            if instance_recorder is None:
+                break
+
+            # allow the recorder to be queued again while it is written
+            with self._lock:
+                self._queued.pop(id(instance_recorder), None)
+
+            # a recorder that fails would fail again on every pass, so it is
+            # given up on
+            try:
+                instance_recorder.write_pending()
+            except Exception as e:
+                Log.error(self._tag, "Couldn't write %s: %s" %
+                    (instance_recorder.filename, e))
+                instance_recorder.fail(e)